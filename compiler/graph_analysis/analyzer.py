@@ -1,27 +1,33 @@
 import networkx as nx
 import json
-import matplotlib.pyplot as plt
-import pygraphviz
-from networkx.drawing.nx_agraph import graphviz_layout
-import networkx.algorithms.approximation as approx
-import networkx.algorithms.dag as dag
-import networkx.algorithms.components as comps
+import os
 import ld_helpers
+from mpu_helpers import NUM_DEFAULT_MPU_REGIONS, get_padding
 import devices
+import pdg_loader
+import pdg
+import region_merge
+import switch_profile
+import emulated_stores
 from  pprint import pprint
 import collections
+import functools
+import itertools
+import multiprocessing
+import heapq
+import numpy
 
 from key_defs import *
 
-# This can be changed by commandline argument
-MAX_DATA_REGIONS = 4
+# Data and peripheral regions available to each compartment when not given,
+# -n sets the total number of MPU regions
+DEFAULT_MAX_DATA_REGIONS = 4
 
-#Number of MPU regions reserved to set global permissions
-NUM_DEFAULT_MPU_REGIONS = 4
+# Directory debug graphs are written to, set by --debug-dir.  None disables
+# them
+DEBUG_DIR = None
 
 
-CONTROL_EDGES = ['Callee','Indirect Call']
-
 DATA_EDGES = [DATA_EDGE_TYPE, PERIPHERAL_EDGE_TYPE, ALIAS_EDGE_TYPE]
 
 DEFAULT_NODE_ADDR = {'colorscheme':'set312'}
@@ -53,73 +59,211 @@ NODE_TYPE_LUT = {'Function':('function','ellipse',[]),
 SYSCALL_COMP_REQUIREMENTS = {"_sbrk": ["malloc", "_sbrk_r"]}
 
 
-def lowest_cost_data_merge(R,c_region):
-    data_regions = nx.get_node_attributes(R,DATA_REGION_KEY).keys()
-    preds = []
-    for p in R.predecessors(c_region):
-        if p in data_regions:
-            preds.append(p)
-
-    min_cost = (None,None,None)
-    for i in range(len(preds)):
-        src = preds[i]
-        code_regions = set(R.successors(src))
-        for j in range(i+1,len(preds)):
-            dest = preds[j]
-            code_regions.update(R.successors(dest))
-            if min_cost[2] == None:
-                min_cost = (src,dest,len(code_regions)-1)
-            elif min_cost[2] > len(code_regions):
-                min_cost = (src,dest,len(code_regions)-1)
-
-            if min_cost[2] == 0:
-                print "Data min_cost", min_cost
-                return min_cost
-
-    print "Data min_cost", min_cost
-    return min_cost
+def write_debug_graph(G,filename):
+    '''
+        Writes G as a .dot file in DEBUG_DIR, if it is set
+    '''
+    if DEBUG_DIR is None:
+        return
+    import dot_writer
+    if not os.path.isdir(DEBUG_DIR):
+        os.makedirs(DEBUG_DIR)
+    dot_writer.write_dot(G, os.path.join(DEBUG_DIR,filename),
+                         NODE_TYPE_ATTRS, EDGE_TYPE_ATTRS, DEFAULT_NODE_ADDR)
 
 
 def look_up_mpu_peripheral(R,T,n):
     return R.node[n][KEY_MPU_TREE_NAME]
 
-def lowest_cost_peripheral_merge(R,T,c_region):
-    peripheral_regions =[]
-    for p in R.predecessors(c_region):
+
+def get_required_mask(R, c_region):
+    '''
+        Gets the bitmask of the peripherals the peripheral regions of
+        c_region were made for
+    '''
+    required_mask = 0
+    for p in R.predecessors_iter(c_region):
         if R.node[p][TYPE_KEY] == PERIPHERAL_REGION_KEY:
-            peripheral_regions.append(p)
+            required_mask |= R.node[p][KEY_REQUIRED_MASK]
+    return required_mask
 
-    required_pers = set()
-    for p in peripheral_regions:
-        required_pers.update(R.node[p][KEY_REQUIRED_PERIPHERALS])
-
-    min_cost = (None,None,None)
-    for i in range(len(peripheral_regions)):
-        src = peripheral_regions[i]
-        mpu_tree_src = look_up_mpu_peripheral(R,T,src)
-        for j in range(i+1,len(peripheral_regions)):
-            dest = peripheral_regions[j]
-            mpu_tree_dest = look_up_mpu_peripheral(R,T,dest)
-            if mpu_tree_src == None or mpu_tree_dest == None:
-                continue
 
-            covered_peripherals = devices.get_covered_peripherals(T,mpu_tree_src,mpu_tree_dest)
-            
-            if covered_peripherals == None:
-                cost = None
-            else:
-                cost = len(covered_peripherals.difference(required_pers))
+def get_merge_padding(R, r1, r2):
+    '''
+        Returns the change in padding from merging regions r1 and r2, from
+        their SIZE_KEY (0 if they have none)
+    '''
+    s1 = R.node[r1].get(SIZE_KEY, 0)
+    s2 = R.node[r2].get(SIZE_KEY, 0)
+    return get_padding(s1 + s2) - get_padding(s1) - get_padding(s2)
 
-            if cost == None:
-                pass
-            elif min_cost[2] == None:
-                min_cost = (src,dest,cost)
-            elif min_cost[2] > cost:
-                min_cost = (src,dest,cost)
 
-            if min_cost[2] == 0:
-                return min_cost
-    return min_cost
+class RegionLowering(object):
+    '''
+        Merges the data and peripheral regions code regions depend on until
+        each depends on at most max_regions.
+
+        Code regions are lowered in order of how far they are over the
+        limit, using a heap.  Each code region keeps a heap of the candidate
+        merges of the regions it depends on, with their costs:
+            data:       the number of other code regions that can access the
+                        merged region
+            peripheral: the number of peripherals the merged MPU region
+                        covers that the code region does not require
+        On equal cost peripheral merges are preferred, then the merge that
+        adds the least padding (peripheral regions add none).
+        A cost only changes when one of its regions is merged, so each
+        region has a version and candidates made with an older version are
+        dropped when they reach the top of the heap.  Only candidates with
+        the newly merged region are added.
+    '''
+    PERIPHERAL = 0  # Peripheral merges are preferred on equal cost
+    DATA = 1
+
+    def __init__(self, R, T, max_regions):
+        self.R = R
+        self.T = T
+        self.max_regions = max_regions
+        self.version = collections.defaultdict(int)
+        self.candidates = {}
+        self.required = {}
+
+    def num_over(self, c_region):
+        return self.R.in_degree(c_region) - self.max_regions
+
+    def _regions_of_type(self, c_region, r_type):
+        return [p for p in self.R.predecessors_iter(c_region)
+                if self.R.node[p][TYPE_KEY] == r_type]
+
+    def _cost(self, c_region, kind, r1, r2):
+        if kind == self.DATA:
+            succ = set(self.R.successors(r1))
+            succ.update(self.R.successors(r2))
+            return len(succ) - 1
+        ancestor = self._ancestor(r1, r2)
+        if ancestor is None:
+            return None
+        covered = self.T.node[ancestor][KEY_LEAF_MASK]
+        return devices.count_bits(covered & ~self.required[c_region])
+
+    def _ancestor(self, p1, p2):
+        '''
+            Gets the MPU region covering peripheral regions p1 and p2
+        '''
+        t1 = look_up_mpu_peripheral(self.R, self.T, p1)
+        t2 = look_up_mpu_peripheral(self.R, self.T, p2)
+        return devices.get_nearest_common_ancestor(self.T, t1, t2)
+
+    def _push(self, c_region, kind, r1, r2):
+        cost = self._cost(c_region, kind, r1, r2)
+        if cost is not None:
+            padding = 0
+            if kind == self.DATA:
+                padding = get_merge_padding(self.R, r1, r2)
+            heapq.heappush(self.candidates[c_region],
+                           (cost, kind, padding, r1, r2,
+                            self.version[r1], self.version[r2]))
+
+    def _add_candidates(self, c_region, region):
+        '''
+            Adds the merges of region with the other regions of its type
+            c_region depends on
+        '''
+        if not self.candidates.has_key(c_region):
+            return
+        r_type = self.R.node[region][TYPE_KEY]
+        kind = self.DATA if r_type == DATA_REGION_KEY else self.PERIPHERAL
+        for other in self._regions_of_type(c_region, r_type):
+            if other != region:
+                self._push(c_region, kind, region, other)
+
+    def _build_candidates(self, c_region):
+        self.candidates[c_region] = []
+        self.required[c_region] = get_required_mask(self.R, c_region)
+        for r_type, kind in ((DATA_REGION_KEY, self.DATA),
+                             (PERIPHERAL_REGION_KEY, self.PERIPHERAL)):
+            regions = self._regions_of_type(c_region, r_type)
+            for i in range(len(regions)):
+                for j in range(i + 1, len(regions)):
+                    self._push(c_region, kind, regions[i], regions[j])
+
+    def _is_current(self, c_region, candidate):
+        (cost, kind, padding, r1, r2, v1, v2) = candidate
+        return self.version[r1] == v1 and self.version[r2] == v2
+
+    def lowest_cost_merge(self, c_region):
+        '''
+            Returns the cheapest (cost, kind, padding, r1, r2, ...) merge for
+            c_region, or None if there is none
+        '''
+        if not self.candidates.has_key(c_region):
+            self._build_candidates(c_region)
+        heap = self.candidates[c_region]
+        while heap and not self._is_current(c_region, heap[0]):
+            heapq.heappop(heap)
+        if heap:
+            return heapq.heappop(heap)
+        return None
+
+    def merge_data(self, d1, d2):
+        merge_regions(self.R, d1, d2)
+        self.version[d1] += 1
+        self.version[d2] += 1
+        affected = []
+        for c in self.R.successors_iter(d1):
+            if self.R.node[c][TYPE_KEY] == CODE_REGION_KEY:
+                self._add_candidates(c, d1)
+                affected.append(c)
+        return affected
+
+    def merge_peripherals(self, c_region, p1, p2):
+        new_region, removed = merge_peripheral_regions(
+            self.R, self.T, c_region, p1, p2, self._ancestor(p1, p2))
+        if new_region is None:
+            return False
+        for r in removed:
+            self.version[r] += 1
+        self.version[new_region] += 1
+        self._add_candidates(c_region, new_region)
+        return True
+
+    def lower(self):
+        '''
+            Returns True if every code region is within the limit
+        '''
+        R = self.R
+        over = []
+        for c_region, attrs in R.nodes_iter(True):
+            if attrs[TYPE_KEY] == CODE_REGION_KEY and \
+                    self.num_over(c_region) > 0:
+                over.append((-self.num_over(c_region), c_region))
+        heapq.heapify(over)
+        while over:
+            (num, c_region) = heapq.heappop(over)
+            current = self.num_over(c_region)
+            if current <= 0:
+                continue
+            if current != -num:
+                heapq.heappush(over, (-current, c_region))
+                continue
+
+            merge = self.lowest_cost_merge(c_region)
+            changed = False
+            affected = [c_region]
+            if merge is not None:
+                (cost, kind, padding, r1, r2, v1, v2) = merge
+                if kind == self.DATA:
+                    affected = self.merge_data(r1, r2)
+                    changed = True
+                else:
+                    changed = self.merge_peripherals(c_region, r1, r2)
+            if not changed:
+                print "Unable to make implementable", c_region, R.predecessors(c_region)
+                return False
+            for c in affected:
+                if self.num_over(c) > 0:
+                    heapq.heappush(over, (-self.num_over(c), c))
+        return True
 
 
 def move_to_same_comp(R, functs):
@@ -151,59 +295,265 @@ def move_to_same_comp(R, functs):
                     attr[OBJECTS_KEY].remove(key)
 
 
-def make_implementable(R, T):
-    '''
-    Lowers the region graph to number of available MPU regions
-        R: A region graph
-        T: Device Tree describing MPU regions for peripherals
-        This makes the the graph implementable by reducing the number of data
-        and peripheral dependancies to below the available mpu threashold.
-    '''
+def prepare_for_lowering(R):
     remove_all_non_region_nodes(R)
     move_to_same_comp(R, SYSCALL_COMP_REQUIREMENTS)
 
-    #code_regions = nx.get_node_attributes(R,CODE_REGION_KEY)
 
-    for c_region,attrs in R.nodes(True):
-        changed = True
-        if attrs[TYPE_KEY] != CODE_REGION_KEY:
+def lower_regions(R, T, max_regions):
+    M = region_merge.RegionMerger(R)
+    implementable = RegionLowering(M, T, max_regions).lower()
+    return M.apply(), implementable
+
+
+def use_free_regions(R, max_regions, switch_counts=None,
+                     emulated_stores=None):
+    '''
+        Uses the MPU regions a lowered region graph has left for the
+        recorded switches and emulated stores, see merge_hot_code_regions
+        and place_emulated_globals.  R is updated in place and returned
+    '''
+    if switch_counts:
+        M = region_merge.RegionMerger(R)
+        merge_hot_code_regions(M, max_regions, switch_counts)
+        R = M.apply()
+    if emulated_stores:
+        R = place_emulated_globals(R, max_regions, emulated_stores)
+    return R
+
+
+def get_function_regions(R):
+    '''
+        Returns {function: the code region it is in}
+    '''
+    function_regions = {}
+    for n, attrs in R.nodes_iter(True):
+        if attrs.get(TYPE_KEY) == CODE_REGION_KEY:
+            for f in attrs.get(OBJECTS_KEY, []):
+                function_regions[f] = n
+    return function_regions
+
+
+def get_region_switches(M, function_regions, switch_counts):
+    '''
+        Sums the recorded switches between each pair of code regions
+        M: region_merge.RegionMerger of the region graph
+        function_regions: get_function_regions of the graph before merging
+        Returns: {(r1, r2): count} with r1 < r2
+    '''
+    switches = collections.defaultdict(int)
+    for (caller, callee), count in switch_counts.items():
+        if not (function_regions.has_key(caller) and
+                function_regions.has_key(callee)):
             continue
-        
-        while len(R.predecessors(c_region)) > MAX_DATA_REGIONS and changed:
-            changed = False
-            
-            (d1, d2,d_cost) = lowest_cost_data_merge(R, c_region)
-            (p1, p2, p_cost) = lowest_cost_peripheral_merge(R,T,c_region)
-            if p_cost == None and d_cost == None:
-                changed = False
-            elif p_cost == None and d_cost!=None:
-                R, changed = merge_data_region(R,d1,d2)
-            elif p_cost != None and d_cost == None:
-                changed = merge_peripheral_regions(R,T,c_region,p1,p2)
-            else:
-                if d_cost < p_cost:
-                    R, changed = merge_data_region(R,d1,d2)
-                    #R, changed = merge_regions(R,d1,d2)
-                else:
-                    changed = merge_peripheral_regions(R,T,c_region,p1,p2)
+        r1 = M.representative(function_regions[caller])
+        r2 = M.representative(function_regions[callee])
+        if r1 is None or r2 is None or r1 == r2:
+            continue
+        switches[(min(r1, r2), max(r1, r2))] += count
+    return switches
 
-            if not changed:
-                print "Unable to make implementable", c_region, R.predecessors(c_region)
-                return R,False
-    return R,True
+
+def count_mpu_regions(R, code_regions):
+    '''
+        Returns the number of data and peripheral regions the code regions
+        would use if merged, peripheral regions for the same MPU region are
+        counted once
+    '''
+    data_regions = set()
+    mpu_regions = set()
+    for c in code_regions:
+        for p in R.predecessors_iter(c):
+            if R.node[p][TYPE_KEY] == DATA_REGION_KEY:
+                data_regions.add(p)
+            elif R.node[p][TYPE_KEY] == PERIPHERAL_REGION_KEY:
+                mpu_regions.add(R.node[p][KEY_MPU_TREE_NAME])
+    return len(data_regions) + len(mpu_regions)
 
 
-def merge_data_region(R,d1,d2):
-    changed = True
-    d1_objs = R.node[d1][OBJECTS_KEY]
-    d1_objs.extend(R.node[d2][OBJECTS_KEY])
-    R = nx.contracted_nodes(R,d1,d2)
-    return R, changed
+def merge_code_regions(R, c1, c2):
+    '''
+        Merges code region c2 into c1, the peripheral regions they had for
+        the same MPU region are combined
+        R: region_merge.RegionMerger of the region graph
+    '''
+    merge_regions(R, c1, c2)
+    mpu_regions = {}
+    for p in sorted(R.predecessors(c1)):
+        attrs = R.node[p]
+        if attrs[TYPE_KEY] != PERIPHERAL_REGION_KEY:
+            continue
+        tree_name = attrs[KEY_MPU_TREE_NAME]
+        if mpu_regions.has_key(tree_name):
+            kept = R.node[mpu_regions[tree_name]]
+            kept[KEY_REQUIRED_PERIPHERALS].update(
+                attrs[KEY_REQUIRED_PERIPHERALS])
+            kept[KEY_REQUIRED_MASK] |= attrs[KEY_REQUIRED_MASK]
+            R.remove_node(p)
+        else:
+            mpu_regions[tree_name] = p
+
+
+def is_privileged(R, code_region):
+    '''
+        Returns True if code_region uses a privileged peripheral, its
+        compartment then runs privileged (see add_compartment_to_comp_desc)
+    '''
+    for p in R.predecessors_iter(code_region):
+        attrs = R.node[p]
+        if attrs[TYPE_KEY] == PERIPHERAL_REGION_KEY and attrs[PRIV_KEY]:
+            return True
+    return False
+
+
+def merge_hot_code_regions(M, max_regions, switch_counts):
+    '''
+        Merges the code regions with the most recorded compartment switches
+        between them, hottest first and then adding the least padding, as
+        long as the merged region uses at most max_regions data and
+        peripheral regions.  Regions of different privilege and the
+        interrupt handlers' region (IRQ_REGION_NAME) are not merged.  The
+        code regions of M must already be within max_regions, so no
+        lowering is needed after.
+        M: region_merge.RegionMerger of the region graph
+        switch_counts: {(caller, callee): count}, see switch_profile
+    '''
+    function_regions = get_function_regions(M)
+    switches = get_region_switches(M, function_regions, switch_counts)
+    total = sum(switches.values())
+    merged = True
+    while merged:
+        # Merging changes the counts between regions, so repeat until no
+        # pair of regions can be merged
+        merged = False
+        pairs = sorted(((count, -get_merge_padding(M, r1, r2), r1, r2)
+                        for ((r1, r2), count) in switches.items()),
+                       reverse=True)
+        for (count, padding, r1, r2) in pairs:
+            r1 = M.representative(r1)
+            r2 = M.representative(r2)
+            if r1 == r2 or IRQ_REGION_NAME in (r1, r2) or \
+                    is_privileged(M, r1) != is_privileged(M, r2) or \
+                    count_mpu_regions(M, (r1, r2)) > max_regions:
+                continue
+            merge_code_regions(M, r1, r2)
+            merged = True
+        if merged:
+            switches = get_region_switches(M, function_regions,
+                                           switch_counts)
+    print "Switches between code regions:", total, "->", \
+          sum(switches.values())
+
+
+def place_emulated_globals(R, max_regions, emulated_stores):
+    '''
+        Gives code regions access to the data regions of the globals they
+        stored to most through the emulator, in the MPU regions they have
+        left.  Stores to the rest stay emulated.
+        R: A lowered region graph, updated in place
+        emulated_stores: [(functions, global, count), ...], see
+                         emulated_stores.py
+    '''
+    function_regions = get_function_regions(R)
+    global_regions = {}
+    for n, attrs in R.nodes_iter(True):
+        if attrs[TYPE_KEY] == DATA_REGION_KEY:
+            for g in attrs.get(OBJECTS_KEY, []):
+                global_regions[g] = n
+
+    # {code region: {data region: count}}, stores to regions the code region
+    # can already access are not emulated anymore
+    candidates = collections.defaultdict(lambda: collections.defaultdict(int))
+    stored = collections.defaultdict(lambda: collections.defaultdict(set))
+    total = 0
+    for (functions, global_name, count) in emulated_stores:
+        d_region = global_regions.get(global_name)
+        if d_region is None:
+            continue
+        c_regions = set(function_regions[f] for f in functions
+                        if function_regions.has_key(f))
+        for c_region in c_regions:
+            if not R.has_edge(d_region, c_region):
+                candidates[c_region][d_region] += count
+                stored[c_region][d_region].add(global_name)
+                total += count
+
+    placed = 0
+    for c_region in sorted(candidates.keys()):
+        free = max_regions - count_mpu_regions(R, (c_region,))
+        # Among regions with as many stores, prefer the one exposing the
+        # fewest globals the code region did not store to
+        counts = []
+        for (d_region, count) in candidates[c_region].items():
+            exposed = len(R.node[d_region].get(OBJECTS_KEY, [])) - \
+                len(stored[c_region][d_region])
+            counts.append((count, -exposed, d_region))
+        counts.sort(reverse=True)
+        for (count, _, d_region) in counts[:max(free, 0)]:
+            R.add_edge(d_region, c_region)
+            placed += count
+    print "Emulated stores moved to MPU regions:", placed, "of", total
+    return R
+
+
+def implement_policy(R, T, max_regions, name, switch_counts=None,
+                     emulated_stores=None):
+    '''
+        Lowers the region graph of a partitioning and returns its compartment
+        description, quits if it cannot be implemented.
+        R: The region graph
+        T: Device Tree describing MPU regions for peripherals
+        max_regions: Data and peripheral regions each code region may use,
+                     or a list of them.  For a list R is lowered to each,
+                     largest first, starting from the lowered graph of the
+                     previous one, and {max_regions: description} is
+                     returned.
+        name: Name of the partitioning, for debug graphs and errors
+        switch_counts: Recorded {(caller, callee): count}, if given code
+                       regions are then merged to remove the most switches
+                       that fit in max_regions, see merge_hot_code_regions
+        emulated_stores: Recorded stores through the emulator, if given the
+                         regions left free hold the most stored globals,
+                         see place_emulated_globals
+        This makes the the graph implementable by reducing the number of data
+        and peripheral dependancies to below the available mpu threashold.
+        See RegionLowering.
+    '''
+    prepare_for_lowering(R)
+    if not isinstance(max_regions, (list, tuple)):
+        R, is_implementable = lower_regions(R, T, max_regions)
+        if is_implementable:
+            R = use_free_regions(R, max_regions, switch_counts,
+                                 emulated_stores)
+        write_debug_graph(R, name + "_merged.dot")
+        if not is_implementable:
+            print "Cannot implement", name
+            quit(-1)
+        return get_compartment_description(R, max_regions)
+
+    descriptions = {}
+    for limit in sorted(set(max_regions), reverse=True):
+        # Lowering only merges regions, so the result for a larger limit is
+        # a valid start for a smaller one
+        R, is_implementable = lower_regions(R, T, limit)
+        placed = R
+        if is_implementable and (switch_counts or emulated_stores):
+            # Hot code regions merged and regions placed to fill this limit
+            # would be kept at the next one, so they are only done on a copy
+            placed = use_free_regions(R.copy(), limit, switch_counts,
+                                      emulated_stores)
+        write_debug_graph(placed, "%s_merged_%i.dot" % (name, limit))
+        if not is_implementable:
+            print "Cannot implement", name, "with", limit, "regions"
+            quit(-1)
+        descriptions[limit] = get_compartment_description(placed, limit)
+    return descriptions
 
 
 def merge_regions(R,d1,d2):
     '''
         Merges Code or Data regions
+        R: region_merge.RegionMerger of the region graph
     '''
     if R.node[d1][TYPE_KEY] != R.node[d2][TYPE_KEY]:
         raise TypeError("Trying to merge nodes of different types")
@@ -212,9 +562,7 @@ def merge_regions(R,d1,d2):
         raise TypeError("Cannot merge peripherals with this method")
 
     changed = True
-    d1_objs = R.node[d1][OBJECTS_KEY]
-    d1_objs.extend(R.node[d2][OBJECTS_KEY])
-    contract_nodes_no_copy(R,d1,d2)
+    R.merge(d1,d2)
     return R, changed
 
 
@@ -242,85 +590,70 @@ def remove_all_non_region_nodes(R):
     return count
 
 
-def merge_peripheral_regions(R,T,code_region,per1,per2):
+def merge_peripheral_regions(R,T,code_region,per1,per2,mpu_parent=None):
     '''
     Merges peripheral by finding the parent node on the path between the
-    nodes
+    nodes, mpu_parent can be given if it is already known
+    Returns: (the merged region, [peripheral regions it replaced]), the
+             merged region is None if they cannot be merged
     '''
     #print "Merging P:",per1,":",per2
-    p1 = look_up_mpu_peripheral(R,T,per1)
-    p2 = look_up_mpu_peripheral(R,T,per2)
+    if mpu_parent is None:
+        p1 = look_up_mpu_peripheral(R,T,per1)
+        p2 = look_up_mpu_peripheral(R,T,per2)
+        mpu_parent = devices.get_nearest_common_ancestor(T,p1,p2)
+    if not mpu_parent:
+        return None, []
 
-    merged = False
-    mpu_parent = devices.get_nearest_common_ancestor(T,p1,p2)
-
-    if mpu_parent:
-        merged = True
-        required_pers = set()
-        required_pers.update(R.node[per1][KEY_REQUIRED_PERIPHERALS])
-        required_pers.update(R.node[per2][KEY_REQUIRED_PERIPHERALS])
-        new_mpu_region,new_attrs = get_mpu_region(T,mpu_parent,code_region,required_pers)
-        R.add_node(new_mpu_region,new_attrs)
-        remove_covered_peripherals(R,T,code_region,new_mpu_region)
-
-    return merged
+    required_pers = set()
+    required_pers.update(R.node[per1][KEY_REQUIRED_PERIPHERALS])
+    required_pers.update(R.node[per2][KEY_REQUIRED_PERIPHERALS])
+    new_mpu_region,new_attrs = get_mpu_region(T,mpu_parent,code_region,required_pers)
+    removed = remove_covered_peripherals(R,T,code_region,new_attrs)
+    R.add_node(new_mpu_region,new_attrs)
+    R.add_edge(new_mpu_region,code_region)
+    return new_mpu_region, removed
 
 
-def remove_covered_peripherals(R,T,code_region,mpu_region):
+def remove_covered_peripherals(R,T,code_region,mpu_attrs):
     '''
-        Removes nodes in R, that are under the added mpu region
+        Removes the peripheral regions of code_region that are under the mpu
+        region described by mpu_attrs, adding the peripherals they require
+        to it.
         This happens when merging two peripherals in the device tree captures
         other peripherals that the code_region also depends on.
+        Returns: The removed regions
     '''
-    mpu_tree_name = R.node[mpu_region][KEY_MPU_TREE_NAME]
-    mpu_attrs = R.node[mpu_region]
-    #covered_pers = devices.get_covered_peripherals(T,mpu_tree_name)
+    mpu_tree_name = mpu_attrs[KEY_MPU_TREE_NAME]
+    removed = []
     for region in R.predecessors(code_region):
         r_attrs = R.node[region]
         if r_attrs[TYPE_KEY] == PERIPHERAL_REGION_KEY:
             other_mpu_region_t_name = r_attrs[KEY_MPU_TREE_NAME]
             if devices.is_child(T,mpu_tree_name, other_mpu_region_t_name):
                 mpu_attrs[KEY_REQUIRED_PERIPHERALS].update(r_attrs[KEY_REQUIRED_PERIPHERALS])
-                R.add_node(mpu_region, mpu_attrs)
-                R.add_edge(mpu_region, code_region)
+                mpu_attrs[KEY_REQUIRED_MASK] |= r_attrs[KEY_REQUIRED_MASK]
                 R.remove_node(region)
+                removed.append(region)
+    return removed
 
 
-def merge_on_attr(G,attr=REGION_KEY):
-    '''
-    Merges all nodes that share the same attribute
-    '''
-
-    node_to_attr = nx.get_node_attributes(G,attr)
-    attr_to_nodelist = {}  # {attr:[nodes,...]}
-    for n, attr in node_to_attr.items():
-        if not attr_to_nodelist.has_key(attr):
-            attr_to_nodelist[attr] = []
-        attr_to_nodelist[attr].append(n)
-
-    M = G.copy()
-    for attr,node_list in attr_to_nodelist.items():
-        root_node =node_list[0]
-        for n in node_list[1:]:
-            M = nx.contracted_nodes(M,root_node,n,False)
-    return M
-
-
-def get_mpu_config(compartments):
+def get_mpu_config(compartments, max_regions):
     mpu_config = {}
     for key in compartments.keys():
-        attrs = [100794405,319160355,100794387,0]+[0]*MAX_DATA_REGIONS
-        addrs = [134217744,536870929,134742034,0]+[0]*MAX_DATA_REGIONS
+        attrs = [100794405,319160355,100794387,0]+[0]*max_regions
+        addrs = [134217744,536870929,134742034,0]+[0]*max_regions
         mpu_config[key]={"Attrs":attrs,"Addrs":addrs}
     return mpu_config
 
 
-def get_compartment_description(R):
+def get_compartment_description(R, max_regions=DEFAULT_MAX_DATA_REGIONS):
     '''
         This gets the compartment description which is given to 
         LLVM to apply during compilation
         Input:
             R(region graph): 
+            max_regions(int):  The limit R was lowered to
         Returns:
             description(dict):  A dictionary that is dumped to a
                                 json file that describes the compartments
@@ -332,7 +665,7 @@ def get_compartment_description(R):
     description = {POLICY_KEY_REGIONS:{},
               POLICY_KEY_COMPARTMENTS:{},
               POLICY_KEY_MPU_CONFIG:{},
-              POLICY_NUM_MPU_REGIONS:NUM_DEFAULT_MPU_REGIONS + MAX_DATA_REGIONS}
+              POLICY_NUM_MPU_REGIONS:NUM_DEFAULT_MPU_REGIONS + max_regions}
 
     for node,attrs in R.nodes(True):
         if attrs[TYPE_KEY] in [CODE_REGION_KEY,DATA_REGION_KEY]:
@@ -340,20 +673,21 @@ def get_compartment_description(R):
         if attrs[TYPE_KEY] == CODE_REGION_KEY:
             add_compartment_to_comp_desc(R,node,description)
 
-    mpu_config = get_mpu_config(description[POLICY_KEY_COMPARTMENTS])
-    add_default_mpu_config(mpu_config)
+    mpu_config = get_mpu_config(description[POLICY_KEY_COMPARTMENTS],
+                                max_regions)
+    add_default_mpu_config(mpu_config, max_regions)
     description[POLICY_KEY_MPU_CONFIG] = mpu_config
 
     return description
 
 
-def add_default_mpu_config(mpu_config):
+def add_default_mpu_config(mpu_config, max_regions):
     '''
         Default MPU configuration, mostly place holders as
     '''
     default_conf ={
-      "Attrs":[100794405,319160355,319094807,319094807].extend([0] * MAX_DATA_REGIONS),
-      "Addrs":[134217744,536870929,3758153746,3758153747].extend([0] * MAX_DATA_REGIONS)
+      "Attrs":[100794405,319160355,319094807,319094807].extend([0] * max_regions),
+      "Addrs":[134217744,536870929,3758153746,3758153747].extend([0] * max_regions)
     }
     mpu_config["__hexbox_default"] = default_conf
 
@@ -405,110 +739,256 @@ def add_region_node(R,name,r_type,r_id=0,objects=None,attrs=None,merge=None,name
     R.add_node(name,region_attrs)
 
 
-def make_peripheral_regions(R,T):
+def make_peripheral_regions(R,P,T,regions,region_of):
     '''
         R : Region Graph
+        P : PDG (pdg.CompactPDG)
         T : Peripheral Tree, maps peripherals to mpu regions
+        regions, region_of: Names of the regions in R, and index in regions
+                            of the region of each node in P (pdg.MISSING if
+                            the node is in no region)
         Converts all peripherals to mpu_regions on the peripheral tree,
         each peripheral is mapped to a unique mpu_region per code region.
         IE mpu_region is not shared between code regions
     '''
-    for node, attrs in R.nodes(True):
-        if attrs[TYPE_KEY] == PERIPHERAL_NODE_TYPE:
-            periph = node
-            for code_region in R.successors(periph):
-                r_type = PERIPHERAL_REGION_KEY
-                per_tree_name = attrs[NAME_KEY]
-                mpu_tree_name = T.predecessors(per_tree_name)[0]
-                mpu_name,mpu_attrs = get_mpu_region(T,mpu_tree_name,
-                                                    code_region,[per_tree_name])
+    for periph in P.nodes_of_type(PERIPHERAL_NODE_TYPE):
+        per_tree_name = P.get_attr(periph, NAME_KEY)
+        if per_tree_name is None:
+            print "WARNING: Peripheral not remapped", P.names[periph]
+            continue
+        mpu_tree_name = T.predecessors(per_tree_name)[0]
+        for code_node in P.successors(periph):
+            mpu_name,mpu_attrs = get_mpu_region(T,mpu_tree_name,
+                                                P.names[code_node],
+                                                [per_tree_name])
+            if R.has_node(mpu_name):
+                R.node[mpu_name][KEY_REQUIRED_PERIPHERALS].add(per_tree_name)
+                R.node[mpu_name][KEY_REQUIRED_MASK] |= \
+                    mpu_attrs[KEY_REQUIRED_MASK]
+            else:
                 R.add_node(mpu_name,mpu_attrs)
-                R.add_edge(mpu_name,code_region)
-            R.remove_node(periph)
+            if region_of[code_node] != pdg.MISSING:
+                R.add_edge(mpu_name,regions[region_of[code_node]])
 
 
-def get_mpu_region(T,tree_node,code_region,required_pers):
+def add_region_edges(R,P,regions,region_of):
+    '''
+        Adds an edge between the regions of the two ends of each edge in P,
+        edges within a region and of nodes in no region are dropped
+    '''
+    src = region_of[P.edge_src]
+    dst = region_of[P.edge_dst]
+    valid = (src != pdg.MISSING) & (dst != pdg.MISSING) & (src != dst)
+    keys = numpy.unique(src[valid] * len(regions) + dst[valid])
+    R.add_edges_from((regions[k // len(regions)], regions[k % len(regions)])
+                     for k in keys)
+
+
+def add_pdg_dependencies(R,P,T,region_nodes):
+    '''
+        Adds the dependencies between the regions of R from the PDG
+        R : Region Graph
+        P : PDG (pdg.CompactPDG)
+        T : Peripheral Tree
+        region_nodes : [(region, [PDG nodes in the region]), ...]
+        Nodes of P that are not Functions, Globals, or Peripherals, and not
+        in a region, are copied to R.  Other nodes in no region are dropped.
+        Each region's SIZE_KEY is the total Size of its nodes.
+    '''
+    regions = []
+    region_of = numpy.full(len(P), pdg.MISSING, dtype=numpy.int64)
+    for (region, nodes) in region_nodes:
+        ids = [P.ids[n] for n in nodes]
+        region_of[ids] = len(regions)
+        regions.append(region)
+        R.node[region][SIZE_KEY] = pdg.get_region_size(P, ids)
+
+    pdg_types = [P.strings.get_id(t) for t in pdg.PDG_NODE_TYPES]
+    for n in numpy.flatnonzero((region_of == pdg.MISSING) &
+                               ~numpy.in1d(P.node_type, pdg_types)):
+        R.add_node(P.names[n],P.attrs(n))
+        region_of[n] = len(regions)
+        regions.append(P.names[n])
+
+    make_peripheral_regions(R,P,T,regions,region_of)
+    add_region_edges(R,P,regions,region_of)
 
-    mpu_attrs = T.node[tree_node]
-    if not mpu_attrs.has_key(KEY_REQUIRED_PERIPHERALS):
-        mpu_attrs[KEY_REQUIRED_PERIPHERALS] = set()
-    mpu_attrs[KEY_REQUIRED_PERIPHERALS].update(required_pers)
+
+def get_mpu_region(T,tree_node,code_region,required_pers):
+    '''
+        Returns the name and attributes of the peripheral region of
+        code_region for the MPU region tree_node.  The attributes are a copy,
+        so regions of different code regions do not share them.
+    '''
+    mpu_attrs = dict(T.node[tree_node])
+    mpu_attrs[KEY_REQUIRED_PERIPHERALS] = set(required_pers)
+    mpu_attrs[KEY_REQUIRED_MASK] = devices.get_peripheral_mask(T,
+                                                               required_pers)
     mpu_attrs[KEY_MPU_TREE_NAME] = tree_node
     mpu_name = tree_node+"_"+code_region
     return mpu_name, mpu_attrs
 
 
-def optimize_filename_groupings(G,filename_to_code_nodes):
+def optimize_filename_groupings(P,filename_to_code_nodes,max_sweeps=1):
     '''
+        Moves each function to the filename group its edges to other
+        functions weigh the most in, see pdg.CompactPDG.edge_weights.  It
+        stays in its own group on a tie.  All
+        functions are moved at once, and this is repeated until none move or
+        max_sweeps times.
         Inputs:
-            move -  boolean to determine if relocations actually happen
+            P:  PDG (pdg.CompactPDG)
+            filename_to_code_nodes: {filename: [functions]}, updated in place
+            max_sweeps: Most times to move the functions
     '''
-    node_to_filenames = nx.get_node_attributes(G,FILENAME_TYPE)
-    for n,attrs in G.nodes(True):
-        if attrs[TYPE_KEY] != FUNCTION_TYPE or \
-            not node_to_filenames.has_key(n):
-            continue
-        filename = node_to_filenames[n]
-        new_filename = filename
-        max_connect = 0
-        neighbors = set(nx.all_neighbors(G,n))
-        for fname, comp in filename_to_code_nodes.items():
-            comp_set = set(comp)
-            con = len(neighbors.intersection(comp_set))
-            if (con > max_connect):
-                new_filename = fname
-        filename_to_code_nodes[filename].remove(n)
-        filename_to_code_nodes[new_filename].append(n)
-        if len(filename_to_code_nodes[filename]) == 0:
-            filename_to_code_nodes.pop(filename,None)
-
-
-def get_peripheral_nodes(G):
-    p = filter(lambda (n, d): d['Type'] == PERIPHERAL_NODE_TYPE, G.nodes(data=True))
-    return p
+    groups = sorted(filename_to_code_nodes.keys())
+    group_of = numpy.full(len(P), pdg.MISSING, dtype=numpy.int64)
+    for g, filename in enumerate(groups):
+        group_of[[P.ids[n] for n in filename_to_code_nodes[filename]]] = g
+
+    # Each pair of neighboring grouped functions once, in both directions,
+    # with the weight of the edges between them
+    src = P.edge_src
+    dst = P.edge_dst
+    valid = (group_of[src] != pdg.MISSING) & \
+            (group_of[dst] != pdg.MISSING) & (src != dst)
+    pairs, inverse = numpy.unique(
+        numpy.minimum(src[valid], dst[valid]) * len(P) +
+        numpy.maximum(src[valid], dst[valid]), return_inverse=True)
+    pair_weights = numpy.bincount(inverse, weights=P.edge_weights()[valid],
+                                  minlength=len(pairs))
+    nodes = numpy.concatenate((pairs // len(P), pairs % len(P)))
+    neighbors = numpy.concatenate((pairs % len(P), pairs // len(P)))
+    weights = numpy.concatenate((pair_weights, pair_weights))
+
+    num_groups = len(groups)
+    total_moved = 0
+    for sweep in xrange(max_sweeps):
+        # Weight of the edges of each function to each group
+        keys, inverse = numpy.unique(nodes * num_groups + group_of[neighbors],
+                                     return_inverse=True)
+        counts = numpy.bincount(inverse, weights=weights,
+                                minlength=len(keys))
+        node = keys // num_groups
+        group = keys % num_groups
+        # Per function, most neighbors first then its own group
+        other = group != group_of[node]
+        order = numpy.lexsort((group, other, -counts, node))
+        first = numpy.ones(len(order), dtype=bool)
+        first[1:] = node[order[1:]] != node[order[:-1]]
+        best = order[first]
+        moved = numpy.count_nonzero(group_of[node[best]] != group[best])
+        group_of[node[best]] = group[best]
+        total_moved += moved
+        if moved == 0:
+            break
+    print "Moved", total_moved, "functions to the file they use most"
+
+    filename_to_code_nodes.clear()
+    for i in numpy.flatnonzero(group_of != pdg.MISSING):
+        filename_to_code_nodes.setdefault(groups[group_of[i]],
+                                          []).append(P.names[i])
 
 
 def make_region_graph(G,T):
-    R = G.copy()
-    make_peripheral_regions(R,T)
-    contract_nodes =[]
+    '''
+        Makes a region graph with a region for each function and global
+        G can be a networkx PDG or a pdg.CompactPDG
+    '''
+    P = pdg.as_compact(G)
+    R = nx.DiGraph()
+    region_nodes = []
     type2count = collections.defaultdict(int)
-    for n, attrs in G.nodes(True):
-        ty = attrs[TYPE_KEY]
+    for i in xrange(len(P)):
+        n = P.names[i]
+        ty = P.get_attr(i,TYPE_KEY)
         if ty == FUNCTION_TYPE:
             reg_id = type2count[CODE_REGION_KEY]
             type2count[CODE_REGION_KEY] += 1
             reg_name = CODE_REGION_KEY +'%i_' % reg_id
             reg_ty = CODE_REGION_KEY
             add_region_node(R,reg_name,reg_ty,reg_id,[n])
-            contract_nodes.append( (reg_name, n) )
+            region_nodes.append( (reg_name, [n]) )
         elif ty == GLOBAL_TYPE:
             reg_ty = DATA_REGION_KEY
             reg_id = type2count[DATA_REGION_KEY]
             type2count[DATA_REGION_KEY] += 1
             reg_name = DATA_REGION_KEY +'%i_' % reg_id
             add_region_node(R,reg_name,reg_ty,reg_id,[n])
-            contract_nodes.append( (reg_name,n) )
-    for (u,v) in contract_nodes:
-        contract_nodes_no_copy(R,u,v)
+            region_nodes.append( (reg_name, [n]) )
+    add_pdg_dependencies(R,P,T,region_nodes)
     return R
 
 
-def partition_by_peripheral(G,T):
+def partition_by_peripheral(G,T,max_regions=DEFAULT_MAX_DATA_REGIONS,
+                            switch_counts=None,emulated_stores=None,
+                            weight_calls=False):
     '''
         Forms initial set of compartments by peripheral.
+        max_regions, emulated_stores: see implement_policy
+        switch_counts: Recorded {(caller, callee): count}, see
+                       partition_by_profile
+        weight_calls:  Without switch_counts, weigh the calls statically
+                       (see get_call_weights) to pick between several
+                       regions a code region could join
     '''
-    R = make_region_graph(G,T)
+    P = pdg.as_compact(G)
+    R = make_region_graph(P,T)
+    merge_weights = switch_counts
+    if not switch_counts and weight_calls:
+        merge_weights = get_call_weights(P)
+    M = region_merge.RegionMerger(R)
     print "Partitioning by Peripheral"
-    worklist = collections.deque()
-    for n, attrs in R.nodes(True):
-        print n, attrs
+    merge_peripheral_neighbors(M, merge_weights)
+
+    if DEBUG_DIR is not None:
+        write_debug_graph(M.apply(),"by_peripheral_before-final.dot")
+    # Merge all areas not dependent on a peripheral
+    no_peripheral_regions = []
+    for n, attrs in M.nodes(True):
+        if attrs[TYPE_KEY] == CODE_REGION_KEY:
+            has_peripheral = False
+            for s in M.predecessors(n):
+                if M.node[s][TYPE_KEY] == PERIPHERAL_REGION_KEY:
+                    has_peripheral = True
+                    break;
+            if not has_peripheral:
+                no_peripheral_regions.append(n)
+    if len(no_peripheral_regions) > 1:
+        code_region = no_peripheral_regions[0]
+        for n in no_peripheral_regions[1:]:
+            merge_regions(M,code_region,n)
+
+    R = M.apply()
+    write_debug_graph(R,"by_peripheral_before_lowering.dot")
+    return implement_policy(R,T,max_regions,"by_peripheral",switch_counts,
+                            emulated_stores)
+
+
+def merge_peripheral_neighbors(M, merge_weights=None):
+    '''
+        Merges the code regions that depend on a peripheral with their
+        neighboring code regions that depend on the same peripherals or on
+        none, in rounds until no more merges are possible.  A region that
+        could join several neighbors is left alone, unless merge_weights
+        is given, then it joins the one it has the most weight with.
+        M: region_merge.RegionMerger of the region graph
+        merge_weights: {(caller, callee): count} or None
+    '''
+    function_regions = get_function_regions(M)
+    worklist = set()
+    for n, attrs in M.nodes_iter(True):
         if attrs[TYPE_KEY]  == PERIPHERAL_REGION_KEY:
-            print "Found Peripheral"
-            for p in R.successors(n):
-                if not p in worklist:
-                    print "Adding Predecessor"
-                    worklist.append(p)
+            worklist.update(M.successors(n))
+
+    # Peripherals each code region depends on, only code regions are
+    # merged below so a merged region's are the union of its parts'
+    dependent_peripherals = {}
+    def get_signature(n):
+        if not dependent_peripherals.has_key(n):
+            dependent_peripherals[n] = \
+                frozenset(get_dependent_peripherals(M, n))
+        return dependent_peripherals[n]
 
     # Add all neighboring code regions that are only adjacent to only a
     # single region dependent on a peripheral region
@@ -516,60 +996,92 @@ def partition_by_peripheral(G,T):
     round_num = 0
     while updated:
         updated = False
-        print "Round Number", round_num
+        print "Round Number", round_num, "Worklist", len(worklist)
         round_num += 1
         potential_merges = collections.defaultdict(set)
         for code_region in worklist:
-
-            dep_per = get_dependent_peripherals(R, code_region)
-            all_neighbors = R.predecessors(code_region)
-            all_neighbors.extend(R.successors(code_region))
-            for n in all_neighbors:
-                if n == code_region:
-                    continue
-                if R.node[n][TYPE_KEY] == CODE_REGION_KEY:
-                    n_dep_per = get_dependent_peripherals(R, n)
+            if not M.has_node(code_region):
+                continue  # Merged into another region
+            dep_per = get_signature(code_region)
+            for n in itertools.chain(M.predecessors_iter(code_region),
+                                     M.successors_iter(code_region)):
+                if M.node[n][TYPE_KEY] == CODE_REGION_KEY:
+                    n_dep_per = get_signature(n)
                     if dep_per == n_dep_per or len(n_dep_per)== 0:
-                        print 'Potential Merges: ', code_region, " ", n
                         potential_merges[n].add(code_region)
 
-        # Merge code regions which only have one potential merge code region
-        worklist = collections.deque()
-        for key, merges in potential_merges.items():
-            if len(merges) == 1:
+        # Merge code regions which only have one potential merge code region,
+        # or one they switch with most, in name order so the result does not
+        # depend on set ordering
+        switches = None
+        if merge_weights:
+            switches = get_region_switches(M, function_regions,
+                                           merge_weights)
+        worklist = set()
+        for key, merges in sorted(potential_merges.items()):
+            region = pick_merge(key, merges, switches)
+            if region is not None:
                 updated = True
-                region = merges.pop()
-                if key in R.nodes() and region in R.nodes():
-                    merge_regions(R, region, key)
-                    worklist.append(region)
-                    if key in worklist:
-                        worklist.remove(key)
-
-    nx.drawing.nx_pydot.write_dot(R,"by_peripheral_before-final.dot")
-    # Merge all areas not dependent on a peripheral
-    no_peripheral_regions = []
-    for n, attrs in R.nodes(True):
-        if attrs[TYPE_KEY] == CODE_REGION_KEY:
-            has_peripheral = False
-            for s in R.predecessors(n):
-                if R.node[s][TYPE_KEY] == PERIPHERAL_REGION_KEY:
-                    has_peripheral = True
-                    break;
-            if not has_peripheral:
-                no_peripheral_regions.append(n)
-    if len(no_peripheral_regions) > 1:
-        code_region = no_peripheral_regions[0]
-        for n in no_peripheral_regions[1:]:
-            merge_regions(R,code_region,n)
+                if M.has_node(key) and M.has_node(region):
+                    merge_regions(M, region, key)
+                    dependent_peripherals[region] = \
+                        get_signature(region) | get_signature(key)
+                    del dependent_peripherals[key]
+                    worklist.add(region)
+                    worklist.discard(key)
+    return M
 
-    nx.drawing.nx_pydot.write_dot(R,"by_peripheral_before_lowering.dot")
-    R, is_implementable = make_implementable(R,T)
-    nx.drawing.nx_pydot.write_dot(R,"by_peripheral_merged.dot")
-    if is_implementable:
-        return get_compartment_description(R)
-    else:
-        print "Cannot implement when grouping by peripheral"
-        quit(-1)
+
+def get_call_weights(P):
+    '''
+        Returns {(caller, callee): weight} of the calls between functions in
+        P (pdg.CompactPDG), see pdg.CompactPDG.edge_weights
+    '''
+    call_types = [P.strings.get_id(t) for t in pdg.CALL_EDGE_TYPES]
+    is_funct = P.node_type == P.strings.get_id(FUNCTION_TYPE)
+    calls = numpy.flatnonzero(numpy.in1d(P.edge_type, call_types) &
+                              is_funct[P.edge_src] & is_funct[P.edge_dst] &
+                              (P.edge_src != P.edge_dst))
+    weights = P.edge_weights()
+    call_weights = collections.defaultdict(float)
+    for e in calls:
+        call_weights[(P.names[P.edge_src[e]], P.names[P.edge_dst[e]])] += \
+            weights[e]
+    return call_weights
+
+
+def pick_merge(key, merges, switches):
+    '''
+        Returns the code region of merges to merge key with: the only one,
+        or the one key has the most switches (or weighted calls) with if
+        there is one.  None if there is no such region.
+        switches: {(r1, r2): count} with r1 < r2, see get_region_switches.
+                  None to only merge with the only one
+    '''
+    if len(merges) == 1:
+        return next(iter(merges))
+    if switches is None:
+        return None
+    counts = sorted((switches.get((min(key, r), max(key, r)), 0), r)
+                    for r in merges)
+    if counts[-1][0] > 0 and counts[-2][0] < counts[-1][0]:
+        return counts[-1][1]
+    return None
+
+
+def partition_by_profile(G,T,max_regions=DEFAULT_MAX_DATA_REGIONS,
+                         switch_counts=None,emulated_stores=None):
+    '''
+        partition_by_peripheral guided by recorded compartment switches.
+        When a code region can join more than one neighbor it joins the one
+        it switches with most, and after lowering the code regions with the
+        most switches between them are merged while the MPU regions allow.
+        switch_counts: {(caller, callee): count}, see switch_profile
+    '''
+    if not switch_counts:
+        raise ValueError("Profile guided partitioning needs switch counts")
+    return partition_by_peripheral(G,T,max_regions,switch_counts,
+                                   emulated_stores)
 
 
 def get_dependent_peripherals(R, n):
@@ -581,16 +1093,25 @@ def get_dependent_peripherals(R, n):
 
 
 
-def partition_by_filename_no_optimization(G,T):
-    return partition_by_filename(G,T,False)
+def partition_by_filename_no_optimization(G,T,
+                                          max_regions=DEFAULT_MAX_DATA_REGIONS,
+                                          emulated_stores=None):
+    return partition_by_filename(G,T,max_regions,opt=False,
+                                 emulated_stores=emulated_stores)
 
-def partition_by_filename(G,T,opt=True):
+def partition_by_filename(G,T,max_regions=DEFAULT_MAX_DATA_REGIONS,opt=True,
+                          emulated_stores=None):
     '''
         Puts all functions from same file in the same region
         Inputs:
-            G(PDG):  The program dependency graph
+            G(PDG):  The program dependency graph, networkx or
+                     pdg.CompactPDG
             T(nx.Digraph):  The device description of peripherals as Tree
+            max_regions:    Data and peripheral regions per code region, see
+                            implement_policy
             opt(bool):      Apply optimizations if True
+            emulated_stores:  Recorded emulated stores, see
+                              implement_policy
         Returns:
             (dict):     A compartment description that is given to LLVM
                         as a json file
@@ -600,195 +1121,156 @@ def partition_by_filename(G,T,opt=True):
     filename_to_data_nodes = collections.defaultdict(list)
 
     print "Merging By filename, Opt: ", opt
-    Region_Graph = G.copy()
-    for (node,attrs) in Region_Graph.nodes(True):
-        if attrs.has_key(FILENAME_TYPE):
-            filename = attrs[FILENAME_TYPE]
-            if attrs[TYPE_KEY] == FUNCTION_TYPE:
-                filename_to_code_nodes[filename].append(node)
-            elif attrs[TYPE_KEY] == GLOBAL_TYPE:
-                filename_to_data_nodes[filename].append(node)
+    P = pdg.as_compact(G)
+    for node in xrange(len(P)):
+        filename = P.get_attr(node,FILENAME_TYPE)
+        if filename is not None:
+            ty = P.get_attr(node,TYPE_KEY)
+            if ty == FUNCTION_TYPE:
+                filename_to_code_nodes[filename].append(P.names[node])
+            elif ty == GLOBAL_TYPE:
+                filename_to_data_nodes[filename].append(P.names[node])
 
     if opt:
-        optimize_filename_groupings(G,filename_to_code_nodes)
+        optimize_filename_groupings(P,filename_to_code_nodes)
 
-    make_peripheral_regions(Region_Graph,T)
-    Region_Graph = build_regions_from_dict(Region_Graph,filename_to_code_nodes,CODE_REGION_KEY)
-    Region_Graph = build_regions_from_dict(Region_Graph,filename_to_data_nodes,DATA_REGION_KEY)
+    Region_Graph = nx.DiGraph()
+    region_nodes = build_regions_from_dict(Region_Graph,filename_to_code_nodes,CODE_REGION_KEY)
+    region_nodes.extend(build_regions_from_dict(Region_Graph,filename_to_data_nodes,DATA_REGION_KEY))
+    add_pdg_dependencies(Region_Graph,P,T,region_nodes)
 
-    Region_Graph, is_implementable = make_implementable(Region_Graph,T)
-    nx.drawing.nx_pydot.write_dot(Region_Graph,"by_filename_code_merged.dot")
-    if is_implementable:
-        return get_compartment_description(Region_Graph)
-    else:
-        print "Cannot implement when grouping by filename"
-        quit(-1)
+    return implement_policy(Region_Graph,T,max_regions,"by_filename_code",
+                            emulated_stores=emulated_stores)
 
 
-def contract_nodes_no_copy(G,keep_node,node):
+def build_regions_from_dict(R,region_dict,r_type,r_id=0):
     '''
-    same as nx.contract_nodes except doesn't copy the graph instead modifies.
-    It contracts the nodes, by moving all edges
-    of node, to keep_node, and then removing node
-
+        Adds a region to R for each list of nodes in region_dict
+        Returns: [(region, nodes), ...] for add_pdg_dependencies
     '''
-    for p in G.predecessors(node):
-        G.add_edge(p,keep_node)
-    for s in G.successors(node):
-        G.add_edge(keep_node,s)
-    G.remove_node(node)
-
-
-def build_regions_from_dict(R,region_dict,r_type,r_id=0):
+    region_nodes = []
     for key, nodes in region_dict.items():
         region_name = r_type + str(r_id)+"_" 
         r_id += 1
         add_region_node(R,region_name,r_type,r_id,nodes,merge=key)
-        for node in nodes:
-            contract_nodes_no_copy(R,region_name,node)
-            if R.has_node(node):
-                R.remove_node(node)
-                print "Removed: ", node
-    return R
+        region_nodes.append((region_name,nodes))
+    return region_nodes
 
 
-def add_nodes(G,json_data,node_types):
-    for node_name,node in json_data.items():
-        if node_name.startswith("llvm"):
-            continue
-        node_ty = node["Attr"]["Type"]
-        if not node_ty in node_types:
-            continue
-        attrs = {}
-        #print node_name
-        attrs.update(node["Attr"])
-        attrs.update(NODE_TYPE_ATTRS[node_ty])
-        G.add_node(node_name,attrs)
+def build_graph(dependancy_json):
+    '''
+        Reads in the program dependancy graph from json file produced by the analysis
+        pass of the compiler.  Then builds a networkx graph of Globals and
+        functions
+    '''
+    nodes, edges = pdg_loader.read_pdg(dependancy_json,
+                                       pdg.PDG_NODE_TYPES,
+                                       pdg.PDG_EDGE_TYPES)
+    PDG = nx.DiGraph()
+    for (node_name, attrs) in nodes:
+        PDG.add_node(node_name,attrs)
+    for (node_name, dest_name, attrs) in edges:
+        if PDG.has_node(dest_name):
+            PDG.add_edge(node_name, dest_name, attr_dict=attrs)
+    return PDG
 
 
-def make_isr_comp(G):
-    irq_region_name = IRQ_REGION_NAME
-    irq_list = []
-    for node, attrs in G.nodes(True):
-        if attrs[TYPE_KEY] == FUNCTION_TYPE and node in devices.INTERRUPT_HANDLERS:
-            irq_list.append(node)
-    irq_attrs = {TYPE_KEY:CODE_REGION_KEY, OBJECTS_KEY:irq_list}
-    G.add_node(irq_region_name,irq_attrs)
-    for n in irq_list:
-        contract_nodes_no_copy(G,irq_region_name,n)
+METHOD_PATTERN = '{method}'
+MPU_PATTERN = '{mpu}'
 
 
-def add_edges(G,json_data,edge_types):
+def policy_path(path, method, num_mpu_regions):
     '''
-        Reads in edges from json data to PDG
-        Inputs:
-            G(nx.DiGraph):  PDG graph
-            json_data(dict):      Dependencies found from LLVM analysis
-            edge_type(list):    List of edge types to add to PDG
+        Returns path with {method} and {mpu} replaced by the partitioning
+        method and number of MPU regions
     '''
-    for node_name,node in json_data.items():
-        if node_name.startswith("llvm"):
-            continue
-        if not node.has_key("Connections"):
-            continue
-        if not G.has_node(node_name):
-            continue
-        #print node_name
-        for dest_name, con_info in node["Connections"].items():
-            if not G.has_node(dest_name):
-                continue
-            if dest_name.startswith("llvm"):
-                continue
-            con_ty = con_info[TYPE_KEY]
-            if not con_ty in edge_types:
-                continue
-            attr_dict = {}
-            attr_dict.update(con_info)
-            attr_dict.update(EDGE_TYPE_ATTRS[con_ty])
-            G.add_edge(node_name, dest_name, attr_dict=attr_dict)
-
-
-def add_size_info(G,json_size_file):
-    with open(json_size_file) as infile:
-        data = json.load(infile)
-        properties = {}
-        for node_name,props in data.items():
-            for key,value in props.items():
-                if not properties.has_key(key):
-                    properties[key] = {}
-                properties[key][node_name] = value
-        for p, nodes in properties.items():
-            nx.set_node_attributes(G,p,nodes)
-
-
-def remap_peripherals(G, device_desc):
-    '''
-      G: Dependancy Graph
-      Device_desc: Description of peripherals on devices
-
-      Takes constant address access output by compiler which is a heuristic of
-      the peripherals accessed and identifies smallest MPU region that will 
-      cover it from device description
-    '''
-    remove_nodes = []
-    successors = {}
-    predecessors = {}
-    for (n, attrs) in G.nodes(True):
-        if attrs[TYPE_KEY] == PERIPHERAL_NODE_TYPE:
-            base_addr = attrs["Addr"]
-            if base_addr == 0xFFFFFFFF:
-                remove_nodes.append(n)
-                continue
-            size = attrs["DataSize"]
-            new_node = devices.get_peripheral_dict(device_desc, base_addr, size)
-
-            if new_node:
-                node_name = ".periph."+new_node[NAME_KEY]
-                #print "Adding Pnode", node_name, new_node
-                G.add_node(node_name,new_node)
-                if not successors.has_key(node_name):
-                    successors[node_name]=[]
-                if not predecessors.has_key(node_name):
-                    predecessors[node_name]=[]
-                successors[node_name].extend(G.successors(n))
-                predecessors[node_name].extend(G.predecessors(n))
-                remove_nodes.append(n)
-            else:
-                print "Failed to Remap", n, ": ", attrs
+    if path is None:
+        return None
+    path = path.replace(METHOD_PATTERN, method)
+    return path.replace(MPU_PATTERN, str(num_mpu_regions))
 
-    G.remove_nodes_from(remove_nodes)
-    for node, successor_list in successors.items():
-        for successor in successor_list:
-            G.add_edge(node, successor)
 
-    for node, predecessor_list in predecessors.items():
-        for predecessor in predecessor_list:
-            G.add_edge(predecessor, node)
+def write_policy(comp_def, outfile, linker_template=None, linker_output=None):
+    '''
+        Writes the policy to outfile and the linker script to linker_output
+        if a template is given
+    '''
+    with open(outfile,'wb') as out:
+        json.dump(comp_def, out, sort_keys=True,
+                  indent=4, separators=(',', ': '))
 
+    if linker_template and linker_output:
+        ld_helpers.make_linker_script(linker_template,
+                                      linker_output,
+                                      comp_def)
 
-def build_graph(dependancy_json):
+
+def run_partition(partition, G, T, method, num_mpu_regions, outfile,
+                  linker_template=None, linker_output=None):
     '''
-        Reads in the program dependancy graph from json file produced by the analysis
-        pass of the compiler.  Then builds a networkx graph of Globals and
-        functions
+        Partitions G with partition for each of num_mpu_regions and writes
+        the policies, see policy_path for the file names.  With more than
+        one count they are lowered in one sweep, see implement_policy.
     '''
-    with open(dependancy_json, 'rb') as infile:
-        json_data = json.load(infile)
-    PDG = nx.DiGraph()
-    add_nodes(PDG,json_data,['Function','Global', PERIPHERAL_NODE_TYPE])
-    add_edges(PDG,json_data,['Callee','Indirect Call','Data','Alias',PERIPHERAL_EDGE_TYPE])
-    return PDG
+    limits = [n - NUM_DEFAULT_MPU_REGIONS for n in num_mpu_regions]
+    if len(limits) == 1:
+        comp_defs = {limits[0]: partition(G,T,limits[0])}
+    else:
+        comp_defs = partition(G,T,limits)
+
+    for n in num_mpu_regions:
+        write_policy(comp_defs[n - NUM_DEFAULT_MPU_REGIONS],
+                     policy_path(outfile, method, n), linker_template,
+                     policy_path(linker_output, method, n))
+
+
+def partition_worker(debug_dir, *args):
+    '''
+        Runs run_partition in a worker process, which has its own debug
+        directory
+    '''
+    global DEBUG_DIR
+    DEBUG_DIR = debug_dir
+    run_partition(*args)
+
+
+def run_partitions(jobs):
+    '''
+        Runs each job in a forked worker process, so they share the PDG
+        already built
+        jobs:  [(name, debug_dir, run_partition arguments), ...]
+        Returns: The names of the jobs that failed
+    '''
+    workers = []
+    for (name, debug_dir, args) in jobs:
+        worker = multiprocessing.Process(target=partition_worker, name=name,
+                                         args=(debug_dir,) + tuple(args))
+        worker.start()
+        workers.append(worker)
+    failed = []
+    for worker in workers:
+        worker.join()
+        if worker.exitcode != 0:
+            failed.append(worker.name)
+    return failed
 
 
 if __name__ == '__main__':
     PARTITION_METHODS = {"filename":partition_by_filename,
                          'peripheral':partition_by_peripheral,
-                         "filename-no-opt":partition_by_filename_no_optimization}
+                         "filename-no-opt":partition_by_filename_no_optimization,
+                         "peripheral-weighted":functools.partial(
+                             partition_by_peripheral, weight_calls=True),
+                         "profile":partition_by_profile}
     import argparse
     parser = argparse.ArgumentParser()
     parser.add_argument('-j','--json_graph',dest='json_graph',required=True,
                     help='Json file describing the Nodes of a graph from llvm')
-    parser.add_argument('-s','--size',dest='size_file', help='JSON Size File')
+    parser.add_argument('-s','--size',dest='size_file',
+                        help=('JSON Size File, {function: {"Size": bytes}}, '
+                              'merges are chosen to add the least padding '
+                              'to power of 2 regions')
+                        )
     parser.add_argument('-o','--output',dest='outfile',
                         help='JSON file with layout of program, and\
                         allowed transitions of the program')
@@ -797,39 +1279,128 @@ if __name__ == '__main__':
     parser.add_argument('-L','--linker_output',dest='linker_output',
                         help='Output Linker Script, required with -T')
     parser.add_argument('-m','--method',dest='partion_method',
-                        help=('Method for partitionin, valid options: '+str(PARTITION_METHODS.keys()))
+                        help=('Method for partitionin, valid options: '+str(PARTITION_METHODS.keys())+
+                              ', several can be given separated by commas, '
+                              'then -o and -L must contain '+METHOD_PATTERN)
                         )
     parser.add_argument('-b','--board',dest='board',
                         help=('Target Board, valid options: '+str(devices.DEVICE_DEFS.keys())),
                         required = True
                         )
     parser.add_argument('-n','--num_mpu_regions',dest='num_mpu_regions',
-                        help=('Number of MPU regions on target'),
-                        default=8, type=int
+                        help=('Number of MPU regions on target, several '
+                              'can be given separated by commas, then -o '
+                              'and -L must contain '+MPU_PATTERN),
+                        default='8'
+                        )
+    parser.add_argument('-p','--profile',dest='profile',
+                        help=('Recorded compartment switches for the profile '
+                              'method, a JSON file of {caller: {callee: '
+                              'count}} or a dump of the switch buffer, '
+                              'see switch_profile.py')
+                        )
+    parser.add_argument('--profile-elf',dest='profile_elf',
+                        help=('The recorded binary, required with a dump for '
+                              '-p or -e')
+                        )
+    parser.add_argument('-e','--emulated-stores',dest='emulated_stores',
+                        help=('The recorded stores through the emulator, a '
+                              'JSON file of {compartment: {global: count}} '
+                              'or a dump of the record buffers, see '
+                              'emulated_stores.py.  The most stored globals '
+                              'are given MPU regions where there are regions '
+                              'left')
+                        )
+    parser.add_argument('--recorded-policy',dest='recorded_policy',
+                        help='Policy the emulated stores were recorded with'
+                        )
+    parser.add_argument('--loop-scale',dest='loop_scale',type=float,
+                        default=pdg.DEFAULT_LOOP_SCALE,
+                        help=('Weight of a call site in a loop relative to '
+                              'one outside it, calls are weighted by their '
+                              'number of call sites times this for each '
+                              'loop level')
+                        )
+    parser.add_argument('--debug-dir',dest='debug_dir',
+                        help='Write the PDG and region graphs as .dot files to this directory'
                         )
 
     args = parser.parse_args()
-    global MAX_DATA_REGIONS
-    MAX_DATA_REGIONS = args.num_mpu_regions - NUM_DEFAULT_MPU_REGIONS
+    DEBUG_DIR = args.debug_dir
+    num_mpu_regions = [int(n) for n in args.num_mpu_regions.split(',')]
+    for n in num_mpu_regions:
+        if n <= NUM_DEFAULT_MPU_REGIONS:
+            print "-n: At least", NUM_DEFAULT_MPU_REGIONS + 1, \
+                  "MPU regions are needed"
+            quit(-1)
 
     if args.partion_method and not args.outfile:
         print "-o, --outfile: Required with -m(--method)"
         quit(-1)
 
-    PDG = build_graph(args.json_graph)
-    device_desc,T = devices.get_device_desc(args.board)
-
-    if args.outfile and args.partion_method:
-        #nx.drawing.nx_pydot.write_dot(PDG,"all_nodes.dot")
-        make_isr_comp(PDG)
-        remap_peripherals(PDG, device_desc)
-        comp_def = PARTITION_METHODS[args.partion_method](PDG,T)
-
-        with open(args.outfile,'wb') as outfile:
-            json.dump(comp_def, outfile, sort_keys=True,
-                      indent=4, separators=(',', ': '))
+    methods = []
+    if args.partion_method:
+        methods = args.partion_method.split(',')
+    for method in methods:
+        if not PARTITION_METHODS.has_key(method):
+            print "Unknown partition method:", method
+            quit(-1)
+    for (values, pattern) in ((methods, METHOD_PATTERN),
+                              (num_mpu_regions, MPU_PATTERN)):
+        if len(values) > 1:
+            for path in (args.outfile, args.linker_output):
+                if path and pattern not in path:
+                    print "-o and -L must contain", pattern, \
+                          "with more than one value of it"
+                    quit(-1)
+
+    if "profile" in methods and not args.profile:
+        print "-p, --profile: Required with -m profile"
+        quit(-1)
 
-        if args.linker_template and args.linker_output:
-            ld_helpers.make_linker_script(args.linker_template,
-                                          args.linker_output,
-                                          comp_def)
+    PDG = pdg.load(args.json_graph)
+    PDG.loop_scale = args.loop_scale
+    if args.size_file:
+        # Region sizes break ties between merges by the padding they add
+        pdg.add_size_info(PDG, args.size_file)
+    device_desc,T = devices.get_device_desc(args.board)
+    if args.profile:
+        switch_counts = switch_profile.load_switch_counts(args.profile,
+                                                          args.profile_elf)
+        PARTITION_METHODS["profile"] = functools.partial(
+            partition_by_profile, switch_counts=switch_counts)
+    if args.emulated_stores:
+        stores = emulated_stores.load_emulated_stores(args.emulated_stores,
+                                                      args.recorded_policy,
+                                                      args.profile_elf)
+        for method in methods:
+            PARTITION_METHODS[method] = functools.partial(
+                PARTITION_METHODS[method], emulated_stores=stores)
+
+    if DEBUG_DIR:
+        write_debug_graph(PDG.to_networkx(),"all_nodes.dot")
+
+    if args.outfile and methods:
+        PDG = pdg.make_isr_comp(PDG)
+        PDG = pdg.remap_peripherals(PDG, device_desc)
+
+        jobs = []
+        for method in methods:
+            debug_dir = DEBUG_DIR
+            if DEBUG_DIR and len(methods) > 1:
+                # Each method writes the same .dot files
+                debug_dir = os.path.join(DEBUG_DIR, method)
+                if not os.path.isdir(debug_dir):
+                    os.makedirs(debug_dir)
+            jobs.append((method, debug_dir,
+                         (PARTITION_METHODS[method], PDG, T, method,
+                          num_mpu_regions, args.outfile,
+                          args.linker_template, args.linker_output)))
+
+        if len(jobs) == 1:
+            run_partition(*jobs[0][2])
+        else:
+            failed = run_partitions(jobs)
+            if failed:
+                print "Partitioning failed for:", ", ".join(failed)
+                quit(-1)
@@ -1,20 +1,24 @@
 from __future__ import print_function
 from argparse import ArgumentParser
+import os
+import glob
+import traceback
+import multiprocessing
 import memory_reader
+import elf_cache
+import elf_reader
+import comp_index
 import networkx as nx
 import final_linker_gen as ld_gen
 import analyzer as graph_an
 from key_defs import *
 from pprint import pprint
 from ld_helpers import next_power_2
-import subprocess
 import json
 from collections import OrderedDict
 import numpy
 import csv
 
-STORE_INSTRS = ['str', 'push', 'stm', 'stc']
-
 
 def write_section_memory_data(baseline_info, hexbox_info, fd):
     '''
@@ -87,72 +91,18 @@ def get_memory_usage(baseline_bin_name, hexbox_bin_name):
 
 def get_sizes_and_num_instrs(bin_file):
     '''
-        Uses objdump to get functions, and number bytes each function
-        takes.  Ignores hidden functions inserted by comps
-    '''
-    cmd = ['arm-none-eabi-objdump', '-t', bin_file]
-    stdout = subprocess.check_output(cmd)
-    functs = {}
-    sections = {}
-    metadata_size = 0
-    for line in stdout.split("\n"):
-        if len(line) > 15 and line[15] == 'F':
-            size_and_name = line.split('\t')[-1]
-            size = int(size_and_name[0:8], 16)
-            name = size_and_name[9:].strip()
-            if name.startswith('.hidden '):
-                name = name[len('.hidden '):]
-            section_name = line[17:].split('\t')[0]
-            #if not name.startswith('.hidden'):
-            functs[name]={'NUM_BYTES':size}
-            num_instrs, num_strs = get_num_instructions(name, bin_file)
-            functs[name]['NUM_STRS'] = num_strs
-            functs[name]['NUM_INSTR'] = num_instrs
-            functs[name]["SECTION"] = section_name
-            if not sections.has_key(section_name):
-                sections[section_name] = {'NUM_BYTES':0,'NUM_INSTR':0}
-            sections[section_name]['NUM_BYTES'] += size
-            sections[section_name]['NUM_INSTR'] += num_instrs
-        if ".rodata" in line and ("__hexbox_md" in line or "_hexbox_comp" in line):
-            metadata_size += int(line.split('\t')[1].split()[0], 16)
-    return functs, sections, metadata_size
-
-
-def get_num_instructions(function, bin_file):
-    '''
-        Uses uses gdb to disassemble each function and then counts number
-        of instructions in that function
-    '''
-    #functs = get_function_names_and_sizes(bin_file)
-
-    cmd = ['arm-none-eabi-gdb', '-batch', '-ex', "file %s" % bin_file,
-           "-ex", "disassemble %s" % function]
-    stdout = subprocess.check_output(cmd)
-    lines = stdout.split('\n')
-    sub_count = 2  # First and last line are not instructions
-    i = 0
-    store_instrs = 0
-    while i < len(lines):
-        # Remove the embedded metadata ptr from the count of instructions
-        if 'svc\t100' in lines[i]:
-            addr = int(lines[i].split()[0], 16)
-            #  Word may get decoded as 1 or 2 instructions
-            if addr + 4 == int(lines[i + 1].split()[0], 16):
-                sub_count += 1  # Line after this svc is not an instruction
-            else:
-                sub_count += 2  # Line after this svc is not an instruction
-        else:
-            for store_str in STORE_INSTRS:
-                if store_str in lines[i].lower():
-                    store_instrs += 1
-        i += 1
-    return (len(lines) - sub_count, store_instrs)
+        Scans the code of bin_file (see thumb_scan) to get functions, number
+        bytes each function takes, and the number of instructions and stores
+        in each.
+        Ignores hidden functions inserted by comps
+    '''
+    return elf_cache.get_function_table(bin_file)
 
 
 def get_instructions_per_compartment(comp_stats, bin_file):
     '''
         Gets the number of static instructions in each compartment
-        Assumes comp_stats was created using build_comp_stats
+        Assumes comp_stats was created using comp_index.build_comp_stats
     '''
     functs, sections, metadata = get_sizes_and_num_instrs(bin_file)
     get_default_comp(comp_stats,functs)
@@ -180,61 +130,32 @@ def get_edges(comp_stats, dep_graph):
        Adds 'OUT_EDGES': [], 'IN_EDGES': [], 'REQ_GLOBAL':set() to comp_stats
     '''
     node2type = nx.get_node_attributes(dep_graph, TYPE_KEY)
+    funct_comps = comp_index.get_function_comps(comp_stats)
+    no_comps = set()
     for c, stats in comp_stats.items():
-        #  print("-----------------%s---------------"%str(c))
         comp_stats[c]['OUT_EDGES'] = []
         comp_stats[c]['IN_EDGES'] = []
         comp_stats[c]['REQ_GLOBAL'] = set()
         for f in stats['FUNCTIONS']:
             try:
                 for s in dep_graph.successors(f):
-                    if node2type[s] == FUNCTION_TYPE and s not in stats['FUNCTIONS']:
-                        #  print("Suc: ", s)
+                    if node2type[s] == FUNCTION_TYPE and \
+                       c not in funct_comps.get(s, no_comps):
                         comp_stats[c]['OUT_EDGES'].append(s)
                     if node2type[s] == GLOBAL_TYPE:
-                        #  print("Req: ", s)
                         comp_stats[c]['REQ_GLOBAL'].add(s)
 
                 for p in dep_graph.predecessors(f):
-                    if node2type[p] == FUNCTION_TYPE and p not in stats['FUNCTIONS']:
-                        #  print("Pre: ", p)
+                    if node2type[p] == FUNCTION_TYPE and \
+                       c not in funct_comps.get(p, no_comps):
                         comp_stats[c]['IN_EDGES'].append(p)
                     if node2type[p] == GLOBAL_TYPE:
-                        #  print("Req: ", p)
                         comp_stats[c]['REQ_GLOBAL'].add(p)
             except nx.exception.NetworkXError:
                 pass
     return comp_stats
 
 
-def build_comp_stats(comp_desc):
-    '''
-        Gets the functions, peripherals, and globals accessible by this
-        compartment.
-        Returns:
-        comp_stats = {COMP_NAME: {"FUNCTIONS": [], "GLOBALS": [],
-                      "PERIPHERALS": [], "Priv": (bool)}, ...}
-    '''
-    comp_stats = {}
-
-    for comp_name, comp_info in comp_desc[POLICY_KEY_COMPARTMENTS].items():
-        stats = {}
-        stats["FUNCTIONS"] = []
-        for f in comp_desc[POLICY_KEY_REGIONS][comp_name][POLICY_REGION_KEY_OBJECTS]:
-            stats["FUNCTIONS"].append(f)
-        stats["GLOBALS"] = []
-        for r in comp_info["Data"]:
-            for g in comp_desc[POLICY_KEY_REGIONS][r][POLICY_REGION_KEY_OBJECTS]:
-                stats["GLOBALS"].append(g)
-        stats["PERIPHERALS"] = []
-        for p in comp_info["Peripherals"]:
-            stats["PERIPHERALS"].append(p)
-
-        stats["Priv"] = comp_info["Priv"]
-        comp_stats[comp_name] = stats
-    return comp_stats
-
-
 def get_comp_stats(comp_desc, bin_file, dep_graph):
     '''
         Gets the compartment stats for the input data
@@ -248,7 +169,7 @@ def get_comp_stats(comp_desc, bin_file, dep_graph):
         section_info =
         metadata =
     '''
-    comp_stats = build_comp_stats(comp_desc)
+    comp_stats = comp_index.build_comp_stats(comp_desc)
     funct_info, section_info, metadata = \
         get_instructions_per_compartment(comp_stats, bin_file)
     get_edges(comp_stats, dep_graph)
@@ -256,46 +177,65 @@ def get_comp_stats(comp_desc, bin_file, dep_graph):
     return comp_stats, funct_info, section_info, metadata
 
 
-def var_in_whitelist(var, compartment, whitelist):
+def get_global_addrs(bin_file):
+    '''
+        Gets the address and size of each data object in bin_file
+        Returns: {name: (addr, size)}
+    '''
+    symbols = elf_cache.get_symbols(bin_file)
+    global_addrs = {}
+    for i in numpy.flatnonzero(symbols.type == elf_reader.STT_OBJECT):
+        global_addrs[symbols.names[i]] = (int(symbols.addr[i]),
+                                          int(symbols.size[i]))
+    return global_addrs
 
-    for (key, symbols) in whitelist.items():
-        wl_comp = key[1]
-        if compartment == wl_comp:
-            for symbol in symbols:
-                if symbol.is_var(var):
-                    return True
-    return False
 
+def get_global_deps(dep_graph, funct_info):
+    '''
+        Gets the functions that require each global and their number of
+        instructions.  This is all get_global_stats needs from dep_graph.
+        The instructions of every neighbor (predecessors too) are summed,
+        neighbors not in funct_info count 0, see CreatingPolicies.md
+        Returns: {var: (set(functions), num_instrs)}
+    '''
+    global_deps = {}
+    for (var, d) in dep_graph.nodes(data=True):
+        if d[TYPE_KEY] != GLOBAL_TYPE:
+            continue
+        req_functs = set()
+        req_instrs = 0
+        # Globals are only connected to functions, and I don't remember the
+        # direction so just check both
+        for n in dep_graph.successors(var) + dep_graph.predecessors(var):
+            if funct_info.has_key(n):
+                req_instrs += funct_info[n]['NUM_INSTR']
+            req_functs.add(n)
+        global_deps[var] = (req_functs, req_instrs)
+    return global_deps
 
-def get_global_stats(comp_stats, dep_graph, funct_info, whitelist):
+
+def get_global_stats(comp_stats, global_deps, whitelist, global_addrs=None):
+    '''
+        Gets the functions that require each global (global_deps, see
+        get_global_deps), and the compartments that can write it.  A
+        compartment can write a global if it is privileged, the global is
+        in one of its data regions, or the global's address (from
+        global_addrs, see get_global_addrs) is in the compartment's
+        whitelist.
+    '''
     global_stats = {}
-    node2type = nx.get_node_attributes(dep_graph, TYPE_KEY)
+    g_vars = global_deps.keys()
+    index = comp_index.CompIndex(comp_stats, g_vars)
+    whitelisted = index.get_whitelisted(whitelist, global_addrs or {})
+    exposed, exposed_instrs, exposed_strs = index.get_exposure(whitelisted)
+    exposed_functs = index.get_exposed_functions(exposed)
 
-    g_vars = filter(lambda (n, d): d[TYPE_KEY] == GLOBAL_TYPE, dep_graph.nodes(data=True))
-    for var_tuple in g_vars:
-        var = var_tuple[0]
+    for i, var in enumerate(g_vars):
         stats = {}
-        stats['REQ_FUNCTIONS'] = set()
-        stats['REQ_INSTR'] = 0
-        stats["EXPOSED_FUNCTS"] = set()
-        stats["EXPOSED_INSTRS"] = 0
-        stats["EXPOSED_STRS"] = 0
-        for c, c_stats in comp_stats.items():
-            if c_stats['Priv'] or var in c_stats['GLOBALS'] or \
-               var_in_whitelist(var, c, whitelist):
-                stats["EXPOSED_INSTRS"] += c_stats['NUM_INSTR']
-                stats["EXPOSED_FUNCTS"].update(c_stats['FUNCTIONS'])
-                stats["EXPOSED_STRS"] += c_stats['NUM_STRS']
-
-        # Globals are only connected to functions, and I don't remember the
-        # direction so just check both
-        for s in dep_graph.successors(var):
-            stats['REQ_INSTR'] += funct_info[s]['NUM_INSTR']
-            stats['REQ_FUNCTIONS'].add(s)
-        for p in dep_graph.predecessors(var):
-            stats['REQ_INSTR'] += funct_info[s]['NUM_INSTR']
-            stats['REQ_FUNCTIONS'].add(p)
-
+        stats['REQ_FUNCTIONS'], stats['REQ_INSTR'] = global_deps[var]
+        stats["EXPOSED_FUNCTS"] = exposed_functs[i]
+        stats["EXPOSED_INSTRS"] = int(exposed_instrs[i])
+        stats["EXPOSED_STRS"] = int(exposed_strs[i])
         global_stats[var] = stats
 
     return global_stats
@@ -405,10 +345,12 @@ def write_program_summary(function_info, section_info, program_name, fd):
     return code_size, code_instr, len(function_info.keys())
 
 
-def write_whitelist_usage(binary, mem_file, fd, size=1024):
+def write_whitelist_usage(comp_list, fd):
+    '''
+        Writes whitelist usage, comp_list is from
+        memory_reader.get_access_control_list
+    '''
     #  TODO get total number of compartments so can calc stats
-    comp_list = memory_reader.get_access_control_list(binary, mem_file,
-                                          size)
     #  print(compartment_addrs)
     addrs = set()
     size_list = []
@@ -463,7 +405,7 @@ def compute_comp_stats(comp_stat, fd):
     ])
     default_reg = OrderedDict()     # contains default region values, so that it will be added separatly
     num_comps = len(comp_stat.keys()) - 2  # Remove default, and hexbox-rt regions
-    for key in comp_stats:
+    for key in comp_stat:
         code_reg = comp_stat[key]
         if key == ".hexbox_rt_code":                            # Skip .hexbox_rt_code
             continue
@@ -735,8 +677,8 @@ def compile_memory_results(name, policy, base_info, hexbox_info):
 
 
 def compile_static_results(name, policy, hexbox_instr, base_instr, comp_stats,
-                           hexbox_numFunc, comp_summary, global_results,
-                           elf_sections, num_comps):
+                           hexbox_numFunc, base_numFunc, comp_summary,
+                           global_results, elf_sections, num_comps):
     '''
         Compiles static results for paper
     '''
@@ -766,58 +708,93 @@ def compile_static_results(name, policy, hexbox_instr, base_instr, comp_stats,
     return results
 
 
-if __name__ == '__main__':
-    parser = ArgumentParser()
-    parser.add_argument('-f', '--hexbox_binary', required=True,
-                        dest='hexbox_bin', help='Hexbox Final Binary')
-    parser.add_argument('-b', '--baseline', required=True, dest='baseline_bin',
-                        help='Baseline Binary')
-    parser.add_argument('-c', '--comp_description', dest='comp_desc',
-                        required=True, help='Final Compartment Description' +
-                        ' (hexbox-final-policy--<method>.json)')
-    parser.add_argument('-g', '--graph', dest='graph', required=True,
-                        help='Dependancy Graph' +
-                        ' (hexbox-analysis--<method>.json)')
-    parser.add_argument('-m', '--memory_file', dest='memory', required=True,
-                        help='Dump of memory from hexbox record binary, use ' +
-                        'dump_mem("<file_name>") in gdb_helpers.py')
-    parser.add_argument('-o', '--outfile', dest='outfile', required=False,
-                        default='results.csv', help='Output file name')
+HEXBOX_FINAL_SUFFIX = '--hexbox--final.elf'
 
-    args = parser.parse_args()
 
-    name_info = args.hexbox_bin.split('--')
-    policy = name_info[1]
-    app_name = name_info[0].split("/")[-1]
+def parse_bin_name(hexbox_bin):
+    '''
+        Gets the app name, policy, and build options (e.g. filename--mpu-8)
+        from a binary named <app>--<policy>--mpu-<N>--hexbox--final.elf
+    '''
+    name_info = os.path.basename(hexbox_bin).split('--')
+    return name_info[0], name_info[1], '--'.join(name_info[1:-2])
+
 
-    with open(args.comp_desc, 'rb') as comp_json:
-        comp_desc = json.load(comp_json)
+def get_baseline_info(baseline_bin):
+    '''
+        Gets everything collect_results needs from the baseline binary, this
+        is shared by every policy built for an app so it is only parsed once
+        Returns:
+        (functs, sections, metadata, section_sizes) see
+        get_sizes_and_num_instrs and final_linker_gen.get_section_sizes
+    '''
+    functs, sections, metadata = get_sizes_and_num_instrs(baseline_bin)
+    return functs, sections, metadata, ld_gen.get_section_sizes(baseline_bin)
 
-    results = {}
 
-    comp_whitelist = memory_reader.get_access_control_list(args.hexbox_bin,
-                                                           args.memory, 1024)
+def get_hexbox_comp_info(comp_desc_file, graph_file, hexbox_bin):
+    '''
+        Reads the final policy and dependency graph, and gets the compartment
+        stats of hexbox_bin.  Only what is needed from the graph is
+        returned, so it is not copied back when this runs on a pool.
+        Returns:
+        (global_deps, comp_stats, funct_info, section_info, metadata) see
+        get_global_deps and get_comp_stats
+    '''
+    with open(comp_desc_file, 'rb') as comp_json:
+        comp_desc = json.load(comp_json)
+    dep_graph = graph_an.build_graph(graph_file)
+    comp_stats, funct_info, section_info, metadata = \
+        get_comp_stats(comp_desc, hexbox_bin, dep_graph)
+    global_deps = get_global_deps(dep_graph, funct_info)
+    return global_deps, comp_stats, funct_info, section_info, metadata
 
-    dep_graph = graph_an.build_graph(args.graph)
-    region_sizes = ld_gen.get_section_sizes(args.hexbox_bin)
-    comp_stats, funct_info, section_info, comp_metadata = \
-        get_comp_stats(comp_desc, args.hexbox_bin, dep_graph)
-    global_stats = get_global_stats(comp_stats, dep_graph, funct_info,
-                                    comp_whitelist)
 
-    base_functs, base_sections, metadata = \
-        get_sizes_and_num_instrs(args.baseline_bin)
+def run_tasks(tasks, pool=None):
+    '''
+        Runs independent tasks [(func, args), ...] on pool, or one after
+        the other if pool is None.  Returns the results in the same order
+    '''
+    if pool is None:
+        return [func(*args) for (func, args) in tasks]
+    pending = [pool.apply_async(func, args) for (func, args) in tasks]
+    return [p.get() for p in pending]
+
 
-    (baseline_info, hexbox_info) = get_memory_usage(args.baseline_bin,
-                                                    args.hexbox_bin)
+def collect_results(hexbox_bin, baseline_bin, comp_desc_file, graph_file,
+                    memory_file, outfile, baseline=None, pool=None):
+    '''
+        Analyzes hexbox_bin against baseline_bin and writes the raw data file
+        to outfile.  baseline is the result of get_baseline_info, if it has
+        already been computed.  The binary analyses do not depend on each
+        other, and are run on pool when one is given.
+        Returns:
+        (mem_results, static_results) rows of the memory and static tables
+    '''
+    app_name, policy, _ = parse_bin_name(hexbox_bin)
+
+    tasks = [(memory_reader.get_access_control_list,
+              (hexbox_bin, memory_file, 1024)),
+             (get_hexbox_comp_info, (comp_desc_file, graph_file, hexbox_bin)),
+             (ld_gen.get_section_sizes, (hexbox_bin,))]
+    if baseline is None:
+        tasks.append((get_baseline_info, (baseline_bin,)))
+    results = run_tasks(tasks, pool)
+    comp_whitelist, comp_info, hexbox_info = results[0:3]
+    if baseline is None:
+        baseline = results[3]
+
+    global_deps, comp_stats, funct_info, section_info, comp_metadata = \
+        comp_info
+    base_functs, base_sections, metadata, baseline_info = baseline
+    global_stats = get_global_stats(comp_stats, global_deps, comp_whitelist,
+                                    get_global_addrs(hexbox_bin))
 
     mem_results = compute_memory_stats(app_name, policy, baseline_info,
                                        hexbox_info)
 
-
-
     #  --------------------------Write Raw data file -------------------------
-    with open(args.outfile, 'w') as fd:
+    with open(outfile, 'w') as fd:
         num_comps, comp_summary = write_comp_summary(comp_stats, fd)
         fd.write('\n')
         global_results = write_global_summary(global_stats, fd)
@@ -834,23 +811,179 @@ if __name__ == '__main__':
         write_section_memory_data(baseline_info, hexbox_info, fd)
         # calculate stats for RAM,FLASH, and metadata
         write_memory_stats(mem_results, fd)
-        write_whitelist_usage(args.hexbox_bin, args.memory, fd)
+        write_whitelist_usage(comp_whitelist, fd)
         fd.write("\n\n Baseline Metadata Size, %i\n" % metadata)
         fd.write("\n Hexbox Metadata Size, %i\n" % comp_metadata)
 
     compare_functions(funct_info, base_functs)
 
-    # -----------------------------Write Memory Results -----------------------
-    with open("memory_table_" + args.outfile, 'wb') as summary_fd:
-        dw = csv.DictWriter(summary_fd, fieldnames=mem_results)
-        dw.writeheader()
-        dw.writerow(mem_results)
     # ----------------------------Compile Static Results-----------------------
     static_results = \
         compile_static_results(app_name, policy, hexbox_instr, base_instr,
-                               comp_stats, hexbox_numFunc, comp_summary,
-                               global_results, hexbox_info, num_comps)
-    with open("static_table_" + args.outfile, 'wb') as summary_fd:
-        dw = csv.DictWriter(summary_fd, fieldnames=static_results)
+                               comp_stats, hexbox_numFunc, base_numFunc,
+                               comp_summary, global_results, hexbox_info,
+                               num_comps)
+    return mem_results, static_results
+
+
+def write_table(rows, filename):
+    '''
+        Writes a list of result rows (OrderedDicts with the same keys) as csv
+    '''
+    with open(filename, 'wb') as summary_fd:
+        dw = csv.DictWriter(summary_fd, fieldnames=rows[0].keys())
         dw.writeheader()
-        dw.writerow(static_results)
+        for row in rows:
+            dw.writerow(row)
+
+
+def find_batch_jobs(app_dir, outfile):
+    '''
+        Finds each bin/*--hexbox--final.elf in app_dir along with its
+        baseline, final policy, analysis graph, and memory recording, named
+        as the generated Makefile and build_final.sh name them.  When there
+        is no baseline built with the same options the first baseline of
+        the app is used, the baseline does not depend on the policy.
+
+        Returns:
+        [(hexbox_bin, baseline_bin, comp_desc, graph, memory, outfile), ...]
+    '''
+    bin_dir = os.path.join(app_dir, 'bin')
+    hexbox_dir = os.path.join(app_dir, '.build', 'hexbox')
+    jobs = []
+    pattern = os.path.join(bin_dir, '*' + HEXBOX_FINAL_SUFFIX)
+    for hexbox_bin in sorted(glob.glob(pattern)):
+        name = os.path.basename(hexbox_bin)[:-len(HEXBOX_FINAL_SUFFIX)]
+        app_name, _, options = parse_bin_name(hexbox_bin)
+        baseline_bin = os.path.join(bin_dir, name + '--baseline.elf')
+        if not os.path.exists(baseline_bin):
+            baselines = sorted(glob.glob(os.path.join(
+                bin_dir, app_name + '--*--baseline.elf')))
+            baseline_bin = baselines[0] if baselines else baseline_bin
+        comp_desc = os.path.join(hexbox_dir,
+                                 'hexbox-final-policy--%s.json' % options)
+        graph = os.path.join(hexbox_dir, 'hexbox-analysis--%s.json' % options)
+        memory = os.path.join(app_dir,
+                              'mem_accesses_%s--hexbox--record.bin' % name)
+        missing = [f for f in (baseline_bin, comp_desc, graph, memory)
+                   if not os.path.exists(f)]
+        if missing:
+            print("Skipping %s, missing: %s" % (hexbox_bin, ", ".join(missing)))
+            continue
+        raw_outfile = os.path.join(app_dir, name + '--' + outfile)
+        jobs.append((hexbox_bin, baseline_bin, comp_desc, graph, memory,
+                     raw_outfile))
+    return jobs
+
+
+def _run_batch_job(job_and_baseline):
+    '''
+        Process pool entry point for run_batch, returns None on failure so
+        one bad build does not stop the rest of the batch
+    '''
+    job, baseline = job_and_baseline
+    (hexbox_bin, baseline_bin, comp_desc, graph, memory, outfile) = job
+    try:
+        return collect_results(hexbox_bin, baseline_bin, comp_desc, graph,
+                               memory, outfile, baseline)
+    except Exception:
+        print("Failed collecting results for %s" % hexbox_bin)
+        traceback.print_exc()
+        return None
+
+
+def run_batch(app_dirs, outfile, num_workers=None):
+    '''
+        Collects the results of every hexbox binary in app_dirs using a
+        process pool and writes one memory table and one static table for
+        all of them.  Each baseline binary is parsed once and shared by all
+        the policies built from it.
+    '''
+    jobs = []
+    for app_dir in app_dirs:
+        jobs.extend(find_batch_jobs(app_dir, outfile))
+    if not jobs:
+        print("No hexbox binaries found in %s" % ", ".join(app_dirs))
+        return
+
+    pool = multiprocessing.Pool(num_workers)
+    try:
+        baseline_bins = sorted(set(job[1] for job in jobs))
+        baselines = dict(zip(baseline_bins,
+                             pool.map(get_baseline_info, baseline_bins)))
+        results = pool.map(_run_batch_job,
+                           [(job, baselines[job[1]]) for job in jobs])
+    finally:
+        pool.close()
+        pool.join()
+
+    mem_rows = []
+    static_rows = []
+    for job, result in zip(jobs, results):
+        if result is None:
+            continue
+        options = parse_bin_name(job[0])[2]
+        for (row, rows) in zip(result, (mem_rows, static_rows)):
+            rows.append(OrderedDict([('Options', options)] + row.items()))
+    if not mem_rows:
+        print("No results were collected")
+        return
+    write_table(mem_rows, "memory_table_" + outfile)
+    write_table(static_rows, "static_table_" + outfile)
+    print("Collected results for %i of %i binaries" % (len(mem_rows),
+                                                     len(jobs)))
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('-f', '--hexbox_binary', dest='hexbox_bin',
+                        help='Hexbox Final Binary')
+    parser.add_argument('-b', '--baseline', dest='baseline_bin',
+                        help='Baseline Binary')
+    parser.add_argument('-c', '--comp_description', dest='comp_desc',
+                        help='Final Compartment Description' +
+                        ' (hexbox-final-policy--<method>.json)')
+    parser.add_argument('-g', '--graph', dest='graph',
+                        help='Dependancy Graph' +
+                        ' (hexbox-analysis--<method>.json)')
+    parser.add_argument('-m', '--memory_file', dest='memory',
+                        help='Dump of memory from hexbox record binary, use ' +
+                        'dump_mem("<file_name>") in gdb_helpers.py')
+    parser.add_argument('-o', '--outfile', dest='outfile', required=False,
+                        default='results.csv', help='Output file name')
+    parser.add_argument('--batch', dest='batch_dirs', nargs='+',
+                        help='App directories to collect all results from, ' +
+                        'each with bin/*--hexbox--final.elf and the ' +
+                        'baselines, policies, graphs, and memory dumps used ' +
+                        'with -f -b -c -g -m.  Writes one memory and one ' +
+                        'static table for all of them')
+    parser.add_argument('-j', '--jobs', dest='jobs', type=int, default=None,
+                        help='Number of worker processes, defaults to the ' +
+                        'number of CPUs.  Use 1 to run everything in this ' +
+                        'process')
+
+    args = parser.parse_args()
+
+    if args.batch_dirs:
+        run_batch(args.batch_dirs, args.outfile, args.jobs)
+    else:
+        for (arg, flag) in ((args.hexbox_bin, '-f'), (args.baseline_bin, '-b'),
+                            (args.comp_desc, '-c'), (args.graph, '-g'),
+                            (args.memory, '-m')):
+            if arg is None:
+                parser.error("%s is required without --batch" % flag)
+        pool = None
+        if args.jobs != 1:
+            pool = multiprocessing.Pool(args.jobs)
+        try:
+            mem_results, static_results = \
+                collect_results(args.hexbox_bin, args.baseline_bin,
+                                args.comp_desc, args.graph, args.memory,
+                                args.outfile, pool=pool)
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+        # -----------------------------Write Memory Results -------------------
+        write_table([mem_results], "memory_table_" + args.outfile)
+        write_table([static_results], "static_table_" + args.outfile)
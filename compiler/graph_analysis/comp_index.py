@@ -0,0 +1,197 @@
+'''
+    Indexes the compartments, globals, and functions of a policy so that
+    what each compartment can access is computed with numpy array
+    operations, rather than by searching the compartment and whitelist
+    lists for every (global, compartment) pair.
+'''
+import numpy
+from key_defs import *
+
+# The compartment each whitelist is recorded for is identified by the name
+# of its policy symbol, _hexbox_comp_<compartment name>
+WHITELIST_COMP_PREFIX = '_hexbox_comp_'
+
+
+def build_comp_stats(comp_desc):
+    '''
+        Gets the functions, peripherals, and globals accessible by this
+        compartment.
+        Returns:
+        comp_stats = {COMP_NAME: {"FUNCTIONS": [], "GLOBALS": [],
+                      "PERIPHERALS": [], "Priv": (bool)}, ...}
+    '''
+    comp_stats = {}
+
+    for comp_name, comp_info in comp_desc[POLICY_KEY_COMPARTMENTS].items():
+        stats = {}
+        stats["FUNCTIONS"] = []
+        for f in comp_desc[POLICY_KEY_REGIONS][comp_name][POLICY_REGION_KEY_OBJECTS]:
+            stats["FUNCTIONS"].append(f)
+        stats["GLOBALS"] = []
+        for r in comp_info["Data"]:
+            for g in comp_desc[POLICY_KEY_REGIONS][r][POLICY_REGION_KEY_OBJECTS]:
+                stats["GLOBALS"].append(g)
+        stats["PERIPHERALS"] = []
+        for p in comp_info["Peripherals"]:
+            stats["PERIPHERALS"].append(p)
+
+        stats["Priv"] = comp_info["Priv"]
+        comp_stats[comp_name] = stats
+    return comp_stats
+
+
+def get_function_comps(comp_stats):
+    '''
+        Maps each function to the compartments that contain it
+        Returns: {function: set(compartment names)}
+    '''
+    funct_comps = {}
+    for comp, stats in comp_stats.items():
+        for f in stats['FUNCTIONS']:
+            funct_comps.setdefault(f, set()).add(comp)
+    return funct_comps
+
+
+def get_whitelist_comp(wl_comp):
+    '''
+        Gets the compartment name a whitelist key from
+        memory_reader.get_access_control_list was recorded for
+    '''
+    if isinstance(wl_comp, basestring) and \
+       wl_comp.startswith(WHITELIST_COMP_PREFIX):
+        return wl_comp[len(WHITELIST_COMP_PREFIX):]
+    return wl_comp
+
+
+class WhitelistIntervals(object):
+    '''
+        The address ranges a compartment is whitelisted for, sorted by
+        start address.  max_ends[i] is the largest end of the first i + 1
+        ranges, so the ranges overlapping [start, end) are found with one
+        binary search.
+    '''
+    def __init__(self, symbols):
+        bounds = sorted(s.get_bounds() for s in symbols)
+        self.starts = numpy.array([b[0] for b in bounds], dtype=numpy.int64)
+        ends = numpy.array([b[1] for b in bounds], dtype=numpy.int64)
+        self.max_ends = numpy.maximum.accumulate(ends) if len(ends) else ends
+
+    def overlaps(self, starts, ends):
+        '''
+            For each [starts[i], ends[i]) returns True if it overlaps any
+            whitelisted range
+        '''
+        last = numpy.searchsorted(self.starts, ends, 'left') - 1
+        result = numpy.zeros(len(starts), dtype=bool)
+        valid = last >= 0
+        result[valid] = self.max_ends[last[valid]] > starts[valid]
+        return result
+
+
+def get_whitelist_intervals(whitelist):
+    '''
+        Groups the whitelist from memory_reader.get_access_control_list by
+        compartment name
+        Returns: {compartment name: WhitelistIntervals}
+    '''
+    comp_symbols = {}
+    for (key, symbols) in whitelist.items():
+        comp = get_whitelist_comp(key[1])
+        comp_symbols.setdefault(comp, []).extend(symbols)
+    intervals = {}
+    for comp, symbols in comp_symbols.items():
+        intervals[comp] = WhitelistIntervals(symbols)
+    return intervals
+
+
+class CompIndex(object):
+    '''
+        Compartment x global index over comp_stats (see
+        collect_results.get_comp_stats)
+
+        comps:     compartment names, comp_idx maps names to rows
+        globals:   global names, global_idx maps names to columns
+        incidence: bool matrix, [c, g] is True if global g is in one of the
+                   data regions of compartment c
+        priv, num_instr, num_strs: arrays indexed by compartment
+    '''
+    def __init__(self, comp_stats, global_names):
+        self.comp_stats = comp_stats
+        self.comps = sorted(comp_stats.keys())
+        self.comp_idx = dict((c, i) for (i, c) in enumerate(self.comps))
+        self.globals = list(global_names)
+        self.global_idx = dict((g, i) for (i, g) in enumerate(self.globals))
+
+        self.incidence = numpy.zeros((len(self.comps), len(self.globals)),
+                                     dtype=bool)
+        for i, c in enumerate(self.comps):
+            cols = [self.global_idx[g] for g in comp_stats[c]['GLOBALS']
+                    if self.global_idx.has_key(g)]
+            self.incidence[i, cols] = True
+
+        self.priv = numpy.array([bool(comp_stats[c]['Priv'])
+                                 for c in self.comps], dtype=bool)
+        self.num_instr = numpy.array([comp_stats[c].get('NUM_INSTR', 0)
+                                      for c in self.comps], dtype=numpy.int64)
+        self.num_strs = numpy.array([comp_stats[c].get('NUM_STRS', 0)
+                                     for c in self.comps], dtype=numpy.int64)
+
+    def get_whitelisted(self, whitelist, global_addrs):
+        '''
+            Gets the globals each compartment can access through its
+            recorded whitelist
+
+            whitelist:    from memory_reader.get_access_control_list
+            global_addrs: {global name: (addr, size)}, globals without an
+                          address are never whitelisted
+            Returns: bool matrix like incidence
+        '''
+        whitelisted = numpy.zeros(self.incidence.shape, dtype=bool)
+        cols = [i for (i, g) in enumerate(self.globals)
+                if global_addrs.has_key(g)]
+        if not whitelist or not cols:
+            return whitelisted
+        cols = numpy.array(cols, dtype=numpy.int64)
+        starts = numpy.array([global_addrs[self.globals[i]][0] for i in cols],
+                             dtype=numpy.int64)
+        ends = starts + numpy.array([max(global_addrs[self.globals[i]][1], 1)
+                                     for i in cols], dtype=numpy.int64)
+        for comp, intervals in get_whitelist_intervals(whitelist).items():
+            row = self.comp_idx.get(comp)
+            if row is not None:
+                whitelisted[row, cols] = intervals.overlaps(starts, ends)
+        return whitelisted
+
+    def get_exposure(self, whitelisted=None):
+        '''
+            Gets which compartments can write each global, privileged
+            compartments can write everything.
+            Returns:
+            exposed: bool matrix like incidence
+            exposed_instrs, exposed_strs: arrays indexed by global, the
+                number of instructions (stores) that can write the global
+        '''
+        exposed = self.incidence | self.priv[:, numpy.newaxis]
+        if whitelisted is not None:
+            exposed = exposed | whitelisted
+        exposed_instrs = self.num_instr.dot(exposed)
+        exposed_strs = self.num_strs.dot(exposed)
+        return exposed, exposed_instrs, exposed_strs
+
+    def get_exposed_functions(self, exposed):
+        '''
+            Gets the set of functions that can write each global.  Globals
+            exposed to the same compartments share one set.
+            Returns: [set(functions), ...] indexed by global
+        '''
+        funct_sets = {}
+        result = []
+        for col in exposed.T:
+            comps = tuple(numpy.flatnonzero(col))
+            if not funct_sets.has_key(comps):
+                functs = set()
+                for i in comps:
+                    functs.update(self.comp_stats[self.comps[i]]['FUNCTIONS'])
+                funct_sets[comps] = functs
+            result.append(funct_sets[comps])
+        return result
@@ -3,23 +3,120 @@ supported devices
 '''
 from key_defs import *
 import networkx as nx
+import numpy
+import bisect
+import os
+import json
+import hashlib
+import tempfile
+import cPickle
 
 EXCLUDE = "EXCLUDE"
+TREE_INDEX = "TREE_INDEX"
 
+# Change when build_mpu_region_tree changes, to invalidate cached trees
+DEVICE_CACHE_VERSION = 1
+CACHE_DIR_ENV = 'HEXBOX_DEVICE_CACHE_DIR'
 
-def get_device_desc(device_name):
+# {(device_name, includes): (desc, T)}
+_devices = {}
+# {(device_name, includes): set(cache_dirs T is saved in)}
+_cache_dirs = {}
 
-    peripherals = DEVICE_DEFS[device_name][PERIPHERAL_KEY]
-    for p in peripherals:
-        p[TYPE_KEY] = PERIPHERAL_NODE_TYPE
 
+def get_includes(device_name):
+    '''
+        Returns the names of the devices device_name includes, directly or
+        through other includes
+    '''
+    includes = []
     for inc in DEVICE_DEFS[device_name][INCLUDE_KEY]:
-        desc, T = get_device_desc(inc)
-        peripherals.extend(desc)
-    desc = sorted(peripherals, key=lambda k: k[BASE_ADDR_KEY])
+        includes.append(inc)
+        includes.extend(get_includes(inc))
+    return tuple(includes)
+
+
+def get_peripherals(device_name):
+    '''
+        Returns copies of the peripherals of device_name and the devices it
+        includes, DEVICE_DEFS is not changed
+    '''
+    peripherals = []
+    for p in DEVICE_DEFS[device_name][PERIPHERAL_KEY]:
+        p = dict(p)
+        p[TYPE_KEY] = PERIPHERAL_NODE_TYPE
+        peripherals.append(p)
+    for inc in DEVICE_DEFS[device_name][INCLUDE_KEY]:
+        peripherals.extend(get_peripherals(inc))
+    return peripherals
+
+
+def get_device_desc(device_name, cache_dir=None):
+    '''
+        Returns (desc, T) for device_name, desc is a tuple of its
+        peripherals sorted by base address and T its MPU region tree.
+        Both are built once per process and shared by all callers, so
+        neither may be modified.  If cache_dir (or $HEXBOX_DEVICE_CACHE_DIR)
+        is given T is also loaded from or saved there, keyed by a hash of
+        desc.
+    '''
+    key = (device_name, get_includes(device_name))
+    if cache_dir is None:
+        cache_dir = os.environ.get(CACHE_DIR_ENV)
+    if not _devices.has_key(key):
+        desc = tuple(sorted(get_peripherals(device_name),
+                            key=lambda k: k[BASE_ADDR_KEY]))
+        T = None
+        _cache_dirs[key] = set()
+        if cache_dir:
+            T = _load_tree(_tree_filename(device_name, desc, cache_dir))
+        if T is None:
+            T = build_mpu_region_tree(desc)
+        else:
+            _cache_dirs[key].add(cache_dir)
+        _devices[key] = (desc, T)
+    desc, T = _devices[key]
+    if cache_dir and cache_dir not in _cache_dirs[key]:
+        _save_tree(T, _tree_filename(device_name, desc, cache_dir))
+        _cache_dirs[key].add(cache_dir)
+    return _devices[key]
+
+
+def _tree_filename(device_name, desc, cache_dir):
+    digest = hashlib.sha1(json.dumps([DEVICE_CACHE_VERSION, desc],
+                                     sort_keys=True)).hexdigest()
+    return os.path.join(cache_dir, device_name + '-' + digest + '.pkl')
+
+
+def _load_tree(filename):
+    '''
+        Returns the tree saved in filename, or None if there is none or it
+        cannot be loaded (e.g. it was pickled by another networkx or Python
+        build), in which case it is rebuilt
+    '''
+    try:
+        with open(filename, 'rb') as infile:
+            return cPickle.load(infile)
+    except Exception:
+        return None
 
-    T = build_mpu_region_tree(desc)
-    return (desc, T)
+
+def _save_tree(T, filename):
+    '''
+        Saves T to filename.  Written to a temporary file and renamed into
+        place so readers running in parallel never see a partial file
+    '''
+    cache_dir = os.path.dirname(filename)
+    try:
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        fd, tmp_name = tempfile.mkstemp(suffix='.pkl', dir=cache_dir)
+        with os.fdopen(fd, 'wb') as outfile:
+            cPickle.dump(T, outfile, cPickle.HIGHEST_PROTOCOL)
+        os.chmod(tmp_name, 0644)
+        os.rename(tmp_name, filename)
+    except (IOError, OSError):
+        print "WARNING: Unable to write device cache to", cache_dir
 
 
 def get_peripheral_dict(device_desc, base_addr,size):
@@ -30,6 +127,65 @@ def get_peripheral_dict(device_desc, base_addr,size):
     return None
 
 
+class PeripheralIndex(object):
+    '''
+        Finds the peripheral of a device description covering an address,
+        giving the same answer as get_peripheral_dict.  Where peripherals
+        overlap the first in device_desc (lowest base address) is used.
+
+        The address space is split into disjoint intervals with a single
+        peripheral, starts and ends are the first and last address of each
+        interval and owners the peripheral dict
+    '''
+    def __init__(self, device_desc):
+        bounds = set()
+        for device in device_desc:
+            bounds.add(device[BASE_ADDR_KEY])
+            bounds.add(device[END_ADDR_KEY] + 1)
+        bounds = sorted(bounds)
+        self.starts = []
+        self.ends = []
+        self.owners = []
+        for start, end in zip(bounds[:-1], bounds[1:]):
+            owner = None
+            for device in device_desc:
+                if device[BASE_ADDR_KEY] <= start and \
+                   device[END_ADDR_KEY] >= end - 1:
+                    owner = device
+                    break
+            if owner is None:
+                continue
+            if self.owners and self.owners[-1] is owner and \
+               self.ends[-1] == start - 1:
+                self.ends[-1] = end - 1
+            else:
+                self.starts.append(start)
+                self.ends.append(end - 1)
+                self.owners.append(owner)
+        self.start_array = numpy.array(self.starts, dtype=numpy.int64)
+        self.end_array = numpy.array(self.ends, dtype=numpy.int64)
+
+    def lookup(self, addr):
+        '''
+            Returns the peripheral dict covering addr, or None
+        '''
+        i = bisect.bisect_right(self.starts, addr) - 1
+        if i >= 0 and addr <= self.ends[i]:
+            return self.owners[i]
+        return None
+
+    def lookup_many(self, addrs):
+        '''
+            Returns the peripheral dict (or None) covering each of addrs
+        '''
+        addrs = numpy.asarray(addrs, dtype=numpy.int64)
+        idx = numpy.searchsorted(self.start_array, addrs, side='right') - 1
+        found = idx >= 0
+        found[found] = addrs[found] <= self.end_array[idx[found]]
+        return [self.owners[i] if f else None
+                for (i, f) in zip(idx.tolist(), found.tolist())]
+
+
 def next_power_2(size):
     return 1 << (size - 1).bit_length()
 
@@ -114,26 +270,140 @@ def remove_prohibited_merges(T):
         T.remove_node(node)
 
 
+class MPUTreeIndex(object):
+    '''
+        Answers ancestry queries on an MPU region tree (or forest) without
+        walking it.  Built once by build_mpu_region_tree, the tree must not
+        change afterwards.
+
+        ids:      node name -> id, ids are in DFS preorder
+        parent:   parent id of each node, -1 for roots
+        root:     id of the root of each node's tree
+        depth:    distance of each node from its root
+        exit:     end of each node's subtree in preorder, c is under p iff
+                  p <= c < exit[p]
+        up:       up[k][v] is the 2**k th ancestor of v (or its root)
+        leaves:   frozenset of the leaves under each node
+        leaf_bit: bit of each leaf (peripheral) in the leaf masks
+        leaf_mask:  int with the bits of the leaves under each node
+    '''
+    def __init__(self, T):
+        self.names = []
+        self.ids = {}
+        self.parent = []
+        self.root = []
+        self.depth = []
+        self.exit = []
+        children = []
+        roots = sorted(n for n in T.nodes_iter() if T.in_degree(n) == 0)
+        for r in roots:
+            stack = [(r, -1)]
+            while stack:
+                node, parent = stack.pop()
+                i = len(self.names)
+                self.names.append(node)
+                self.ids[node] = i
+                self.parent.append(parent)
+                children.append([])
+                if parent == -1:
+                    self.root.append(i)
+                    self.depth.append(0)
+                else:
+                    children[parent].append(i)
+                    self.root.append(self.root[parent])
+                    self.depth.append(self.depth[parent] + 1)
+                self.exit.append(None)
+                for s in sorted(T.successors_iter(node), reverse=True):
+                    stack.append((s, i))
+
+        num_nodes = len(self.names)
+        leaves = [None] * num_nodes
+        masks = [0] * num_nodes
+        self.leaf_bit = {}
+        # Children come after their parent in preorder
+        for i in reversed(xrange(num_nodes)):
+            if children[i]:
+                self.exit[i] = max(self.exit[c] for c in children[i])
+                leaves[i] = frozenset().union(*[leaves[c]
+                                                for c in children[i]])
+                for c in children[i]:
+                    masks[i] |= masks[c]
+            else:
+                self.exit[i] = i + 1
+                leaves[i] = frozenset([self.names[i]])
+                masks[i] = 1 << len(self.leaf_bit)
+                self.leaf_bit[self.names[i]] = masks[i]
+        self.leaves = dict(zip(self.names, leaves))
+        self.leaf_mask = dict(zip(self.names, masks))
+
+        self.up = [[p if p != -1 else i for (i, p) in enumerate(self.parent)]]
+        max_depth = max(self.depth) if self.depth else 0
+        while (1 << len(self.up)) <= max_depth:
+            prev = self.up[-1]
+            self.up.append([prev[prev[i]] for i in xrange(num_nodes)])
+
+    def is_ancestor(self, p, c):
+        '''
+            True if node c is p or under p
+        '''
+        p = self.ids[p]
+        c = self.ids[c]
+        return p <= c < self.exit[p]
+
+    def lca(self, n1, n2):
+        '''
+            Returns the lowest common ancestor of n1 and n2, or None if they
+            are in different trees
+        '''
+        a = self.ids[n1]
+        b = self.ids[n2]
+        if self.root[a] != self.root[b]:
+            return None
+        if self.depth[a] < self.depth[b]:
+            a, b = b, a
+        diff = self.depth[a] - self.depth[b]
+        k = 0
+        while diff:
+            if diff & 1:
+                a = self.up[k][a]
+            diff >>= 1
+            k += 1
+        if a != b:
+            for k in reversed(xrange(len(self.up))):
+                if self.up[k][a] != self.up[k][b]:
+                    a = self.up[k][a]
+                    b = self.up[k][b]
+            a = self.parent[a]
+        return self.names[a]
+
+    def is_root(self, n):
+        return self.parent[self.ids[n]] == -1
+
+
+def get_tree_index(T):
+    '''
+        Returns the MPUTreeIndex of T, building it if T did not come from
+        build_mpu_region_tree
+    '''
+    if not T.graph.has_key(TREE_INDEX):
+        T.graph[TREE_INDEX] = MPUTreeIndex(T)
+    return T.graph[TREE_INDEX]
+
+
 def get_nearest_common_ancestor(T, n1, n2):
-    Undirected_T = T.to_undirected()
-    try:
-        path = nx.shortest_path(Undirected_T, n1, n2)
-        for n in path:
-            for p in T.predecessors(n):
-                # The MPU region that covers p1,p2 is the node with no parent
-                #on the path, i.e. nearest ancestor
-                if not (p in path):
-                    return n
-    except nx.exception.NetworkXNoPath:
+    '''
+        Returns the smallest MPU region covering n1 and n2, or None if they
+        are in different trees or only a root covers them
+    '''
+    index = get_tree_index(T)
+    ancestor = index.lca(n1, n2)
+    if ancestor is None or index.is_root(ancestor):
         return None
+    return ancestor
 
 
 def is_child(T, p, c):
-    try:
-        path = nx.shortest_path(T, p, c)
-        return True
-    except nx.exception.NetworkXNoPath:
-        return False
+    return get_tree_index(T).is_ancestor(p, c)
 
 
 def get_covered_peripherals(T, n1, n2=None):
@@ -150,13 +420,32 @@ def get_covered_peripherals(T, n1, n2=None):
 
 
 def get_leaves(T, node):
-    successor_list = T.successors(node)
-    leaves = set()
-    if len(successor_list) == 0:
-        leaves.add(node)
-    for s in T.successors(node):
-        leaves.update(get_leaves(T, s))
-    return leaves
+    '''
+        Returns the leaves under node as a frozenset
+    '''
+    return get_tree_index(T).leaves[node]
+
+
+def get_leaf_mask(T, node):
+    '''
+        Returns the leaves under node as a bitmask
+    '''
+    return get_tree_index(T).leaf_mask[node]
+
+
+def get_peripheral_mask(T, peripherals):
+    '''
+        Returns the bitmask of the given peripherals (leaves of T)
+    '''
+    leaf_bit = get_tree_index(T).leaf_bit
+    mask = 0
+    for p in peripherals:
+        mask |= leaf_bit[p]
+    return mask
+
+
+def count_bits(mask):
+    return bin(mask).count('1')
 
 
 def build_mpu_region_tree(devices_desc):
@@ -167,13 +456,15 @@ def build_mpu_region_tree(devices_desc):
         the region can be found by getting all the leaves of a node
 
         In additon the minimal covering of a two peripherals can be found by
-        finding their common ancestor, and counting it leaves
+        finding their common ancestor, and counting it leaves.  These are
+        answered by an MPUTreeIndex stored in T.graph[TREE_INDEX], and each
+        MPU region node has the bitmask of its leaves in KEY_LEAF_MASK
     '''
     T = nx.DiGraph()
     root_name, root_attrs = get_mpu_regions_root()
     T.add_node(root_name, root_attrs)
     for p in devices_desc:
-        T.add_node(p[NAME_KEY], p)
+        T.add_node(p[NAME_KEY], dict(p))
         pwr2size = next_power_2_pwr(p[END_ADDR_KEY] - p[BASE_ADDR_KEY] + 1)
         start_addr = p[BASE_ADDR_KEY] & ~(2**pwr2size - 1)
         if p[BASE_ADDR_KEY] & (2**pwr2size - 1):
@@ -189,6 +480,11 @@ def build_mpu_region_tree(devices_desc):
             simplifiy_mpu_region_tree(T, node)
     add_privilege_flags(T, devices_desc)
     #  nx.drawing.nx_pydot.write_dot(T,"mpu_simplified_map.dot")
+    index = MPUTreeIndex(T)
+    T.graph[TREE_INDEX] = index
+    for node, attrs in T.nodes_iter(data=True):
+        if attrs[TYPE_KEY] == PERIPHERAL_REGION_KEY:
+            attrs[KEY_LEAF_MASK] = index.leaf_mask[node]
     return T
 
 DEVICE_DEFS = {
@@ -0,0 +1,70 @@
+'''
+    Writes networkx graphs as Graphviz DOT text directly, rather than
+    building a pydot graph first.  Nodes and edges are styled by their Type
+    attribute, the rest of their attributes are written as is.
+'''
+
+
+def quote(value):
+    '''
+        Returns value as a quoted DOT string
+    '''
+    if not isinstance(value, basestring):
+        value = str(value)
+    value = value.replace('\\', '\\\\').replace('"', '\\"')
+    value = value.replace('\n', '\\n')
+    return '"%s"' % value
+
+
+def format_attrs(attrs):
+    if not attrs:
+        return ''
+    items = ['%s=%s' % (quote(k), quote(v)) for (k, v) in attrs.items()]
+    return ' [' + ', '.join(items) + ']'
+
+
+def _styled(attrs, styles, type_key):
+    '''
+        Returns the style of attrs's type (styles[attrs[type_key]]) with
+        attrs added to it
+    '''
+    if not styles or not attrs.has_key(type_key):
+        return attrs
+    style = styles.get(attrs[type_key])
+    if not style:
+        return attrs
+    styled = dict(style)
+    styled.update(attrs)
+    return styled
+
+
+def write_dot(G, filename, node_styles=None, edge_styles=None,
+              default_node_attrs=None, type_key='Type'):
+    '''
+        Writes G to filename in DOT format
+        Inputs:
+            G:            networkx graph
+            node_styles:  {type: {dot attribute: value}} added to each node
+                          with that type
+            edge_styles:  same for edges
+            default_node_attrs:  {dot attribute: value} for all nodes
+    '''
+    if G.is_directed():
+        graph_type, edge_op = 'digraph', '->'
+    else:
+        graph_type, edge_op = 'graph', '--'
+    with open(filename, 'wb') as outfile:
+        outfile.write('strict %s {\n' % graph_type)
+        if default_node_attrs:
+            outfile.write('node%s;\n' % format_attrs(default_node_attrs))
+        for n, attrs in G.nodes_iter(data=True):
+            line = '%s%s;\n' % (quote(n),
+                                format_attrs(_styled(attrs, node_styles,
+                                                     type_key)))
+            outfile.write(line.encode('utf-8'))
+        for u, v, attrs in G.edges_iter(data=True):
+            line = '%s %s %s%s;\n' % (quote(u), edge_op, quote(v),
+                                      format_attrs(_styled(attrs, edge_styles,
+                                                           type_key)))
+            outfile.write(line.encode('utf-8'))
+        outfile.write('}\n')
@@ -0,0 +1,227 @@
+'''
+    Content addressed cache of the per ELF artifacts used by the
+    graph_analysis tools (section sizes, symbol table, and per function
+    instruction statistics).  Entries are keyed by the SHA-1 of the ELF's
+    contents and stored as compressed .npz files, one per ELF and group
+    of keys, so repeated and parallel runs on the same binary only read
+    and scan it once.  The file names include CACHE_VERSION, so entries
+    computed differently are not reused.
+
+    The cache is shared by every application under $HEXBOX_ELF_CACHE_DIR,
+    or ~/.cache/hexbox/elf_cache ($XDG_CACHE_HOME/hexbox/elf_cache), and
+    keeps the MAX_CACHE_FILES most recently used files.
+'''
+import os
+import hashlib
+import tempfile
+import numpy
+import elf_reader
+import thumb_scan
+
+CACHE_DIR_ENV = 'HEXBOX_ELF_CACHE_DIR'
+MAX_CACHE_FILES = 512
+
+# Increase when how an entry is computed changes
+#   1: fn_num_instr and fn_num_strs from thumb_scan instead of objdump
+#   2: MCRR and VMOV to two registers are not stores
+CACHE_VERSION = 2
+
+SECTION_KEYS = ['sec_names', 'sec_addr', 'sec_size', 'sec_type',
+                'sec_flags', 'sec_offset']
+SYMBOL_KEYS = ['sym_names', 'sym_addr', 'sym_size', 'sym_type',
+               'sym_section']
+FUNCTION_KEYS = ['fn_names', 'fn_sections', 'fn_num_bytes', 'fn_num_instr',
+                 'fn_num_strs', 'metadata_size']
+
+# {(path, mtime, size): digest}
+_digests = {}
+# {(digest, group): {key: array}}
+_entries = {}
+
+
+def get_cache_dir():
+    cache_dir = os.environ.get(CACHE_DIR_ENV)
+    if cache_dir:
+        return cache_dir
+    cache_home = os.environ.get('XDG_CACHE_HOME',
+                                os.path.join(os.path.expanduser('~'),
+                                             '.cache'))
+    return os.path.join(cache_home, 'hexbox', 'elf_cache')
+
+
+def get_digest(elf_file):
+    '''
+        Gets the SHA-1 of the contents of elf_file, remembering it for the
+        life of the process as long as the file is unchanged
+    '''
+    stat = os.stat(elf_file)
+    key = (os.path.abspath(elf_file), stat.st_mtime, stat.st_size)
+    if not _digests.has_key(key):
+        sha = hashlib.sha1()
+        with open(elf_file, 'rb') as infile:
+            for chunk in iter(lambda: infile.read(1 << 20), ''):
+                sha.update(chunk)
+        _digests[key] = sha.hexdigest()
+    return _digests[key]
+
+
+def _entry_filename(digest, group):
+    return os.path.join(get_cache_dir(),
+                        '%s-v%i-%s.npz' % (digest, CACHE_VERSION, group))
+
+
+def _load_entry(digest, group):
+    if _entries.has_key((digest, group)):
+        return _entries[(digest, group)]
+    entry = {}
+    filename = _entry_filename(digest, group)
+    try:
+        with numpy.load(filename) as data:
+            for key in data.files:
+                entry[key] = data[key]
+        os.utime(filename, None)  # Most recently used, see _prune
+    except (IOError, OSError, ValueError):
+        pass  # Not cached yet, or a partial file from an older version
+    _entries[(digest, group)] = entry
+    return entry
+
+
+def _save_entry(digest, group, entry):
+    '''
+        Writes the entry to a temporary file and renames it into place so
+        readers running in parallel never see a partial file.  Each group
+        of keys has its own file, so processes filling different groups
+        of the same ELF do not drop each other's keys.
+    '''
+    cache_dir = get_cache_dir()
+    try:
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        fd, tmp_name = tempfile.mkstemp(prefix='.', suffix='.npz',
+                                        dir=cache_dir)
+        with os.fdopen(fd, 'wb') as outfile:
+            numpy.savez_compressed(outfile, **entry)
+        os.chmod(tmp_name, 0644)
+        os.rename(tmp_name, _entry_filename(digest, group))
+        _prune(cache_dir)
+    except (IOError, OSError):
+        print "WARNING: Unable to write ELF cache to", cache_dir
+
+
+def _prune(cache_dir):
+    '''
+        Removes the entries of other CACHE_VERSIONs and, past
+        MAX_CACHE_FILES, the least recently used ones
+    '''
+    suffix = '-v%i-' % CACHE_VERSION
+    entries = []
+    for name in os.listdir(cache_dir):
+        if name.startswith('.') or not name.endswith('.npz'):
+            continue
+        filename = os.path.join(cache_dir, name)
+        try:
+            if suffix not in name:
+                os.remove(filename)
+            else:
+                entries.append((os.path.getmtime(filename), filename))
+        except OSError:
+            pass  # Removed by another process
+    entries.sort()
+    for _, filename in entries[:-MAX_CACHE_FILES]:
+        try:
+            os.remove(filename)
+        except OSError:
+            pass
+
+
+def _str_array(strings):
+    if len(strings) == 0:
+        return numpy.zeros(0, dtype='S1')
+    return numpy.array(strings)
+
+
+def _get_entry(elf_file, group, keys, fill):
+    digest = get_digest(elf_file)
+    entry = _load_entry(digest, group)
+    missing = [k for k in keys if not entry.has_key(k)]
+    if missing:
+        entry.update(fill(elf_file))
+        _save_entry(digest, group, entry)
+    return entry
+
+
+def _read_elf(elf_file):
+    with elf_reader.ElfFile(elf_file) as elf:
+        sections = elf.sections
+        symbols = elf.symbols
+    return {'sec_names': _str_array(sections.names),
+            'sec_addr': sections.addr, 'sec_size': sections.size,
+            'sec_type': sections.type, 'sec_flags': sections.flags,
+            'sec_offset': sections.offset,
+            'sym_names': _str_array(symbols.names),
+            'sym_addr': symbols.addr, 'sym_size': symbols.size,
+            'sym_type': symbols.type, 'sym_section': symbols.section}
+
+
+def _get_sections(entry):
+    headers = {'addr': entry['sec_addr'], 'size': entry['sec_size'],
+               'type': entry['sec_type'], 'flags': entry['sec_flags'],
+               'offset': entry['sec_offset']}
+    return elf_reader.Sections(entry['sec_names'].tolist(), headers)
+
+
+def get_sections(elf_file):
+    '''
+        Returns the elf_reader.Sections of elf_file
+    '''
+    entry = _get_entry(elf_file, 'elf', SECTION_KEYS, _read_elf)
+    return _get_sections(entry)
+
+
+def get_section_list(elf_file):
+    '''
+        Same as elf_reader.get_section_list, using the cache
+    '''
+    return elf_reader.get_reported_sections(get_sections(elf_file))
+
+
+def get_symbols(elf_file):
+    '''
+        Returns the elf_reader.SymbolTable of elf_file
+    '''
+    entry = _get_entry(elf_file, 'elf', SECTION_KEYS + SYMBOL_KEYS,
+                       _read_elf)
+    return elf_reader.SymbolTable(entry['sym_names'].tolist(),
+                                  entry['sym_addr'], entry['sym_size'],
+                                  entry['sym_type'], entry['sym_section'],
+                                  _get_sections(entry))
+
+
+def _read_functions(elf_file):
+    symbols = get_symbols(elf_file)
+    functs = thumb_scan.get_function_list(elf_file, symbols)
+    return {'fn_names': _str_array([f[0] for f in functs]),
+            'fn_sections': _str_array([f[1] for f in functs]),
+            'fn_num_bytes': numpy.array([f[2] for f in functs],
+                                        dtype=numpy.int64),
+            'fn_num_instr': numpy.array([f[3] for f in functs],
+                                        dtype=numpy.int64),
+            'fn_num_strs': numpy.array([f[4] for f in functs],
+                                       dtype=numpy.int64),
+            'metadata_size': numpy.array(
+                thumb_scan.get_metadata_size(symbols))}
+
+
+def get_function_table(elf_file):
+    '''
+        Gets the statistics for every function of elf_file, see
+        thumb_scan.build_function_table
+    '''
+    entry = _get_entry(elf_file, 'functions', FUNCTION_KEYS,
+                       _read_functions)
+    functs = zip(entry['fn_names'].tolist(), entry['fn_sections'].tolist(),
+                 entry['fn_num_bytes'].tolist(),
+                 entry['fn_num_instr'].tolist(),
+                 entry['fn_num_strs'].tolist())
+    return thumb_scan.build_function_table(functs,
+                                           int(entry['metadata_size']))
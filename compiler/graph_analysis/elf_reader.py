@@ -0,0 +1,275 @@
+'''
+    Small ELF32 reader that reads the section headers and .symtab of an ELF
+    directly from a memory map of the file.  This is used in place of
+    running arm-none-eabi-size and arm-none-eabi-objdump -t and parsing
+    their text output.
+'''
+import mmap
+import struct
+import numpy
+
+ELF_MAGIC = '\x7fELF'
+ELFCLASS32 = 1
+ELFDATA2LSB = 1
+EM_ARM = 40
+
+# Section header types
+SHT_NULL = 0
+SHT_SYMTAB = 2
+SHT_STRTAB = 3
+SHT_RELA = 4
+SHT_NOBITS = 8
+SHT_REL = 9
+
+# Section header flags
+SHF_ALLOC = 0x2
+SHF_EXECINSTR = 0x4
+
+SHN_UNDEF = 0
+SHN_LORESERVE = 0xff00
+SHN_ABS = 0xfff1
+
+# Symbol types
+STT_NOTYPE = 0
+STT_OBJECT = 1
+STT_FUNC = 2
+STT_SECTION = 3
+STT_FILE = 4
+
+ELF_HEADER_FMT = '<16sHHIIIIIHHHHHH'
+
+SECTION_DTYPE = numpy.dtype([('name', '<u4'), ('type', '<u4'),
+                             ('flags', '<u4'), ('addr', '<u4'),
+                             ('offset', '<u4'), ('size', '<u4'),
+                             ('link', '<u4'), ('info', '<u4'),
+                             ('addralign', '<u4'), ('entsize', '<u4')])
+
+SYMBOL_DTYPE = numpy.dtype([('name', '<u4'), ('value', '<u4'),
+                            ('size', '<u4'), ('info', 'u1'),
+                            ('other', 'u1'), ('shndx', '<u2')])
+
+# Sections that arm-none-eabi-size -A does not report
+NON_REPORTED_SECTION_TYPES = [SHT_NULL, SHT_SYMTAB, SHT_STRTAB, SHT_REL,
+                              SHT_RELA]
+
+
+class Sections(object):
+    '''
+        Section headers of an ELF
+        names: list of section names, indexed by section number
+        addr, size, type, flags, offset: numpy arrays indexed by section number
+    '''
+    def __init__(self, names, headers):
+        self.names = names
+        self.addr = headers['addr']
+        self.size = headers['size']
+        self.type = headers['type']
+        self.flags = headers['flags']
+        self.offset = headers['offset']
+        self._name_to_idx = {}
+        for i, name in enumerate(names):
+            if not self._name_to_idx.has_key(name):
+                self._name_to_idx[name] = i
+
+    def __len__(self):
+        return len(self.names)
+
+    def index(self, name):
+        '''
+            Returns the index of the section named name, or None
+        '''
+        return self._name_to_idx.get(name)
+
+    def get_name(self, idx):
+        if idx < len(self.names):
+            return self.names[idx]
+        elif idx == SHN_ABS:
+            return '*ABS*'
+        return '*UND*'
+
+
+class SymbolTable(object):
+    '''
+        Symbols from .symtab, as parallel arrays
+        names: list of symbol names
+        addr, size, type, section: numpy arrays, section is the index of the
+        section containing the symbol (see Sections)
+    '''
+    def __init__(self, names, addr, size, sym_type, section, sections):
+        self.names = names
+        self.addr = addr
+        self.size = size
+        self.type = sym_type
+        self.section = section
+        self.sections = sections
+
+    def __len__(self):
+        return len(self.names)
+
+    def section_name(self, i):
+        return self.sections.get_name(int(self.section[i]))
+
+    def functions(self):
+        '''
+            Returns the indices of all function symbols
+        '''
+        return numpy.flatnonzero(self.type == STT_FUNC)
+
+
+class ElfFile(object):
+    '''
+        Memory mapped ELF32 file.  Use as a context manager or call close()
+    '''
+    def __init__(self, filename):
+        self.filename = filename
+        self._fd = open(filename, 'rb')
+        self._mm = mmap.mmap(self._fd.fileno(), 0, access=mmap.ACCESS_READ)
+        self._headers = None
+        self._sections = None
+        self._symbols = None
+        self._read_header()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        self._mm.close()
+        self._fd.close()
+
+    def _read_header(self):
+        header = struct.unpack_from(ELF_HEADER_FMT, self._mm, 0)
+        ident = header[0]
+        if ident[0:4] != ELF_MAGIC:
+            raise ValueError("Not an ELF file: %s" % self.filename)
+        if ord(ident[4]) != ELFCLASS32 or ord(ident[5]) != ELFDATA2LSB:
+            raise ValueError("Only little endian ELF32 is supported: %s" %
+                             self.filename)
+        self.machine = header[2]
+        self.shoff = header[6]
+        self.shentsize = header[11]
+        self.shnum = header[12]
+        self.shstrndx = header[13]
+
+    def _read_array(self, offset, count, dtype):
+        return numpy.frombuffer(self._mm, dtype=dtype, count=count,
+                                offset=offset).copy()
+
+    def _read_strtab(self, header):
+        start = int(header['offset'])
+        return self._mm[start:start + int(header['size'])]
+
+    @staticmethod
+    def _get_str(strtab, offset):
+        end = strtab.find('\0', offset)
+        if end < 0:
+            end = len(strtab)
+        return strtab[offset:end]
+
+    @property
+    def sections(self):
+        if self._sections is None:
+            if self.shentsize != SECTION_DTYPE.itemsize:
+                raise ValueError("Unexpected section header size in %s" %
+                                 self.filename)
+            self._headers = self._read_array(self.shoff, self.shnum,
+                                             SECTION_DTYPE)
+            shstrtab = self._read_strtab(self._headers[self.shstrndx])
+            names = [self._get_str(shstrtab, int(n))
+                     for n in self._headers['name']]
+            self._sections = Sections(names, self._headers)
+        return self._sections
+
+    def section_data(self, name):
+        '''
+            Returns the contents of section name as a numpy uint8 array, or
+            None if the section is not in the file or has no contents
+        '''
+        sections = self.sections
+        idx = sections.index(name)
+        if idx is None or sections.type[idx] == SHT_NOBITS:
+            return None
+        return self._read_array(int(sections.offset[idx]),
+                                int(sections.size[idx]), numpy.uint8)
+
+    def read(self, addr, size):
+        '''
+            Returns the size bytes at address addr as a string, or None if
+            they are not all in the contents of one allocated section
+        '''
+        sections = self.sections
+        for idx in xrange(len(sections)):
+            start = int(sections.addr[idx])
+            if not sections.flags[idx] & SHF_ALLOC or \
+                    sections.type[idx] == SHT_NOBITS or \
+                    addr < start or \
+                    addr + size > start + int(sections.size[idx]):
+                continue
+            offset = int(sections.offset[idx]) + addr - start
+            return self._mm[offset:offset + size]
+        return None
+
+    @property
+    def symbols(self):
+        if self._symbols is None:
+            self._symbols = self._read_symbols()
+        return self._symbols
+
+    def _read_symbols(self):
+        sections = self.sections
+        symtab_idx = numpy.flatnonzero(sections.type == SHT_SYMTAB)
+        if len(symtab_idx) == 0:
+            empty = numpy.zeros(0, dtype=numpy.uint32)
+            return SymbolTable([], empty, empty, empty.astype(numpy.uint8),
+                               empty.astype(numpy.uint16), sections)
+        symtab = self._headers[symtab_idx[0]]
+        strtab = self._read_strtab(self._headers[symtab['link']])
+        count = int(symtab['size']) // SYMBOL_DTYPE.itemsize
+        raw = self._read_array(int(symtab['offset']), count, SYMBOL_DTYPE)
+        # Skip the null symbol at index 0
+        raw = raw[1:]
+        sym_type = raw['info'] & 0xF
+        section = raw['shndx']
+        addr = raw['value']
+        if self.machine == EM_ARM:
+            # Thumb functions have the low bit of their address set
+            addr = numpy.where(sym_type == STT_FUNC, addr & ~numpy.uint32(1),
+                               addr).astype(numpy.uint32)
+        names = []
+        for i, name_off in enumerate(raw['name']):
+            if sym_type[i] == STT_SECTION and section[i] < len(sections):
+                names.append(sections.names[section[i]])
+            else:
+                names.append(self._get_str(strtab, int(name_off)))
+        return SymbolTable(names, addr, raw['size'], sym_type, section,
+                           sections)
+
+
+def read_sections(filename):
+    with ElfFile(filename) as elf:
+        return elf.sections
+
+
+def read_symbols(filename):
+    with ElfFile(filename) as elf:
+        return elf.symbols
+
+
+def get_reported_sections(sections):
+    '''
+        Gets the sections that arm-none-eabi-size -A would report
+        returns [(name, size, addr), ...] in section header order
+    '''
+    section_list = []
+    for i in xrange(len(sections)):
+        if sections.type[i] in NON_REPORTED_SECTION_TYPES:
+            continue
+        section_list.append((sections.names[i], int(sections.size[i]),
+                             int(sections.addr[i])))
+    return section_list
+
+
+def get_section_list(filename):
+    return get_reported_sections(read_sections(filename))
@@ -0,0 +1,114 @@
+'''
+    Loads recorded counts of the stores each compartment made through the
+    emulator, for placing the most often emulated globals in MPU regions.
+
+    The counts are either
+
+    * A JSON file of {compartment: {global: count}}
+    * A dump of the emulator record buffers of a hexbox record binary, see
+      dump_mem in gdb_helpers.py (record_memory() saves it as
+      mem_accesses_<binary>.bin).  Each compartment's buffer holds the
+      address of its compartment struct, _hexbox_comp_<code region>, and
+      the ranges of words it stored to (see
+      memory_reader.parse_memory_recording).  The buffers do not count the
+      stores, so the count of a global is the number of its words the
+      compartment stored to.
+
+    A compartment is a code region of the policy the recording was made
+    with, which is read to get its functions, or else a function name.
+'''
+import collections
+import json
+import numpy
+import elf_cache
+import elf_reader
+import memory_reader
+from key_defs import *
+
+# COMP_EMULATOR_RECORD_SIZE in profiler.c
+RECORD_BUFFER_SIZE = 1024
+# Emulated stores are recorded a word at a time
+STORE_SIZE = 4
+# Name prefix of the compartment structs, see HexboxApplication.cpp
+COMP_SYMBOL_PREFIX = '_hexbox_comp_'
+
+
+def get_compartment_functions(policy_filename):
+    '''
+        Returns {code region: [functions]} of a policy file
+    '''
+    with open(policy_filename, 'rb') as infile:
+        policy = json.load(infile)
+    compartments = {}
+    for name, region in policy[POLICY_KEY_REGIONS].items():
+        if region[POLICY_REGION_KEY_TYPE] == "Code":
+            compartments[name] = region[POLICY_REGION_KEY_OBJECTS]
+    return compartments
+
+
+def get_recorded_stores(memory_filename, binary_filename,
+                        buffer_size=RECORD_BUFFER_SIZE):
+    '''
+        Converts a dump of the emulator record buffers to store counts
+        memory_filename: File from dump_mem in gdb_helpers.py
+        binary_filename: The recorded ELF
+        Returns: {compartment: {global: count}}, see the module docstring
+    '''
+    symbols = elf_cache.get_symbols(binary_filename)
+    comp_names = {}
+    for i in xrange(len(symbols)):
+        if symbols.names[i].startswith(COMP_SYMBOL_PREFIX):
+            comp_names[int(symbols.addr[i])] = \
+                symbols.names[i][len(COMP_SYMBOL_PREFIX):]
+    objs = numpy.flatnonzero((symbols.type == elf_reader.STT_OBJECT) &
+                             (symbols.size > 0))
+    starts = symbols.addr[objs].astype(numpy.int64)
+    ends = starts + symbols.size[objs]
+
+    data = collections.defaultdict(lambda: collections.defaultdict(int))
+    recording = memory_reader.parse_memory_recording(memory_filename,
+                                                     buffer_size)
+    for (_, comp_addr), accesses in sorted(recording.items()):
+        comp = comp_names.get(comp_addr)
+        if comp is None:
+            print "WARNING: No compartment at 0x%08x" % comp_addr
+            continue
+        for access in accesses:
+            overlap = numpy.minimum(ends, access.addr + access.size) - \
+                numpy.maximum(starts, access.addr)
+            for i in numpy.flatnonzero(overlap > 0):
+                words = (int(overlap[i]) + STORE_SIZE - 1) // STORE_SIZE
+                data[comp][symbols.names[objs[i]]] += words
+    return data
+
+
+def load_emulated_stores(stores_filename, policy_filename=None,
+                         binary_filename=None):
+    '''
+        Reads the emulated store counts, see the module docstring
+        stores_filename: JSON file of {compartment: {global: count}} or a
+                         dump of the record buffers
+        policy_filename: Policy the counts were recorded with
+        binary_filename: The recorded ELF, required for a memory dump
+        Returns: [(functions, global, count), ...], one per compartment
+                 and global, sorted
+    '''
+    compartments = {}
+    if policy_filename:
+        compartments = get_compartment_functions(policy_filename)
+    if stores_filename.endswith('.json'):
+        with open(stores_filename, 'rb') as infile:
+            data = json.load(infile)
+    elif binary_filename is None:
+        raise ValueError("The recorded binary is needed to read " +
+                         stores_filename)
+    else:
+        data = get_recorded_stores(stores_filename, binary_filename)
+    stores = []
+    for comp, counts in data.items():
+        functions = tuple(sorted(compartments.get(comp, [comp])))
+        for global_name, count in counts.items():
+            if count > 0:
+                stores.append((functions, global_name, count))
+    stores.sort()
+    return stores
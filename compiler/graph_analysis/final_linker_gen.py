@@ -1,11 +1,11 @@
 
 import json
-import subprocess
 import csv
 import operator
 import ld_helpers
 import pprint
 import mpu_helpers
+import elf_cache
 
 
 DEFAULT_RAM_SECTIONS = ['.data', '.bss', '._user_heap_stack',
@@ -35,20 +35,18 @@ RAM_SIZE = 128*1024
 ._user_heap_stack     1536   536872080
 '''
 
-def parse_size_data(size_output_str):
-    data=size_output_str.split('\n')
-    print data
+def build_size_data(section_list):
+    '''
+        section_list: [(name, size, addr), ...] as from
+                      elf_cache.get_section_list
+        returns: {name: {'size': int, 'addr': int}, ...}
+    '''
     size_data ={}
-    for line in data[2:]:# Skip first two lines
-        fields = line.split()
-        if len(fields) != 3:
-            break
-        name = fields[0]
+    for (name, size, addr) in section_list:
         if name.endswith("_bss"):
             name = name[:-4]
         elif name.endswith("_data"):
             name = name[:-5]
-        size = int(fields[1])
         if size >= 0:
             if size == 0:
                 size = 0
@@ -57,16 +55,13 @@ def parse_size_data(size_output_str):
             if size_data.has_key(name):
                 size_data[name]['size'] += size
             else:
-                size_data[name] = {'size':size,'addr':int(fields[2])}
+                size_data[name] = {'size':size,'addr':addr}
     return size_data
 
 
 def get_section_sizes(object_filename):
-    #arm-none-eabi-size -A -d bin/temp.obj
-    cmd =['arm-none-eabi-size', '-A','-d']
-    cmd.append(object_filename)
-    stdout = subprocess.check_output(cmd)
-    size_data = parse_size_data(stdout)
+    section_list = elf_cache.get_section_list(object_filename)
+    size_data = build_size_data(section_list)
     return size_data
 
 
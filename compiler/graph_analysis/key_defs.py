@@ -12,6 +12,11 @@ FUNCTION_TYPE = 'Function'
 FILENAME_TYPE = "Filename"
 GLOBAL_TYPE = "Global"
 TYPE_KEY = 'Type'
+LLVM_TYPE_KEY = 'LLVM_Type'
+ADDRESS_TAKEN_KEY = 'Address Taken'
+OBJ_SIZE_KEY = 'Size'
+COUNT_KEY = 'Count'
+LOOP_DEPTHS_KEY = 'Loop Depths'
 PERIPHERAL_NODE_TYPE = 'Peripheral'
 PERIPHERAL_EDGE_TYPE = PERIPHERAL_NODE_TYPE
 ALIAS_EDGE_TYPE = 'Alias'
@@ -29,6 +34,8 @@ MERGE_KEY = "MERGE_KEY"
 
 KEY_MPU_TREE_NAME = "MPU_TREE_NAME"
 KEY_REQUIRED_PERIPHERALS = "REQUIRED_PERIPHS"
+KEY_REQUIRED_MASK = "REQUIRED_MASK"
+KEY_LEAF_MASK = "LEAF_MASK"
 
 PRIV_KEY = "Priv"
 
@@ -2,8 +2,8 @@ import struct
 import collections
 import re
 import json
-import subprocess
 from binascii import hexlify
+import elf_cache
 
 '''
     Takes a recording of accesses that are from running the hexbox recording
@@ -62,12 +62,6 @@ class ObjdumpSymbol(object):
             return None
 
 
-def gen_symbol_file(elf_file):
-    cmd = ['arm-none-eabi-objdump', '-t', elf_file]
-    symbol_file = subprocess.check_output(cmd)
-    return symbol_file
-
-
 def write_comp_access_list(outfile, n, acl):
     '''
         Writes the access control list for the compartment
@@ -240,31 +234,18 @@ def parse_memory_recording(memory_filename, buffer_size):
 
 def parse_symbol_table(binary_filename):
     '''
-        Parses the symbol table output by
-        arm-none-eabi-objdump -t
+        Reads the symbol table of binary_filename
 
-        symbol_filename: filename of file output from arm-none-eabi-objdump -t
-        returns:  dict mapping addr to symbol name
+        binary_filename: ELF file to read the symbols from
+        returns:  list of ObjdumpSymbols
     '''
-    start_found = False
+    symbols = elf_cache.get_symbols(binary_filename)
     objdump_symbols = []
-    lines = gen_symbol_file(binary_filename)
-    for line in lines.split('\n'):
-        if not start_found:
-            if line == 'SYMBOL TABLE:':
-                start_found = True
-            continue
-        split = line.split(" ")
-        try:
-            addr = int(split[0].strip(), 16)
-            size = int(split[-2].split("\t")[-1].strip(), 16)
-            symbol_name = split[-1].strip()
-
-            sym = ObjdumpSymbol(addr, size, symbol_name)
-            objdump_symbols.append(sym)
-        except ValueError:
-            pass  # Catches empty newline at end of file, skips bad lines
-    
+    for i in xrange(len(symbols)):
+        sym = ObjdumpSymbol(int(symbols.addr[i]), int(symbols.size[i]),
+                            symbols.names[i])
+        objdump_symbols.append(sym)
+
     return objdump_symbols
 
 def get_access_control_list(binary, memory_file, buffer_size):
@@ -1,8 +1,28 @@
 
+import ld_helpers
+
 KB = 1024
 MB = 1024*KB
 GB = 1024*MB
 
+#Number of MPU regions reserved to set global permissions
+NUM_DEFAULT_MPU_REGIONS = 4
+
+# Smallest MPU region, the linker rounds smaller regions up to it (see
+# final_linker_gen.build_size_data)
+MIN_MPU_REGION_SIZE = 32
+
+
+def get_padding(size):
+    '''
+        Bytes a region of size is padded by to be an MPU region, a power of
+        2 of at least MIN_MPU_REGION_SIZE, empty regions are not padded
+    '''
+    if size == 0:
+        return 0
+    return max(MIN_MPU_REGION_SIZE, ld_helpers.next_power_2(size)) - size
+
+
 def encode_size(size):
     value = size
     if size == 0:
@@ -0,0 +1,478 @@
+'''
+    Compact program dependency graph for the partitioners.  Nodes are
+    identified by integer ids, their attributes are kept as numpy columns
+    (strings are interned) and the edges as CSR/CSC adjacency arrays, so
+    large PDGs take a fraction of the memory of a networkx graph and
+    traversals are array slices rather than dict lookups.
+
+    Conversion to and from networkx is provided for the debug .dot output
+    and for partitioners written against networkx.  networkx and devices
+    are only imported when needed, so tools that only read the PDG (e.g.
+    policy_cost.py) stay quick to start.
+'''
+import collections
+import copy
+import json
+import numpy
+import pdg_loader
+from key_defs import *
+
+MISSING = -1
+
+PDG_NODE_TYPES = [FUNCTION_TYPE, GLOBAL_TYPE, PERIPHERAL_NODE_TYPE]
+PDG_EDGE_TYPES = ['Callee', 'Indirect Call', DATA_EDGE_TYPE, ALIAS_EDGE_TYPE,
+                  PERIPHERAL_EDGE_TYPE]
+CALL_EDGE_TYPES = ['Callee', 'Indirect Call']
+
+# Each loop a call site is in multiplies its weight by this, see
+# CompactPDG.edge_weights
+DEFAULT_LOOP_SCALE = 1.0
+
+# {attribute: column}, values are interned strings
+STRING_COLUMNS = {TYPE_KEY: 'node_type',
+                  FILENAME_TYPE: 'filename',
+                  NAME_KEY: 'peripheral',
+                  LLVM_TYPE_KEY: 'llvm_type'}
+# {attribute: (column, dtype, python types)}
+INT_COLUMNS = {OBJ_SIZE_KEY: ('size', numpy.int64, (int, long)),
+               ADDRESS_TAKEN_KEY: ('address_taken', numpy.int8, (bool,))}
+
+NODE_COLUMNS = STRING_COLUMNS.values() + [c[0] for c in INT_COLUMNS.values()]
+EDGE_COLUMNS = ['edge_src', 'edge_dst', 'edge_type', 'edge_count',
+                'edge_loop_counts']
+
+
+class StringTable(object):
+    '''
+        Interns strings to ids, ids index strings
+    '''
+    def __init__(self):
+        self.strings = []
+        self.ids = {}
+
+    def intern(self, s):
+        i = self.ids.get(s)
+        if i is None:
+            i = len(self.strings)
+            self.ids[s] = i
+            self.strings.append(s)
+        return i
+
+    def get_id(self, s):
+        return self.ids.get(s, MISSING)
+
+    def lookup(self, i):
+        if i == MISSING:
+            return None
+        return self.strings[i]
+
+
+def _split_attrs(strings, attrs):
+    '''
+        Splits a node's attributes into its column values and the
+        attributes that have no column
+        Returns: ({column: value}, {attribute: value})
+    '''
+    values = {}
+    extra = {}
+    for key, value in attrs.items():
+        if STRING_COLUMNS.has_key(key) and isinstance(value, basestring):
+            values[STRING_COLUMNS[key]] = strings.intern(value)
+        elif INT_COLUMNS.has_key(key) and \
+                type(value) in INT_COLUMNS[key][2]:
+            values[INT_COLUMNS[key][0]] = int(value)
+        else:
+            extra[key] = value
+    return values, extra
+
+
+class PDGBuilder(object):
+    '''
+        Accumulates nodes and edges and builds a CompactPDG from them.
+        Edges may be added before their destination, edges to nodes that
+        are never added are dropped.
+    '''
+    def __init__(self):
+        self.strings = StringTable()
+        self.names = []
+        self.ids = {}
+        self.columns = dict((c, []) for c in NODE_COLUMNS)
+        self.extra = {}
+        self.edge_src = []
+        self.edge_dst = []
+        self.edge_type = []
+        self.edge_count = []
+        self.edge_loop_counts = []
+
+    def add_node(self, name, attrs):
+        if self.ids.has_key(name):
+            raise ValueError("Node %s added twice" % name)
+        node_id = len(self.names)
+        self.ids[name] = node_id
+        self.names.append(name)
+        values, extra = _split_attrs(self.strings, attrs)
+        for c in NODE_COLUMNS:
+            self.columns[c].append(values.get(c, MISSING))
+        if extra:
+            self.extra[node_id] = extra
+        return node_id
+
+    def add_edge(self, src, dest, attrs):
+        '''
+            src is the id of an added node, dest a node name
+        '''
+        self.edge_src.append(src)
+        self.edge_dst.append(dest)
+        edge_type = attrs.get(TYPE_KEY)
+        if edge_type is None:
+            self.edge_type.append(MISSING)
+        else:
+            self.edge_type.append(self.strings.intern(edge_type))
+        count = attrs.get(COUNT_KEY, MISSING)
+        self.edge_count.append(count)
+        # Call sites not in a loop have no Loop Depths
+        self.edge_loop_counts.append(attrs.get(LOOP_DEPTHS_KEY,
+                                               [max(count, 0)]))
+
+    def build(self):
+        columns = {}
+        for c in STRING_COLUMNS.values():
+            columns[c] = numpy.array(self.columns[c], dtype=numpy.int32)
+        for (c, dtype, _) in INT_COLUMNS.values():
+            columns[c] = numpy.array(self.columns[c], dtype=dtype)
+        dst = numpy.array([self.ids.get(d, MISSING) for d in self.edge_dst],
+                          dtype=numpy.int32)
+        keep = dst != MISSING
+        columns['edge_src'] = numpy.array(self.edge_src,
+                                          dtype=numpy.int32)[keep]
+        columns['edge_dst'] = dst[keep]
+        columns['edge_type'] = numpy.array(self.edge_type,
+                                           dtype=numpy.int32)[keep]
+        columns['edge_count'] = numpy.array(self.edge_count,
+                                            dtype=numpy.int64)[keep]
+        columns['edge_loop_counts'] = _loop_counts(self.edge_loop_counts)[keep]
+        return CompactPDG(self.names, self.strings, columns, self.extra)
+
+
+def _loop_counts(depth_counts):
+    '''
+        Returns the per loop depth call site counts of each edge as an
+        array with a row per edge and a column per depth
+    '''
+    depths = max([len(c) for c in depth_counts] + [1])
+    counts = numpy.zeros((len(depth_counts), depths), dtype=numpy.int64)
+    for e, c in enumerate(depth_counts):
+        counts[e, :len(c)] = c
+    return counts
+
+
+def _adjacency(keys, values, num_nodes):
+    '''
+        Groups values by key
+        Returns: (ptr, grouped), the values of key k are
+                 grouped[ptr[k]:ptr[k + 1]]
+    '''
+    order = numpy.argsort(keys, kind='mergesort')
+    ptr = numpy.zeros(num_nodes + 1, dtype=numpy.int64)
+    ptr[1:] = numpy.cumsum(numpy.bincount(keys, minlength=num_nodes))
+    return ptr, values[order]
+
+
+class CompactPDG(object):
+    '''
+        Program dependency graph with integer node ids
+
+        names:      node names indexed by id, ids maps names to ids
+        strings:    StringTable of the interned attribute values
+        node_type, filename, peripheral (NAME_KEY), llvm_type:
+                    interned attribute of each node, MISSING if it has none
+        size, address_taken:  attribute of each node, MISSING if it has none
+        extra:      {id: attrs} attributes without a column
+        edge_src, edge_dst, edge_type (interned), edge_count:  one per edge
+        edge_loop_counts:  number of call sites of each edge at each loop
+                           depth, a row per edge and a column per depth
+        loop_scale: see edge_weights
+        succ_ptr, succ:  successors of i are succ[succ_ptr[i]:succ_ptr[i+1]]
+        pred_ptr, pred:  predecessors of i, likewise
+    '''
+    def __init__(self, names, strings, columns, extra):
+        self.names = names
+        self.ids = dict((n, i) for (i, n) in enumerate(names))
+        self.strings = strings
+        for c in NODE_COLUMNS + EDGE_COLUMNS:
+            setattr(self, c, columns[c])
+        self.extra = extra
+        self.loop_scale = DEFAULT_LOOP_SCALE
+        n = len(names)
+        self.succ_ptr, self.succ = _adjacency(self.edge_src, self.edge_dst, n)
+        self.pred_ptr, self.pred = _adjacency(self.edge_dst, self.edge_src, n)
+
+    def __len__(self):
+        return len(self.names)
+
+    def number_of_edges(self):
+        return len(self.edge_src)
+
+    def has_node(self, name):
+        return self.ids.has_key(name)
+
+    def successors(self, i):
+        return self.succ[self.succ_ptr[i]:self.succ_ptr[i + 1]]
+
+    def predecessors(self, i):
+        return self.pred[self.pred_ptr[i]:self.pred_ptr[i + 1]]
+
+    def neighbors(self, i):
+        '''
+            Predecessors then successors of i, like nx.all_neighbors
+        '''
+        return numpy.concatenate((self.predecessors(i), self.successors(i)))
+
+    def nodes_of_type(self, node_type):
+        '''
+            Returns the ids of the nodes of node_type
+        '''
+        type_id = self.strings.get_id(node_type)
+        if type_id == MISSING:
+            return numpy.zeros(0, dtype=numpy.int64)
+        return numpy.flatnonzero(self.node_type == type_id)
+
+    def get_attr(self, i, key, default=None):
+        if STRING_COLUMNS.has_key(key):
+            value = getattr(self, STRING_COLUMNS[key])[i]
+            if value != MISSING:
+                return self.strings.lookup(value)
+        elif INT_COLUMNS.has_key(key):
+            column, _, py_types = INT_COLUMNS[key]
+            value = getattr(self, column)[i]
+            if value != MISSING:
+                return py_types[0](value)
+        if self.extra.has_key(i):
+            return self.extra[i].get(key, default)
+        return default
+
+    def attrs(self, i):
+        '''
+            Returns a copy of the attributes of node i as a dict
+        '''
+        attrs = copy.deepcopy(self.extra.get(i, {}))
+        for key in STRING_COLUMNS.keys() + INT_COLUMNS.keys():
+            value = self.get_attr(i, key)
+            if value is not None:
+                attrs[key] = value
+        return attrs
+
+    def edge_attrs(self, e):
+        attrs = {}
+        if self.edge_type[e] != MISSING:
+            attrs[TYPE_KEY] = self.strings.lookup(self.edge_type[e])
+        if self.edge_count[e] != MISSING:
+            attrs[COUNT_KEY] = int(self.edge_count[e])
+        in_loops = numpy.flatnonzero(self.edge_loop_counts[e, 1:])
+        if len(in_loops):
+            attrs[LOOP_DEPTHS_KEY] = \
+                self.edge_loop_counts[e, :in_loops[-1] + 2].tolist()
+        return attrs
+
+    def edge_weights(self):
+        '''
+            Returns the weight of each edge.  A call edge weighs the sum of
+            its call sites, each loop_scale to the power of the number of
+            loops it is in.  Other edges, and call edges without a Count,
+            weigh 1.
+        '''
+        call_types = [self.strings.get_id(t) for t in CALL_EDGE_TYPES]
+        is_call = numpy.in1d(self.edge_type, call_types) & \
+            (self.edge_count != MISSING)
+        depths = numpy.arange(self.edge_loop_counts.shape[1])
+        weights = self.edge_loop_counts.dot(
+            numpy.power(float(self.loop_scale), depths))
+        return numpy.where(is_call, weights, 1.0)
+
+    def to_networkx(self):
+        import networkx as nx
+        G = nx.DiGraph()
+        for i, name in enumerate(self.names):
+            G.add_node(name, self.attrs(i))
+        for e in xrange(self.number_of_edges()):
+            G.add_edge(self.names[self.edge_src[e]],
+                       self.names[self.edge_dst[e]], self.edge_attrs(e))
+        return G
+
+    def contract(self, groups, remove=()):
+        '''
+            Returns a new CompactPDG where the nodes of each group are
+            replaced by a single node, added after the remaining nodes.
+            Edges between the same pair of nodes are merged, summing their
+            counts at each loop depth, and edges within a group are
+            dropped.
+
+            groups: [(name, attrs, [ids]), ...]
+            remove: ids of nodes to drop with their edges
+        '''
+        n = len(self)
+        grouped = numpy.zeros(n, dtype=bool)
+        for (_, _, members) in groups:
+            grouped[members] = True
+        grouped[list(remove)] = True
+        kept = numpy.flatnonzero(~grouped)
+        new_id = numpy.full(n, MISSING, dtype=numpy.int64)
+        new_id[kept] = numpy.arange(len(kept))
+        for g, (_, _, members) in enumerate(groups):
+            new_id[members] = len(kept) + g
+        new_id[list(remove)] = MISSING
+
+        names = [self.names[i] for i in kept]
+        columns = dict((c, getattr(self, c)[kept]) for c in NODE_COLUMNS)
+        extra = {}
+        for new, old in enumerate(kept):
+            if self.extra.has_key(old):
+                extra[new] = self.extra[old]
+        group_values = []
+        for (name, attrs, _) in groups:
+            values, group_extra = _split_attrs(self.strings, attrs)
+            if group_extra:
+                extra[len(names)] = group_extra
+            names.append(name)
+            group_values.append(values)
+        for c in NODE_COLUMNS:
+            values = [v.get(c, MISSING) for v in group_values]
+            columns[c] = numpy.concatenate(
+                (columns[c], numpy.array(values, dtype=columns[c].dtype)))
+
+        src = new_id[self.edge_src]
+        dst = new_id[self.edge_dst]
+        valid = (src != MISSING) & (dst != MISSING) & \
+            ((src != dst) | (self.edge_src == self.edge_dst))
+        keys = src[valid] * len(names) + dst[valid]
+        keys, first, inverse = numpy.unique(keys, return_index=True,
+                                            return_inverse=True)
+        counts = self.edge_count[valid]
+        has_count = counts != MISSING
+        total = numpy.bincount(inverse, weights=numpy.where(has_count,
+                                                            counts, 0),
+                               minlength=len(keys))
+        counted = numpy.bincount(inverse, weights=has_count,
+                                 minlength=len(keys)) > 0
+        columns['edge_src'] = (keys // len(names)).astype(numpy.int32)
+        columns['edge_dst'] = (keys % len(names)).astype(numpy.int32)
+        columns['edge_type'] = self.edge_type[valid][first]
+        columns['edge_count'] = numpy.where(counted, total,
+                                            MISSING).astype(numpy.int64)
+        loop_counts = numpy.zeros((len(keys),
+                                   self.edge_loop_counts.shape[1]),
+                                  dtype=numpy.int64)
+        numpy.add.at(loop_counts, inverse, self.edge_loop_counts[valid])
+        columns['edge_loop_counts'] = loop_counts
+        P = CompactPDG(names, self.strings, columns, extra)
+        P.loop_scale = self.loop_scale
+        return P
+
+
+def from_networkx(G):
+    '''
+        Builds a CompactPDG from a networkx PDG, ids follow G.nodes()
+    '''
+    builder = PDGBuilder()
+    for n, attrs in G.nodes(True):
+        builder.add_node(n, attrs)
+    for u, v, attrs in G.edges(data=True):
+        builder.add_edge(builder.ids[u], v, attrs)
+    return builder.build()
+
+
+def as_compact(G):
+    '''
+        Returns G as a CompactPDG, converting it if it is a networkx graph
+    '''
+    if isinstance(G, CompactPDG):
+        return G
+    return from_networkx(G)
+
+
+def load(dependancy_json, node_types=PDG_NODE_TYPES,
+         edge_types=PDG_EDGE_TYPES):
+    '''
+        Reads the program dependancy graph from the json file produced by
+        the analysis pass of the compiler, without building a networkx graph
+    '''
+    builder = PDGBuilder()
+    for name, attrs, connections in pdg_loader.iter_pdg(dependancy_json,
+                                                        node_types,
+                                                        edge_types):
+        node_id = builder.add_node(name, attrs)
+        for dest_name, con_info in connections:
+            builder.add_edge(node_id, dest_name, con_info)
+    return builder.build()
+
+
+def add_size_info(P, json_size_file):
+    '''
+        Reads the size file written by the compiler, {node: {attribute:
+        value}}, and updates the attributes of P's nodes in place.  Nodes
+        not in P are ignored
+    '''
+    with open(json_size_file) as infile:
+        data = json.load(infile)
+    for name, props in data.items():
+        i = P.ids.get(name)
+        if i is None:
+            continue
+        values, extra = _split_attrs(P.strings, props)
+        for c, value in values.items():
+            getattr(P, c)[i] = value
+        if extra:
+            P.extra.setdefault(i, {}).update(extra)
+
+
+def get_region_size(P, ids):
+    '''
+        Returns the total Size of the nodes ids, nodes without one count 0
+    '''
+    sizes = P.size[ids]
+    return int(sizes[sizes != MISSING].sum())
+
+
+def make_isr_comp(P):
+    '''
+        Puts all interrupt handlers (devices.INTERRUPT_HANDLERS) in one code
+        region, IRQ_REGION_NAME, with their total Size.  Returns the new
+        graph
+    '''
+    import devices
+    irq_list = [i for i in P.nodes_of_type(FUNCTION_TYPE)
+                if P.names[i] in devices.INTERRUPT_HANDLERS]
+    irq_attrs = {TYPE_KEY: CODE_REGION_KEY,
+                 OBJECTS_KEY: [P.names[i] for i in irq_list],
+                 SIZE_KEY: get_region_size(P, irq_list)}
+    return P.contract([(IRQ_REGION_NAME, irq_attrs, irq_list)])
+
+
+def remap_peripherals(P, device_desc):
+    '''
+        The compiler gives the constant addresses a function accesses as
+        peripheral nodes.  Replaces each with the peripheral of device_desc
+        (see devices.get_device_desc) that covers its address, one node per
+        peripheral named .periph.<name>, and drops those at 0xFFFFFFFF.
+        Returns the new graph
+    '''
+    import devices
+    remove_nodes = []
+    groups = collections.OrderedDict()
+    nodes = []
+    for n in P.nodes_of_type(PERIPHERAL_NODE_TYPE):
+        if P.get_attr(n, "Addr") == 0xFFFFFFFF:
+            remove_nodes.append(n)
+        else:
+            nodes.append(n)
+    index = devices.PeripheralIndex(device_desc)
+    new_nodes = index.lookup_many([P.get_attr(n, "Addr") for n in nodes])
+    for n, new_node in zip(nodes, new_nodes):
+        if new_node:
+            node_name = ".periph." + new_node[NAME_KEY]
+            if not groups.has_key(node_name):
+                groups[node_name] = (node_name, new_node, [])
+            groups[node_name][2].append(n)
+        else:
+            print "Failed to Remap", P.names[n], ": ", P.attrs(n)
+    return P.contract(groups.values(), remove_nodes)
@@ -0,0 +1,143 @@
+'''
+    Reads the program dependency graph written by the HexboxAnalysis LLVM
+    pass (hexbox-analysis*.json) incrementally.  The file is a single JSON
+    object of {node name: {"Attr": {...}, "Connections": {...}}}, which is
+    decoded one node at a time so only the nodes and edges that are kept
+    are ever held in memory, rather than the whole document.
+'''
+import json
+from key_defs import *
+
+READ_SIZE = 1 << 20
+WHITESPACE = ' \t\n\r'
+IGNORED_PREFIX = 'llvm'
+
+
+class ObjectStream(object):
+    '''
+        Yields the (key, value) pairs of the top level object of a JSON
+        file, decoding each value as it is reached
+    '''
+    def __init__(self, infile, read_size=READ_SIZE):
+        self.infile = infile
+        self.read_size = read_size
+        self.decoder = json.JSONDecoder()
+        self.buf = ''
+        self.pos = 0
+        self.eof = False
+
+    def _read(self):
+        '''
+            Reads more of the file, dropping what has been decoded.
+            Returns False at the end of the file
+        '''
+        if self.eof:
+            return False
+        data = self.infile.read(self.read_size)
+        if not data:
+            self.eof = True
+            return False
+        self.buf = self.buf[self.pos:] + data
+        self.pos = 0
+        return True
+
+    def _next_char(self):
+        '''
+            Skips whitespace and returns the next character, or None at the
+            end of the file
+        '''
+        while True:
+            while self.pos < len(self.buf) and \
+                    self.buf[self.pos] in WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self._read():
+                return None
+
+    def _expect(self, chars):
+        c = self._next_char()
+        if c is None or c not in chars:
+            raise ValueError("Expected one of '%s' at offset %i, found %s" %
+                             (chars, self.pos, repr(c)))
+        self.pos += 1
+        return c
+
+    def _decode(self):
+        '''
+            Decodes the value starting at the current position, reading more
+            of the file until it is complete
+        '''
+        self._next_char()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buf, self.pos)
+                # A number at the end of the buffer may continue in the
+                # next read
+                if end < len(self.buf) or self.eof:
+                    self.pos = end
+                    return value
+            except ValueError:
+                if self.eof:
+                    raise
+            self._read()
+
+    def __iter__(self):
+        self._expect('{')
+        if self._next_char() == '}':
+            self.pos += 1
+            return
+        while True:
+            key = self._decode()
+            self._expect(':')
+            value = self._decode()
+            yield key, value
+            if self._expect(',}') == '}':
+                return
+
+
+def iter_pdg(dependancy_json, node_types, edge_types):
+    '''
+        Reads the nodes of the given types from the analysis file one at a
+        time.  llvm.* nodes and connections to them are dropped.
+
+        Yields:
+        (name, attrs, connections) attrs is the node's "Attr" dict,
+        connections = [(dest, attrs), ...] with the connection's dict, dest
+        may be a node that is not kept
+    '''
+    with open(dependancy_json, 'rb') as infile:
+        for node_name, node in ObjectStream(infile):
+            if node_name.startswith(IGNORED_PREFIX):
+                continue
+            attrs = node["Attr"]
+            if attrs[TYPE_KEY] not in node_types:
+                continue
+            connections = []
+            for dest_name, con_info in node.get("Connections", {}).items():
+                if dest_name.startswith(IGNORED_PREFIX):
+                    continue
+                if con_info[TYPE_KEY] not in edge_types:
+                    continue
+                connections.append((dest_name, con_info))
+            yield node_name, attrs, connections
+
+
+def read_pdg(dependancy_json, node_types, edge_types):
+    '''
+        Reads the nodes and edges of the given types from the analysis file
+        in a single pass.  llvm.* nodes and connections to them are dropped.
+
+        Returns:
+        nodes = [(name, attrs), ...] attrs is the node's "Attr" dict
+        edges = [(src, dest, attrs), ...] attrs is the connection's dict,
+                either end may be a node that was not kept
+    '''
+    nodes = []
+    edges = []
+    for node_name, attrs, connections in iter_pdg(dependancy_json,
+                                                  node_types, edge_types):
+        nodes.append((node_name, attrs))
+        for dest_name, con_info in connections:
+            edges.append((node_name, dest_name, con_info))
+    return nodes, edges
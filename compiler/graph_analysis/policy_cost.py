@@ -0,0 +1,287 @@
+'''
+    Estimates the costs of a compartmentalization policy from the PDG, so
+    policies of different methods can be compared without building,
+    recording, and running collect_results on each.  For a policy it
+    estimates
+
+    * The call edges between compartments and their weight, static (see
+      pdg.CompactPDG.edge_weights) and recorded if a profile is given (see
+      switch_profile.py)
+    * The power of 2 padding of the code (flash) and data (RAM) regions,
+      from the Size of the functions (-s size file) and globals
+    * The functions and code bytes that can write each global, like
+      collect_results.get_global_stats without a whitelist
+    * The share of the functions and code bytes that are privileged
+    * The MPU regions each compartment uses of those available
+
+    Functions in no compartment are in DEFAULT_COMP, as in collect_results.
+'''
+import collections
+import json
+import os
+import numpy
+import comp_index
+import mpu_helpers
+import pdg
+import switch_profile
+from key_defs import *
+
+DEFAULT_COMP = '.default'
+
+
+def load_policy(policy_filename):
+    with open(policy_filename, 'rb') as infile:
+        return json.load(infile)
+
+
+def get_node_comps(P, index):
+    '''
+        Returns the row in index (comp_index.CompIndex) of the compartment
+        of each node of P, pdg.MISSING for nodes that are not functions
+    '''
+    comp_of = numpy.full(len(P), pdg.MISSING, dtype=numpy.int64)
+    comp_of[P.nodes_of_type(FUNCTION_TYPE)] = index.comp_idx[DEFAULT_COMP]
+    for i, comp in enumerate(index.comps):
+        ids = [P.ids[f] for f in index.comp_stats[comp]['FUNCTIONS']
+               if P.has_node(f)]
+        comp_of[ids] = i
+    return comp_of
+
+
+def get_switch_costs(P, comp_of, switch_counts=None):
+    '''
+        Counts the calls between functions that cross compartments
+        comp_of: see get_node_comps
+        switch_counts: Recorded {(caller, callee): count}, optional
+    '''
+    call_types = [P.strings.get_id(t) for t in pdg.CALL_EDGE_TYPES]
+    src_comp = comp_of[P.edge_src]
+    dst_comp = comp_of[P.edge_dst]
+    calls = numpy.in1d(P.edge_type, call_types) & \
+        (src_comp != pdg.MISSING) & (dst_comp != pdg.MISSING) & \
+        (P.edge_src != P.edge_dst)
+    cross = calls & (src_comp != dst_comp)
+    weights = P.edge_weights()
+
+    costs = collections.OrderedDict()
+    costs['CALL_EDGES'] = int(calls.sum())
+    costs['CROSS_EDGES'] = int(cross.sum())
+    costs['CALL_WEIGHT'] = float(weights[calls].sum())
+    costs['CROSS_WEIGHT'] = float(weights[cross].sum())
+    if switch_counts:
+        calls = 0
+        switches = 0
+        for (caller, callee), count in switch_counts.items():
+            if not (P.has_node(caller) and P.has_node(callee)):
+                continue
+            c1 = comp_of[P.ids[caller]]
+            c2 = comp_of[P.ids[callee]]
+            if c1 == pdg.MISSING or c2 == pdg.MISSING:
+                continue
+            calls += count
+            if c1 != c2:
+                switches += count
+        costs['PROFILED_CALLS'] = calls
+        costs['SWITCHES'] = switches
+    return costs
+
+
+def get_region_sizes(P, policy):
+    '''
+        Returns {region: size} of the regions of policy, objects not in P
+        or without a Size count 0
+    '''
+    sizes = {}
+    for name, region in policy[POLICY_KEY_REGIONS].items():
+        ids = [P.ids[o] for o in region[POLICY_REGION_KEY_OBJECTS]
+               if P.has_node(o)]
+        sizes[name] = pdg.get_region_size(P, ids)
+    return sizes
+
+
+def get_padding_costs(P, policy, region_sizes):
+    '''
+        Sums the sizes of the code and data regions of policy and the
+        padding to make each an MPU region, see mpu_helpers.get_padding
+    '''
+    costs = collections.OrderedDict()
+    for r_type, memory in (("Code", 'FLASH'), ("Data", 'RAM')):
+        size = 0
+        padding = 0
+        for name, region in policy[POLICY_KEY_REGIONS].items():
+            if region[POLICY_REGION_KEY_TYPE] == r_type:
+                size += region_sizes[name]
+                padding += mpu_helpers.get_padding(region_sizes[name])
+        costs[memory + '_SIZE'] = size
+        costs[memory + '_PADDING'] = padding
+    unsized = 0
+    for region in policy[POLICY_KEY_REGIONS].values():
+        for o in region[POLICY_REGION_KEY_OBJECTS]:
+            if not P.has_node(o) or P.size[P.ids[o]] == pdg.MISSING:
+                unsized += 1
+    costs['UNSIZED_OBJECTS'] = unsized
+    return costs
+
+
+def get_comp_code(P, index, comp_of):
+    '''
+        Returns the number of functions and code bytes of each compartment
+        of index, as arrays indexed like index.comps
+    '''
+    functs = numpy.flatnonzero(comp_of != pdg.MISSING)
+    sizes = numpy.where(P.size[functs] != pdg.MISSING, P.size[functs], 0)
+    num_functs = numpy.bincount(comp_of[functs],
+                                minlength=len(index.comps))
+    num_bytes = numpy.bincount(comp_of[functs], weights=sizes,
+                               minlength=len(index.comps)).astype(numpy.int64)
+    return num_functs, num_bytes
+
+
+def get_global_exposure(P, index, num_functs, num_bytes):
+    '''
+        Gets the functions that require each global, and the functions and
+        code bytes that can write it, see collect_results.get_global_stats
+        Returns: {global: {'REQ_FUNCTIONS', 'EXPOSED_FUNCTS',
+                           'EXPOSED_BYTES'}}
+    '''
+    exposed, _, _ = index.get_exposure()
+    exposed_functs = num_functs.dot(exposed)
+    exposed_bytes = num_bytes.dot(exposed)
+    funct_type = P.strings.get_id(FUNCTION_TYPE)
+    global_stats = {}
+    for i, var in enumerate(index.globals):
+        neighbors = P.neighbors(P.ids[var])
+        stats = collections.OrderedDict()
+        stats['REQ_FUNCTIONS'] = len(set(
+            neighbors[P.node_type[neighbors] == funct_type]))
+        stats['EXPOSED_FUNCTS'] = int(exposed_functs[i])
+        stats['EXPOSED_BYTES'] = int(exposed_bytes[i])
+        global_stats[var] = stats
+    return global_stats
+
+
+def get_priv_costs(index, num_functs, num_bytes):
+    '''
+        The share of the functions and code bytes that are privileged, the
+        bytes are 0 without function sizes
+    '''
+    costs = collections.OrderedDict()
+    costs['PRIV_COMPS'] = int(index.priv.sum())
+    costs['PRIV_FUNCTS_SHARE'] = \
+        float(num_functs[index.priv].sum()) / max(num_functs.sum(), 1)
+    costs['PRIV_BYTES_SHARE'] = \
+        float(num_bytes[index.priv].sum()) / max(num_bytes.sum(), 1)
+    return costs
+
+
+def get_mpu_costs(policy):
+    '''
+        Gets the data and peripheral MPU regions each compartment uses of
+        those it may use
+    '''
+    limit = policy[POLICY_NUM_MPU_REGIONS] - \
+        mpu_helpers.NUM_DEFAULT_MPU_REGIONS
+    used = numpy.array([len(comp["Data"]) + len(comp["Peripherals"])
+                        for comp in policy[POLICY_KEY_COMPARTMENTS].values()],
+                       dtype=numpy.int64)
+    costs = collections.OrderedDict()
+    costs['MPU_REGIONS'] = limit
+    costs['MAX_MPU_USED'] = int(used.max()) if len(used) else 0
+    costs['MEAN_MPU_USED'] = float(used.mean()) if len(used) else 0.0
+    costs['COMPS_AT_LIMIT'] = int((used == limit).sum())
+    costs['COMPS_OVER_LIMIT'] = int((used > limit).sum())
+    return costs
+
+
+def evaluate_policy(P, policy, switch_counts=None):
+    '''
+        Estimates the costs of policy
+        P: The PDG (pdg.CompactPDG) the policy was made from, with the
+           function sizes (pdg.add_size_info) if they are known
+        policy: A compartment description, see load_policy
+        switch_counts: Recorded {(caller, callee): count}, see
+                       switch_profile.load_switch_counts
+        Returns: (summary, global_stats), summary is an OrderedDict of the
+                 costs and global_stats is from get_global_exposure
+    '''
+    comp_stats = comp_index.build_comp_stats(policy)
+    comp_stats[DEFAULT_COMP] = {"FUNCTIONS": [], "GLOBALS": [], "Priv": 0}
+    g_vars = [P.names[i] for i in P.nodes_of_type(GLOBAL_TYPE)]
+    index = comp_index.CompIndex(comp_stats, g_vars)
+    comp_of = get_node_comps(P, index)
+    num_functs, num_bytes = get_comp_code(P, index, comp_of)
+    global_stats = get_global_exposure(P, index, num_functs, num_bytes)
+
+    summary = collections.OrderedDict()
+    summary['COMPARTMENTS'] = len(policy[POLICY_KEY_COMPARTMENTS])
+    summary.update(get_switch_costs(P, comp_of, switch_counts))
+    summary.update(get_padding_costs(P, policy, get_region_sizes(P, policy)))
+    for key in ('EXPOSED_FUNCTS', 'EXPOSED_BYTES'):
+        values = [s[key] for s in global_stats.values()]
+        summary['MEAN_' + key] = float(numpy.mean(values)) if values else 0.0
+        summary['MAX_' + key] = max(values) if values else 0
+    summary.update(get_priv_costs(index, num_functs, num_bytes))
+    summary.update(get_mpu_costs(policy))
+    return summary, global_stats
+
+
+def write_table(results, fd):
+    '''
+        Writes the summaries of results, [(name, summary), ...], as csv with
+        a column per policy
+    '''
+    fd.write(",".join(["Policy"] + [name for (name, _) in results]) + "\n")
+    for key in results[0][1].keys():
+        row = [key]
+        for (_, summary) in results:
+            value = summary.get(key, '')
+            if isinstance(value, float):
+                value = "%.3f" % value
+            row.append(str(value))
+        fd.write(",".join(row) + "\n")
+
+
+if __name__ == '__main__':
+    import argparse
+    import sys
+    parser = argparse.ArgumentParser(
+        description='Estimates the costs of compartmentalization policies')
+    parser.add_argument('-j','--json_graph',dest='json_graph',required=True,
+                        help='Json file describing the Nodes of a graph from llvm')
+    parser.add_argument('-c','--comp_description',dest='policies',nargs='+',
+                        required=True,
+                        help='Compartment descriptions (policies) to compare')
+    parser.add_argument('-s','--size',dest='size_file', help='JSON Size File')
+    parser.add_argument('-p','--profile',dest='profile',
+                        help=('Recorded compartment switches, see '
+                              'switch_profile.py')
+                        )
+    parser.add_argument('--profile-elf',dest='profile_elf',
+                        help='The recorded binary, required with a dump for -p'
+                        )
+    parser.add_argument('-o','--outfile',dest='outfile',
+                        help=('Write the summary and per global costs of '
+                              'each policy to this JSON file')
+                        )
+    args = parser.parse_args()
+
+    P = pdg.load(args.json_graph)
+    if args.size_file:
+        pdg.add_size_info(P, args.size_file)
+    switch_counts = None
+    if args.profile:
+        switch_counts = switch_profile.load_switch_counts(args.profile,
+                                                          args.profile_elf)
+
+    results = []
+    output = {}
+    for policy_file in args.policies:
+        summary, global_stats = evaluate_policy(P, load_policy(policy_file),
+                                                switch_counts)
+        name = os.path.basename(policy_file)
+        results.append((name, summary))
+        output[policy_file] = {"Summary": summary, "Globals": global_stats}
+    write_table(results, sys.stdout)
+    if args.outfile:
+        with open(args.outfile, 'wb') as outfile:
+            json.dump(output, outfile, indent=2)
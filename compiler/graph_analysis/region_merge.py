@@ -0,0 +1,276 @@
+'''
+    In place merging of the regions of a region graph.
+
+    RegionMerger wraps a networkx region graph and provides the parts of the
+    DiGraph interface the partitioners use, plus merge().  Merged regions
+    are tracked with a union-find over node ids.  A merge links the adjacency
+    sets of the region with fewer neighbors into the other's, and renames it
+    in its neighbors' sets, so the sets always hold live regions and queries
+    read them directly.  The object lists are only concatenated on demand,
+    by objects() or apply().  The graph is never copied.  apply() writes
+    the result back to the wrapped graph.
+'''
+from key_defs import *
+
+
+class _NodeView(object):
+    '''
+        Attribute dicts of the nodes, like DiGraph.node
+    '''
+    def __init__(self, merger):
+        self.merger = merger
+
+    def __getitem__(self, n):
+        return self.merger.get_attrs(n)
+
+    def __contains__(self, n):
+        return self.merger.has_node(n)
+
+
+class RegionMerger(object):
+    '''
+        R: The region graph (networkx DiGraph), it is not updated until
+           apply() is called
+
+        parent:  union-find parent of each id, roots are live nodes
+        label:   name of the node each root represents
+        attrs:   attribute dict of each root
+        succ, pred:  sets of the live roots adjacent to each root
+        chunks:  object lists of each root not yet concatenated
+    '''
+    def __init__(self, R):
+        self.R = R
+        self.ids = {}
+        self.parent = []
+        self.label = []
+        self.attrs = []
+        self.alive = []
+        self.succ = []
+        self.pred = []
+        self.chunks = []
+        self.node = _NodeView(self)
+        for n, attrs in R.nodes_iter(data=True):
+            self._new_id(n, attrs)
+        for u, v in R.edges_iter():
+            if u != v:
+                self.succ[self.ids[u]].add(self.ids[v])
+                self.pred[self.ids[v]].add(self.ids[u])
+
+    def _new_id(self, n, attrs):
+        i = len(self.parent)
+        self.ids[n] = i
+        self.parent.append(i)
+        self.label.append(n)
+        self.attrs.append(attrs)
+        self.alive.append(True)
+        self.succ.append(set())
+        self.pred.append(set())
+        self.chunks.append(None)
+        return i
+
+    def find(self, i):
+        root = i
+        while self.parent[root] != root:
+            root = self.parent[root]
+        while self.parent[i] != root:
+            self.parent[i], i = root, self.parent[i]
+        return root
+
+    def _root(self, n):
+        '''
+            Returns the id of node n, or None if it is not in the graph
+        '''
+        i = self.ids.get(n)
+        if i is None:
+            return None
+        root = self.find(i)
+        if not self.alive[root] or self.label[root] != n:
+            return None
+        return root
+
+    def _get_root(self, n):
+        root = self._root(n)
+        if root is None:
+            raise KeyError("The node %s is not in the graph" % (n,))
+        return root
+
+    def _rename(self, old, new):
+        '''
+            Replaces root old by new (None to drop it) in the adjacency sets
+            of old's neighbors, a neighbor that is new drops old
+        '''
+        for r in self.pred[old]:
+            self.succ[r].discard(old)
+            if new is not None and r != new:
+                self.succ[r].add(new)
+        for r in self.succ[old]:
+            self.pred[r].discard(old)
+            if new is not None and r != new:
+                self.pred[r].add(new)
+
+    def has_node(self, n):
+        return self._root(n) is not None
+
+    def representative(self, n):
+        '''
+            Returns the node n has been merged into (n itself if it has not
+            been), or None if that node was removed
+        '''
+        i = self.ids.get(n)
+        if i is None:
+            return None
+        root = self.find(i)
+        if not self.alive[root]:
+            return None
+        return self.label[root]
+
+    def get_attrs(self, n):
+        '''
+            Returns the attributes of n, its OBJECTS_KEY list is only
+            updated by objects() and apply()
+        '''
+        return self.attrs[self._get_root(n)]
+
+    def objects(self, n):
+        '''
+            Returns the objects of n, including those of the nodes merged
+            into it
+        '''
+        root = self._get_root(n)
+        if self.chunks[root] is not None:
+            objects = []
+            for chunk in self.chunks[root]:
+                objects.extend(chunk)
+            self.attrs[root][OBJECTS_KEY] = objects
+            self.chunks[root] = None
+        return self.attrs[root].get(OBJECTS_KEY)
+
+    def nodes_iter(self, data=False):
+        for root in xrange(len(self.parent)):
+            if self.parent[root] == root and self.alive[root]:
+                n = self.label[root]
+                if data:
+                    yield n, self.get_attrs(n)
+                else:
+                    yield n
+
+    def nodes(self, data=False):
+        return list(self.nodes_iter(data))
+
+    def successors(self, n):
+        root = self._get_root(n)
+        return [self.label[r] for r in self.succ[root]]
+
+    def predecessors(self, n):
+        root = self._get_root(n)
+        return [self.label[r] for r in self.pred[root]]
+
+    def successors_iter(self, n):
+        return iter(self.successors(n))
+
+    def predecessors_iter(self, n):
+        return iter(self.predecessors(n))
+
+    def in_degree(self, n):
+        return len(self.pred[self._get_root(n)])
+
+    def out_degree(self, n):
+        return len(self.succ[self._get_root(n)])
+
+    def has_edge(self, u, v):
+        u_root = self._root(u)
+        v_root = self._root(v)
+        if u_root is None or v_root is None:
+            return False
+        return v_root in self.succ[u_root]
+
+    def add_node(self, n, attr_dict=None):
+        root = self._root(n)
+        if root is None:
+            self._new_id(n, dict(attr_dict) if attr_dict else {})
+        elif attr_dict:
+            self.get_attrs(n).update(attr_dict)
+
+    def add_edge(self, u, v):
+        if not self.has_node(u):
+            self.add_node(u)
+        if not self.has_node(v):
+            self.add_node(v)
+        u_root = self._root(u)
+        v_root = self._root(v)
+        if u_root != v_root:
+            self.succ[u_root].add(v_root)
+            self.pred[v_root].add(u_root)
+
+    def remove_node(self, n):
+        root = self._get_root(n)
+        self._rename(root, None)
+        self.alive[root] = False
+        self.succ[root] = set()
+        self.pred[root] = set()
+        self.chunks[root] = None
+
+    def merge(self, keep, other):
+        '''
+            Merges node other into node keep, keep's name and attributes
+            are kept, the objects of other are appended to keep's and their
+            SIZE_KEYs are added
+        '''
+        keep_root = self._get_root(keep)
+        other_root = self._get_root(other)
+        if keep_root == other_root:
+            return
+        chunks = self.chunks[keep_root]
+        if chunks is None:
+            chunks = [self.attrs[keep_root].get(OBJECTS_KEY, [])]
+        if self.chunks[other_root] is None:
+            chunks.append(self.attrs[other_root].get(OBJECTS_KEY, []))
+        else:
+            chunks.extend(self.chunks[other_root])
+        attrs = self.attrs[keep_root]
+        other_attrs = self.attrs[other_root]
+        if attrs.has_key(SIZE_KEY) or other_attrs.has_key(SIZE_KEY):
+            attrs[SIZE_KEY] = attrs.get(SIZE_KEY, 0) + \
+                other_attrs.get(SIZE_KEY, 0)
+
+        # The root with more neighbors is kept, so merging costs the smaller
+        # number of neighbors
+        big, small = keep_root, other_root
+        if len(self.succ[big]) + len(self.pred[big]) < \
+                len(self.succ[small]) + len(self.pred[small]):
+            big, small = small, big
+        self._rename(small, big)
+        self.parent[small] = big
+        for adjacent in (self.succ, self.pred):
+            adjacent[big].update(adjacent[small])
+            adjacent[big].discard(small)
+            adjacent[big].discard(big)
+            adjacent[small] = set()
+        self.label[big] = keep
+        self.attrs[big] = attrs
+        self.chunks[big] = chunks
+        self.chunks[small] = None
+
+    def apply(self):
+        '''
+            Writes the merged graph back to R and returns R
+        '''
+        R = self.R
+        live = set()
+        for n, attrs in self.nodes_iter(data=True):
+            live.add(n)
+            self.objects(n)
+            if R.has_node(n):
+                R.node[n] = attrs
+            else:
+                R.add_node(n, attrs)
+        R.remove_nodes_from([n for n in R.nodes_iter() if n not in live])
+        # Edges that are unchanged keep their attributes
+        for n in live:
+            root = self._root(n)
+            targets = set(self.label[r]
+                          for r in self.succ[root])
+            R.remove_edges_from([(n, s) for s in R.successors_iter(n)
+                                 if s not in targets])
+            R.add_edges_from((n, t) for t in targets if not R.has_edge(n, t))
+        return R
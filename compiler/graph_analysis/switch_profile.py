@@ -0,0 +1,159 @@
+'''
+    Loads recorded compartment switch counts for profile guided
+    partitioning.  A profile is either
+
+    * A JSON file of switch counts per call edge,
+      {caller: {callee: count, ...}, ...}
+    * A dump of the switch PC buffer of a hexbox record binary, see
+      dump_switch_counts in gdb_helpers.py.  It holds one
+      struct profiler_pc_record (profiler.h) per compartment entry site.
+      Each PC is mapped to the function containing it, and to the
+      functions it enters from the metadata after its svc 100 in the
+      recorded binary.
+
+    Both are returned as {(caller, callee): count}.
+'''
+import collections
+import json
+import struct
+import numpy
+import elf_cache
+import elf_reader
+from key_defs import *
+
+# From profiler.c
+COMP_SWITCH_ADDRS = 0x1000E000
+EMULATOR_RAW_ADDRS = 0x1000F000
+PC_RECORD_FORMAT = "<II"
+
+# struct hexbox_metadata (return_policy, count) followed by count
+# struct hexbox_entry (id, policy), from hexbox-rt.h
+METADATA_FORMAT = "<II"
+METADATA_DEST_FORMAT = "<II"
+
+
+def parse_switch_recording(memory_filename, dump_addr=COMP_SWITCH_ADDRS):
+    '''
+        Reads the switch PC buffer from a gdb memory dump
+        memory_filename: File from (gdb) dump binary memory <file> ...
+        dump_addr:  Address the dump starts at
+        returns -> {pc: count}
+    '''
+    record_size = struct.calcsize(PC_RECORD_FORMAT)
+    with open(memory_filename, 'rb') as infile:
+        infile.seek(COMP_SWITCH_ADDRS - dump_addr)
+        buf = infile.read(EMULATOR_RAW_ADDRS - COMP_SWITCH_ADDRS)
+
+    pc_counts = collections.defaultdict(int)
+    for offset in xrange(0, len(buf) - record_size + 1, record_size):
+        pc, count = struct.unpack_from(PC_RECORD_FORMAT, buf, offset)
+        if pc == 0:
+            break
+        pc_counts[pc] += count
+    return pc_counts
+
+
+def get_function_lookup(symbols):
+    '''
+        Returns (starts, ends, names) of the functions of symbols sorted by
+        address, for find_function
+    '''
+    functs = symbols.functions()
+    functs = functs[numpy.argsort(symbols.addr[functs], kind='mergesort')]
+    starts = symbols.addr[functs].astype(numpy.int64)
+    ends = starts + symbols.size[functs]
+    return starts, ends, [symbols.names[i] for i in functs]
+
+
+def find_function(lookup, addr):
+    '''
+        Returns the name of the function containing addr, or None
+    '''
+    starts, ends, names = lookup
+    i = numpy.searchsorted(starts, addr, side='right') - 1
+    if i >= 0 and addr < ends[i]:
+        return names[i]
+    return None
+
+
+def read_metadata_dests(elf, pc):
+    '''
+        Reads the destinations of the compartment entry recorded at pc.
+        pc is the address of the word after the svc 100, which points to
+        its struct hexbox_metadata (hexbox-rt.h), see handle_svc.
+        Returns: [dest address, ...], empty if it cannot be read
+    '''
+    md_ptr = elf.read(pc, 4)
+    if md_ptr is None:
+        return []
+    (md_addr,) = struct.unpack("<I", md_ptr)
+    header = elf.read(md_addr, struct.calcsize(METADATA_FORMAT))
+    if header is None:
+        return []
+    (_, count) = struct.unpack(METADATA_FORMAT, header)
+    dest_size = struct.calcsize(METADATA_DEST_FORMAT)
+    dests = elf.read(md_addr + len(header), count * dest_size)
+    if dests is None:
+        return []
+    # Thumb function addresses have the low bit set
+    return [struct.unpack_from(METADATA_DEST_FORMAT, dests, i)[0] & ~1
+            for i in xrange(0, len(dests), dest_size)]
+
+
+def map_pcs_to_calls(pc_counts, binary_filename):
+    '''
+        Maps the recorded compartment entries to the calls they were made
+        for, using the metadata of each entry in binary_filename.  The count
+        of an entry with several destinations (an indirect call) is split
+        evenly between them.
+        returns -> {(caller, callee): count}
+    '''
+    symbols = elf_cache.get_symbols(binary_filename)
+    lookup = get_function_lookup(symbols)
+    edge_counts = collections.defaultdict(float)
+    with elf_reader.ElfFile(binary_filename) as elf:
+        for pc, count in sorted(pc_counts.items()):
+            caller = find_function(lookup, pc)
+            if caller is None:
+                print "WARNING: Switch PC not in a function 0x%08x" % pc
+                continue
+            callees = [find_function(lookup, d)
+                       for d in read_metadata_dests(elf, pc)]
+            callees = [c for c in callees if c is not None and c != caller]
+            if not callees:
+                print "WARNING: No destinations for switch PC 0x%08x" % pc
+                continue
+            for callee in callees:
+                edge_counts[(caller, callee)] += float(count) / len(callees)
+    return edge_counts
+
+
+def load_edge_counts(json_filename):
+    '''
+        Reads a JSON profile of {caller: {callee: count}}
+        returns -> {(caller, callee): count}
+    '''
+    with open(json_filename, 'rb') as infile:
+        data = json.load(infile)
+    edge_counts = {}
+    for caller, callees in data.items():
+        for callee, count in callees.items():
+            if caller != callee and count > 0:
+                edge_counts[(caller, callee)] = count
+    return edge_counts
+
+
+def load_switch_counts(profile_filename, binary_filename=None,
+                       dump_addr=COMP_SWITCH_ADDRS):
+    '''
+        Loads the profile in profile_filename, see the module docstring
+        binary_filename:  The recorded ELF, required for a memory dump
+        returns -> {(caller, callee): count}
+    '''
+    if profile_filename.endswith('.json'):
+        return load_edge_counts(profile_filename)
+    if binary_filename is None:
+        raise ValueError("The recorded binary is needed to read " +
+                         profile_filename)
+    pc_counts = parse_switch_recording(profile_filename, dump_addr)
+    return map_pcs_to_calls(pc_counts, binary_filename)
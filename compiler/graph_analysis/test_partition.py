@@ -0,0 +1,185 @@
+'''
+    Tests the peripheral rounds of partition_by_peripheral against the
+    networkx version they replaced, and which code regions
+    merge_hot_code_regions merges.
+
+    Run from this directory:  python -m unittest test_partition
+'''
+import collections
+import random
+import unittest
+import networkx as nx
+import analyzer
+import region_merge
+from key_defs import *
+
+
+def code_region(i):
+    return CODE_REGION_KEY + '%i_' % i
+
+
+def peripheral_region(i):
+    return PERIPHERAL_REGION_KEY + '%i_' % i
+
+
+def make_graph(calls, peripherals):
+    '''
+        calls: [(caller, callee)] of code region numbers
+        peripherals: {code region number: [peripheral names]}
+    '''
+    R = nx.DiGraph()
+    code = set(c for call in calls for c in call) | set(peripherals)
+    for i in code:
+        analyzer.add_region_node(R, code_region(i), CODE_REGION_KEY, i,
+                                 ['f%i' % i])
+    for (u, v) in calls:
+        R.add_edge(code_region(u), code_region(v))
+    names = sorted(set(p for pers in peripherals.values() for p in pers))
+    for (i, name) in enumerate(names):
+        R.add_node(peripheral_region(i),
+                   {TYPE_KEY: PERIPHERAL_REGION_KEY,
+                    KEY_REQUIRED_PERIPHERALS: [name]})
+        for (c, pers) in peripherals.items():
+            if name in pers:
+                R.add_edge(peripheral_region(i), code_region(c))
+    return R
+
+
+def deque_rounds(R):
+    '''
+        The networkx rounds partition_by_peripheral used to run, merging
+        in name order instead of dict order so the result is deterministic
+    '''
+    worklist = collections.deque()
+    for n, attrs in R.nodes(True):
+        if attrs[TYPE_KEY] == PERIPHERAL_REGION_KEY:
+            for p in R.successors(n):
+                if not p in worklist:
+                    worklist.append(p)
+    updated = True
+    while updated:
+        updated = False
+        potential_merges = collections.defaultdict(set)
+        for code_region in worklist:
+            dep_per = analyzer.get_dependent_peripherals(R, code_region)
+            all_neighbors = R.predecessors(code_region)
+            all_neighbors.extend(R.successors(code_region))
+            for n in all_neighbors:
+                if n == code_region:
+                    continue
+                if R.node[n][TYPE_KEY] == CODE_REGION_KEY:
+                    n_dep_per = analyzer.get_dependent_peripherals(R, n)
+                    if dep_per == n_dep_per or len(n_dep_per) == 0:
+                        potential_merges[n].add(code_region)
+        worklist = collections.deque()
+        for key, merges in sorted(potential_merges.items()):
+            if len(merges) == 1:
+                updated = True
+                region = merges.pop()
+                if key in R.nodes() and region in R.nodes():
+                    R.node[region][OBJECTS_KEY].extend(
+                        R.node[key][OBJECTS_KEY])
+                    for p in R.predecessors(key):
+                        R.add_edge(p, region)
+                    for s in R.successors(key):
+                        R.add_edge(region, s)
+                    R.remove_node(key)
+                    worklist.append(region)
+                    if key in worklist:
+                        worklist.remove(key)
+    return R
+
+
+def code_partition(R):
+    return sorted(sorted(attrs[OBJECTS_KEY])
+                  for (n, attrs) in R.nodes_iter(True)
+                  if attrs[TYPE_KEY] == CODE_REGION_KEY)
+
+
+def merged_partition(R, merge_weights=None):
+    M = region_merge.RegionMerger(R)
+    analyzer.merge_peripheral_neighbors(M, merge_weights)
+    return code_partition(M.apply())
+
+
+class TestPeripheralRounds(unittest.TestCase):
+
+    def test_matches_deque_version(self):
+        # 0 uses the UART, 3 and 4 the GPIO, 1 is called by 0 and 3
+        calls = [(0, 1), (3, 1), (0, 2), (2, 5), (3, 4), (4, 6), (6, 7)]
+        peripherals = {0: ['UART'], 3: ['GPIO'], 4: ['GPIO']}
+        expected = code_partition(deque_rounds(make_graph(calls, peripherals)))
+        self.assertEqual(merged_partition(make_graph(calls, peripherals)),
+                         expected)
+        self.assertIn(['f0', 'f2', 'f5'], expected)
+        self.assertIn(['f3', 'f4', 'f6', 'f7'], expected)
+        self.assertIn(['f1'], expected)
+
+    def test_matches_deque_version_random(self):
+        rand = random.Random(0)
+        for _ in xrange(200):
+            n = rand.randint(2, 12)
+            calls = [(rand.randrange(n), rand.randrange(n))
+                     for _ in xrange(rand.randint(1, 2 * n))]
+            peripherals = {}
+            for i in rand.sample(xrange(n), rand.randint(1, n)):
+                peripherals[i] = rand.sample(['UART', 'GPIO', 'SPI'],
+                                             rand.randint(1, 2))
+            expected = code_partition(
+                deque_rounds(make_graph(calls, peripherals)))
+            self.assertEqual(merged_partition(make_graph(calls, peripherals)),
+                             expected, (calls, peripherals))
+
+    def test_weights_pick_between_candidates(self):
+        calls = [(0, 1), (3, 1)]
+        peripherals = {0: ['UART'], 3: ['GPIO']}
+        self.assertIn(['f1'], merged_partition(make_graph(calls, peripherals)))
+        weights = {('f3', 'f1'): 10, ('f0', 'f1'): 1}
+        self.assertIn(['f1', 'f3'],
+                      merged_partition(make_graph(calls, peripherals),
+                                       weights))
+
+
+class TestHotCodeRegions(unittest.TestCase):
+
+    def make_graph(self):
+        '''
+            Code regions 0 to 2 and the interrupt handlers' region, 1 uses
+            a privileged peripheral
+        '''
+        R = nx.DiGraph()
+        for i in xrange(3):
+            analyzer.add_region_node(R, code_region(i), CODE_REGION_KEY, i,
+                                     ['f%i' % i])
+        analyzer.add_region_node(R, IRQ_REGION_NAME, CODE_REGION_KEY, 3,
+                                 ['SysTick_Handler'])
+        for (i, (name, priv)) in enumerate([('UART', False), ('PPB', True)]):
+            R.add_node(peripheral_region(i),
+                       {TYPE_KEY: PERIPHERAL_REGION_KEY,
+                        KEY_MPU_TREE_NAME: name,
+                        KEY_REQUIRED_PERIPHERALS: set([name]),
+                        KEY_REQUIRED_MASK: 1,
+                        PRIV_KEY: priv})
+            R.add_edge(peripheral_region(i), code_region(i))
+        return R
+
+    def merge_hot(self, switch_counts):
+        M = region_merge.RegionMerger(self.make_graph())
+        analyzer.merge_hot_code_regions(M, 4, switch_counts)
+        return code_partition(M.apply())
+
+    def test_different_privilege_not_merged(self):
+        partition = self.merge_hot({('f0', 'f1'): 100, ('f0', 'f2'): 1})
+        self.assertIn(['f0', 'f2'], partition)
+        self.assertIn(['f1'], partition)
+
+    def test_irq_region_not_merged(self):
+        partition = self.merge_hot({('SysTick_Handler', 'f0'): 100,
+                                    ('f2', 'SysTick_Handler'): 100})
+        self.assertIn(['SysTick_Handler'], partition)
+        self.assertIn(['f0'], partition)
+        self.assertIn(['f2'], partition)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,80 @@
+'''
+    Tests thumb_scan's store encodings against instructions assembled with
+    llvm-mc -triple=thumbv7em-none-eabi -mattr=+vfp4 -show-encoding
+
+    Run from this directory:  python -m unittest test_thumb_scan
+'''
+import unittest
+import numpy
+import thumb_scan
+
+# (assembly, encoding bytes, is a store)
+INSTRUCTIONS = [
+    ("stc p14, c5, [r1, #4]", [0x81, 0xed, 0x01, 0x5e], True),
+    ("stc p14, c5, [r1], {3}", [0x81, 0xec, 0x03, 0x5e], True),
+    ("stc p14, c5, [r1], #-4", [0x21, 0xec, 0x01, 0x5e], True),
+    ("stcl p14, c5, [r1, #4]", [0xc1, 0xed, 0x01, 0x5e], True),
+    ("mcrr p14, #1, r0, r1, c2", [0x41, 0xec, 0x12, 0x0e], False),
+    ("vmov d0, r0, r1", [0x41, 0xec, 0x10, 0x0b], False),
+    ("vmov r0, r1, d0", [0x51, 0xec, 0x10, 0x0b], False),
+    ("ldc p14, c5, [r1, #4]", [0x91, 0xed, 0x01, 0x5e], False),
+    ("vstr d0, [r0]", [0x80, 0xed, 0x00, 0x0b], True),
+    ("vstr s0, [r0, #8]", [0x80, 0xed, 0x02, 0x0a], True),
+    ("vpush {d8}", [0x2d, 0xed, 0x02, 0x8b], True),
+    ("vstmia r0!, {s0, s1}", [0xa0, 0xec, 0x02, 0x0a], True),
+    ("vldr d0, [r0]", [0x90, 0xed, 0x00, 0x0b], False),
+    ("vpop {d8}", [0xbd, 0xec, 0x02, 0x8b], False),
+    ("strd r0, r1, [r2]", [0xc2, 0xe9, 0x00, 0x01], True),
+    ("strex r0, r1, [r2]", [0x42, 0xe8, 0x00, 0x10], True),
+    ("ldrd r0, r1, [r2]", [0xd2, 0xe9, 0x00, 0x01], False),
+    ("str.w r0, [r1, #4]", [0xc1, 0xf8, 0x04, 0x00], True),
+    ("str r0, [r1]", [0x08, 0x60], True),
+    ("push {r4, lr}", [0x10, 0xb5], True),
+    ("ldr r0, [r1]", [0x08, 0x68], False),
+    ("bx lr", [0x70, 0x47], False),
+]
+
+BASE_ADDR = 0x08000000
+
+
+def first_halfword(encoding):
+    return encoding[0] | (encoding[1] << 8)
+
+
+class TestStoreEncodings(unittest.TestCase):
+
+    def test_classify_stores(self):
+        halfwords = numpy.array([first_halfword(e)
+                                 for (_, e, _) in INSTRUCTIONS],
+                                dtype=numpy.uint16)
+        wide = thumb_scan.is_wide(halfwords)
+        stores = thumb_scan.classify_stores(halfwords, wide)
+        for (asm, encoding, is_store), wide_instr, store in \
+                zip(INSTRUCTIONS, wide, stores):
+            self.assertEqual(wide_instr, len(encoding) == 4, asm)
+            self.assertEqual(store, is_store, asm)
+
+    def test_section_scan(self):
+        '''
+            Counts the instructions and stores of each as a function, and of
+            all of them as one, the way get_function_list does
+        '''
+        data = []
+        functs = []
+        for (asm, encoding, is_store) in INSTRUCTIONS:
+            functs.append((asm, BASE_ADDR + len(data), len(encoding),
+                           is_store))
+            data.extend(encoding)
+        data = numpy.array(data, dtype=numpy.uint8)
+        entries = [addr for (_, addr, _, _) in functs]
+        scan = thumb_scan.SectionScan(data, BASE_ADDR, [], entries)
+        for (asm, addr, size, is_store) in functs:
+            self.assertEqual(scan.get_stats(addr, size), (1, int(is_store)),
+                             asm)
+        num_stores = sum(1 for (_, _, s) in INSTRUCTIONS if s)
+        self.assertEqual(scan.get_stats(BASE_ADDR, len(data)),
+                         (len(INSTRUCTIONS), num_stores))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,293 @@
+'''
+    Counts the instructions and store instructions of each function by
+    scanning the Thumb-2 code in the ELF's executable sections (.text,
+    .hexbox_text_*, ...) with numpy, rather than disassembling it.
+
+    The length of a Thumb-2 instruction is given by the top five bits of its
+    first halfword, and stores are identified from their encodings (see
+    hexbox-rt/emulator.c).  Literal pools, marked with $d mapping symbols,
+    are counted one line per word as objdump lists them, and the metadata
+    word after each svc 100 is skipped.
+'''
+import numpy
+import elf_reader
+
+SVC_METADATA_INSTR = 0xDF64  # svc 100
+SVC_METADATA_SIZE = 4
+SVC_METADATA_HALFWORDS = SVC_METADATA_SIZE // 2
+
+# The number of times the metadata words are removed and the boundaries
+# recomputed, an svc 100 can only be found once the code before it has
+# been decoded correctly
+MAX_SVC_PASSES = 8
+
+# (mask, value) of the first halfword of each store encoding
+THUMB16_STORES = [(0xF800, 0xC000),  # STMIA
+                  (0xF800, 0x9000),  # STR  Rt, [SP, #imm8]
+                  (0xF800, 0x6000),  # STR  Rt, [Rn, #imm5]
+                  (0xF800, 0x7000),  # STRB Rt, [Rn, #imm5]
+                  (0xF800, 0x8000),  # STRH Rt, [Rn, #imm5]
+                  (0xFE00, 0x5000),  # STR  Rt, [Rn, Rm]
+                  (0xFE00, 0x5200),  # STRH Rt, [Rn, Rm]
+                  (0xFE00, 0x5400),  # STRB Rt, [Rn, Rm]
+                  (0xFE00, 0xB400)]  # PUSH
+
+THUMB32_STORES = [(0xFF10, 0xF800),  # STR{B,H}{T}, imm and reg forms
+                  (0xFFD0, 0xE880),  # STMIA.W
+                  (0xFFD0, 0xE900),  # STMDB / PUSH.W
+                  (0xFE50, 0xE840)]  # STRD, STREX{B,H,D}
+
+# STR{B,H}.W with op1 == 111 is undefined
+THUMB32_STR_UNDEFINED = (0xFFF0, 0xF8E0)
+
+# STC / VSTR / VSTM / VPUSH, excluding op1 == 000x00 (MCRR, VMOV to two
+# registers, or undefined), where P, U, and W (bits 8, 7, 5) are all 0.
+# The D bit (6) does not matter there.
+THUMB32_COPROC_STORE = (0xEE10, 0xEC00)
+THUMB32_COPROC_NOT_STORE = 0x01A0
+
+
+def is_wide(halfwords):
+    '''
+        True for each halfword that starts a 32 bit instruction
+        (top five bits 0b11101, 0b11110, or 0b11111)
+    '''
+    return (halfwords >> 11) >= 0x1D
+
+
+def _match_any(halfwords, encodings):
+    matched = numpy.zeros(len(halfwords), dtype=bool)
+    for (mask, value) in encodings:
+        matched |= (halfwords & mask) == value
+    return matched
+
+
+def classify_stores(halfwords, wide):
+    '''
+        True for each instruction (given by its first halfword) that is a
+        store
+    '''
+    stores16 = _match_any(halfwords, THUMB16_STORES)
+    mask, value = THUMB32_STR_UNDEFINED
+    stores32 = _match_any(halfwords, THUMB32_STORES) & \
+        ((halfwords & mask) != value)
+    mask, value = THUMB32_COPROC_STORE
+    stores32 |= ((halfwords & mask) == value) & \
+        ((halfwords & THUMB32_COPROC_NOT_STORE) != 0)
+    return numpy.where(wide, stores32, stores16)
+
+
+def _shift_right(mask):
+    shifted = numpy.zeros(len(mask), dtype=bool)
+    shifted[1:] = mask[:-1]
+    return shifted
+
+
+def _offset_in_run(run_begin):
+    '''
+        Returns the distance of each position from the last True in
+        run_begin at or before it
+    '''
+    idx = numpy.arange(len(run_begin))
+    begins = numpy.maximum.accumulate(numpy.where(run_begin, idx, 0))
+    return idx - begins
+
+
+def find_instr_starts(halfwords, not_code, resets):
+    '''
+        Finds the halfwords that start an instruction.
+
+        Decoding restarts at each True in resets (function entries and $t
+        mapping symbols), positions in not_code are never instructions.
+        In a run of consecutive halfwords that all look like the start of a
+        32 bit instruction every other halfword starts one, beginning with
+        the first.  Everywhere else each code halfword is a 16 bit
+        instruction, except the one just after a run of odd length which
+        is the second half of the run's last instruction.
+    '''
+    wide = is_wide(halfwords) & ~not_code
+    run_begin = wide & (~_shift_right(wide) | resets)
+    offset = _offset_in_run(run_begin)
+    wide_starts = wide & (offset % 2 == 0)
+    run_end = wide & ~(numpy.append(wide[1:], False) &
+                       ~numpy.append(resets[1:], False))
+    second_half = _shift_right(run_end & wide_starts) & ~resets
+    narrow_starts = ~wide & ~not_code & ~second_half
+    return wide_starts | narrow_starts, wide
+
+
+def _mapping_symbols(symbols, section_idx):
+    '''
+        Gets the $t/$d mapping symbols of a section, sorted by address
+        returns [(addr, is_data), ...]
+    '''
+    mapping = []
+    in_section = numpy.flatnonzero((symbols.section == section_idx) &
+                                   (symbols.type == elf_reader.STT_NOTYPE))
+    for i in in_section:
+        name = symbols.names[i]
+        if name[:2] in ('$t', '$a'):
+            mapping.append((int(symbols.addr[i]), False))
+        elif name[:2] == '$d':
+            mapping.append((int(symbols.addr[i]), True))
+    mapping.sort()
+    return mapping
+
+
+class SectionScan(object):
+    '''
+        Instruction boundaries and stores of one executable section, kept
+        as running counts per halfword so each function's counts are a
+        subtraction
+    '''
+    def __init__(self, data, base_addr, mapping, entry_points):
+        self.base_addr = base_addr
+        num_hw = len(data) // 2
+        halfwords = data[:num_hw * 2].view('<u2')
+        hw_addrs = base_addr + 2 * numpy.arange(num_hw, dtype=numpy.int64)
+
+        resets = numpy.zeros(num_hw, dtype=bool)
+        data_mask = numpy.zeros(num_hw, dtype=bool)
+        data_begin = numpy.zeros(num_hw, dtype=bool)
+        if mapping:
+            map_addrs = numpy.array([m[0] for m in mapping], dtype=numpy.int64)
+            map_data = numpy.array([m[1] for m in mapping], dtype=bool)
+            last_map = numpy.searchsorted(map_addrs, hw_addrs, 'right') - 1
+            data_mask = (last_map >= 0) & map_data[last_map]
+            map_pos = (map_addrs - base_addr) // 2
+            valid = (map_pos >= 0) & (map_pos < num_hw)
+            resets[map_pos[valid & ~map_data]] = True
+            data_begin[map_pos[valid & map_data]] = True
+        entry_pos = (numpy.array(entry_points, dtype=numpy.int64) -
+                     base_addr) // 2
+        resets[entry_pos[(entry_pos >= 0) & (entry_pos < num_hw)]] = True
+        if num_hw:
+            resets[0] = True
+
+        # Remove the metadata word after each svc 100 and decode again
+        skip = numpy.zeros(num_hw, dtype=bool)
+        for _ in xrange(MAX_SVC_PASSES):
+            starts, wide = find_instr_starts(halfwords, data_mask | skip,
+                                             resets)
+            svcs = numpy.flatnonzero(starts & (halfwords == SVC_METADATA_INSTR))
+            new_skip = skip.copy()
+            for i in xrange(1, SVC_METADATA_HALFWORDS + 1):
+                new_skip[svcs[svcs + i < num_hw] + i] = True
+            if numpy.array_equal(new_skip, skip):
+                break
+            skip = new_skip
+            after = svcs + SVC_METADATA_HALFWORDS + 1
+            resets[after[after < num_hw]] = True
+
+        # Literal pools are listed one .word (or trailing .short) per line
+        pool = data_mask & ~skip
+        pool_begin = pool & (~_shift_right(pool) | data_begin)
+        pool_lines = pool & (_offset_in_run(pool_begin) % 2 == 0)
+
+        stores = starts & classify_stores(halfwords, wide)
+        self.lines = numpy.concatenate(
+            ([0], numpy.cumsum(starts | pool_lines, dtype=numpy.int64)))
+        self.stores = numpy.concatenate(
+            ([0], numpy.cumsum(stores, dtype=numpy.int64)))
+
+    def get_stats(self, start, size):
+        '''
+            Returns (num_instrs, num_strs) of the function at start
+        '''
+        num_hw = len(self.lines) - 1
+        lo = min(max((start - self.base_addr) // 2, 0), num_hw)
+        hi = min(max((start + size - self.base_addr + 1) // 2, lo), num_hw)
+        return (int(self.lines[hi] - self.lines[lo]),
+                int(self.stores[hi] - self.stores[lo]))
+
+
+def scan_sections(elf, symbols, functs):
+    '''
+        Scans every executable section of elf
+        Returns {section_name: SectionScan}
+    '''
+    sections = elf.sections
+    entries = {}
+    for (name, addr, size, section_name) in functs:
+        entries.setdefault(section_name, []).append(addr)
+    scans = {}
+    for idx in xrange(len(sections)):
+        if not sections.flags[idx] & elf_reader.SHF_EXECINSTR:
+            continue
+        name = sections.names[idx]
+        data = elf.section_data(name)
+        if data is None:
+            continue
+        scans[name] = SectionScan(data, int(sections.addr[idx]),
+                                  _mapping_symbols(symbols, idx),
+                                  entries.get(name, []))
+    return scans
+
+
+def get_function_symbols(symbols):
+    '''
+        Gets the function symbols from an elf_reader.SymbolTable
+        returns [(name, addr, size, section), ...]
+    '''
+    functs = []
+    for i in symbols.functions():
+        functs.append((symbols.names[i], int(symbols.addr[i]),
+                       int(symbols.size[i]), symbols.section_name(i)))
+    return functs
+
+
+def get_metadata_size(symbols):
+    '''
+        Gets the number of bytes of hexbox metadata in .rodata
+    '''
+    metadata_size = 0
+    for i in xrange(len(symbols)):
+        name = symbols.names[i]
+        if ("__hexbox_md" in name or "_hexbox_comp" in name) and \
+           ".rodata" in symbols.section_name(i):
+            metadata_size += int(symbols.size[i])
+    return metadata_size
+
+
+def get_function_list(bin_file, symbols):
+    '''
+        Scans bin_file and gets the statistics for every function symbol in
+        symbols (an elf_reader.SymbolTable)
+
+        Returns: [(name, section, num_bytes, num_instrs, num_strs), ...]
+    '''
+    functs = get_function_symbols(symbols)
+    with elf_reader.ElfFile(bin_file) as elf:
+        scans = scan_sections(elf, symbols, functs)
+    funct_list = []
+    for (name, addr, size, section_name) in functs:
+        if scans.has_key(section_name):
+            num_instrs, num_strs = scans[section_name].get_stats(addr, size)
+        else:
+            num_instrs, num_strs = (0, 0)
+        funct_list.append((name, section_name, size, num_instrs, num_strs))
+    return funct_list
+
+
+def build_function_table(funct_list, metadata_size):
+    '''
+        Builds the function table from the output of get_function_list
+
+        Returns:
+        functs = {name: {'NUM_BYTES': int, 'NUM_INSTR': int, 'NUM_STRS': int,
+                         'SECTION': str}, ...}
+        sections = {section_name: {'NUM_BYTES': int, 'NUM_INSTR': int}, ...}
+        metadata_size = int
+    '''
+    functs = {}
+    sections = {}
+    for (name, section_name, size, num_instrs, num_strs) in funct_list:
+        functs[name] = {'NUM_BYTES': size,
+                        'NUM_INSTR': num_instrs,
+                        'NUM_STRS': num_strs,
+                        'SECTION': section_name}
+        if not sections.has_key(section_name):
+            sections[section_name] = {'NUM_BYTES': 0, 'NUM_INSTR': 0}
+        sections[section_name]['NUM_BYTES'] += size
+        sections[section_name]['NUM_INSTR'] += num_instrs
+    return functs, sections, metadata_size
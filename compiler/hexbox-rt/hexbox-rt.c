@@ -184,6 +184,9 @@ enum hexbox_switch_type __attribute__((used))handle_svc(struct exception_frame *
     // ------------------------Compartment Entry ----------------------------
     if( instr == SVC100){ //Compartment Entry
       switch_type = ENTRY;
+#ifndef ENFORCE
+      __profiler_count_comp_addr((uint32_t)stack->pc);
+#endif
       uint32_t *dest_addr = stack->lr;
       md = (struct hexbox_metadata *)(*stack->pc);
       p = __hexbox_get_policy(md,(uint32_t)stack->lr);
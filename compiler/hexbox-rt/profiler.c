@@ -103,7 +103,7 @@ void __profiler_count_comp_addr(uint32_t pc){
   //  TODO Change to  use red-black tree allocated in an array
   //  A large amount of time is used just searching through the array
   uint32_t i;
-  struct profiler_pc_record* buf = (struct profiler_pc_record*)COMP_SWITCH_BUF_SIZE;
+  struct profiler_pc_record* buf = (struct profiler_pc_record*)COMP_SWITCH_ADDRS;
 
   for (i = 0; i < COMP_SWITCH_BUF_SIZE / sizeof(struct profiler_pc_record); ++i){
     if (buf[i].pc == pc || buf[i].pc ==  0){
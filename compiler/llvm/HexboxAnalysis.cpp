@@ -23,6 +23,8 @@
 #include "llvm/ADT/SmallSet.h"
 #include "llvm/IR/Constants.h"
 #include "llvm/IR/DebugInfoMetadata.h"
+#include "llvm/IR/Dominators.h"
+#include "llvm/Analysis/LoopInfo.h"
 #include "json/json.h"  //From https://github.com/open-source-parsers/jsoncpp
 #include <fstream>
 
@@ -89,14 +91,23 @@ namespace {
             }
         }
 
+        //Loop depth of the call sites, used to weight the connections
+        DominatorTree DT;
+        LoopInfo LI;
+        if ( !F.isDeclaration() ){
+            DT.recalculate(F);
+            LI.analyze(DT);
+        }
+
         //Adds Callees
         for ( BasicBlock &BB : F ){
+            unsigned loop_depth = LI.getLoopDepth(&BB);
             for ( Instruction & I : BB ){
                 if ( CallSite cs = CallSite(&I) ){
                     if (cs){
                         Function * callee = cs.getCalledFunction();
                         if ( callee ){
-                            add_connection(*Fnode,callee->getName().str(),"Callee");
+                            add_connection(*Fnode,callee->getName().str(),"Callee",loop_depth);
 
                         }else if ( InlineAsm * IA = dyn_cast_or_null<InlineAsm>(cs.getCalledValue()) ){
                             std::string str;
@@ -108,7 +119,7 @@ namespace {
                             Instruction * Inst = ConstEx->getAsInstruction();
                             if( CastInst * CI = dyn_cast_or_null<CastInst>(Inst) ){
                                 if ( Function * c = dyn_cast<Function>(Inst->getOperand(0)) ){
-                                    add_connection(*Fnode,c->getName().str(),"Callee");
+                                    add_connection(*Fnode,c->getName().str(),"Callee",loop_depth);
 
                                 }else{
                                     assert(false && "Unhandled Cast");
@@ -128,11 +139,25 @@ namespace {
     }
 
 
-    void add_connection(Json::Value & Fnode, std::string name ,std::string type){
+    void add_connection(Json::Value & Fnode, std::string name ,std::string type,
+                        unsigned loop_depth=0){
         Json::Value *Connections;
         Connections = &Fnode["Connections"][name];
         (*Connections)["Type"] = type;
         (*Connections)["Count"] = (*Connections)["Count"].asUInt64() + 1;
+        //Number of the connection's call sites at each loop depth, omitted
+        //if none are in a loop
+        if ( loop_depth > 0 && !Connections->isMember("Loop Depths") ){
+            //The call sites added before were not in a loop
+            (*Connections)["Loop Depths"].append((*Connections)["Count"].asUInt64() - 1);
+        }
+        if ( Connections->isMember("Loop Depths") ){
+            Json::Value & Depths = (*Connections)["Loop Depths"];
+            while ( Depths.size() <= loop_depth ){
+                Depths.append(0u);
+            }
+            Depths[loop_depth] = Depths[loop_depth].asUInt64() + 1;
+        }
     }
 
 
@@ -568,7 +593,7 @@ namespace {
                  Global = &OutputJsonRoot[GV.getName().str()];
                  add_connection(*Global,F->getName().str(),"Data");
                  (*Global)["Attr"]["Type"]="Global";
-                 (*Global)["Attr"]["Size"] = M.getDataLayout().getTypeAllocSize(GV.getType());
+                 (*Global)["Attr"]["Size"] = M.getDataLayout().getTypeAllocSize(GV.getValueType());
                  // Don't know why you use 0 in the getMetadata() below but I've tried a bunch of other options
                  // like Metadata::DIGlobalVariableExpressionKind etc and always get null
                  if ( DIGlobalVariableExpression * DI_GVE = dyn_cast_or_null<DIGlobalVariableExpression>(GV.getMetadata(0)) ){
@@ -177,17 +177,46 @@ $$(HEXBOX_ANALYSIS_FILE): $$(HEXBOX_IR_FILE) Makefile | $$(HEXBOX_DIR)
 	--plugin-opt=-hexbox-analysis-size=$$(HEXBOX_SIZE_FILE) \
 	-o $$(BIN_DIR)/$$(TARGET)--baseline.elf >/dev/null 2>/dev/null
 
-# Generate Linker Script and Partitioning
-$$(HEXBOX_POLICY_FILE): $$(HEXBOX_ANALYSIS_FILE) Makefile | $$(HEXBOX_DIR)
+# Recorded compartment switches for HEXBOX_METHOD=profile, a dump from
+# dump_switch_counts in gdb_helpers.py needs the recorded binary too
+HEXBOX_PROFILE ?=
+HEXBOX_PROFILE_ELF ?=
+# Recorded emulated stores, {compartment: {global: count}}, and the policy
+# they were recorded with, for any HEXBOX_METHOD
+HEXBOX_EMULATED_STORES ?=
+HEXBOX_RECORDED_POLICY ?=
+HEXBOX_PROFILE_OPTS = $$(if $$(HEXBOX_PROFILE),-p=$$(HEXBOX_PROFILE)) \
+	$$(if $$(HEXBOX_PROFILE_ELF),--profile-elf=$$(HEXBOX_PROFILE_ELF)) \
+	$$(if $$(HEXBOX_EMULATED_STORES),-e=$$(HEXBOX_EMULATED_STORES)) \
+	$$(if $$(HEXBOX_RECORDED_POLICY),--recorded-policy=$$(HEXBOX_RECORDED_POLICY))
+
+# Generate Linker Script and Partitioning, one run writes both.  A new
+# profile or emulated store recording regenerates them
+$$(HEXBOX_POLICY_FILE): $$(HEXBOX_ANALYSIS_FILE) Makefile $$(HEXBOX_PROFILE) \
+		$$(HEXBOX_EMULATED_STORES) | $$(HEXBOX_DIR)
 	python $HEXBOX_GRAPH_TOOL -j=$$(HEXBOX_ANALYSIS_FILE) -s=$$(HEXBOX_SIZE_FILE) \
 	  -o=$$(HEXBOX_POLICY_FILE) -T=$$(LDSCRIPT) -L=$$(HEXBOX_INTER_LINKER_SCRIPT) \
-	  -m=$$(HEXBOX_METHOD) -b=STM32F479 -n=$$(NUM_MPU_REGIONS)
-
-# Generate Linker Script and Partitioning
-$$(HEXBOX_INTER_LINKER_SCRIPT): $$(HEXBOX_ANALYSIS_FILE) Makefile | $$(HEXBOX_DIR)
+	  -m=$$(HEXBOX_METHOD) -b=STM32F479 -n=$$(NUM_MPU_REGIONS) \
+	  $$(HEXBOX_PROFILE_OPTS)
+
+$$(HEXBOX_INTER_LINKER_SCRIPT): $$(HEXBOX_POLICY_FILE) ;
+
+# Policies and linker scripts for all of HEXBOX_METHODS and
+# HEXBOX_MPU_COUNTS from one analyzer run, named as the builds with
+# HEXBOX_METHOD and NUM_MPU_REGIONS set to each expect
+HEXBOX_METHODS ?= filename filename-no-opt peripheral
+HEXBOX_MPU_COUNTS ?= $$(NUM_MPU_REGIONS)
+empty :=
+comma := ,
+commas = $$(subst $$(empty) $$(empty),$$(comma),$$(strip $$(1)))
+hexbox_policies: $$(HEXBOX_ANALYSIS_FILE) Makefile | $$(HEXBOX_DIR)
 	python $HEXBOX_GRAPH_TOOL -j=$$(HEXBOX_ANALYSIS_FILE) -s=$$(HEXBOX_SIZE_FILE) \
-    -o=$$(HEXBOX_POLICY_FILE) -T=$$(LDSCRIPT) -L=$$(HEXBOX_INTER_LINKER_SCRIPT) \
-    -m=$$(HEXBOX_METHOD) -b=STM32F479
+	  -o=$$(HEXBOX_DIR)/hexbox-policy--{method}--mpu-{mpu}.json \
+	  -T=$$(LDSCRIPT) \
+	  -L=$$(HEXBOX_DIR)/hexbox-intermediate--{method}--mpu-{mpu}.ld \
+	  -m=$$(call commas,$$(HEXBOX_METHODS)) \
+	  -b=STM32F479 -n=$$(call commas,$$(HEXBOX_MPU_COUNTS)) \
+	  $$(HEXBOX_PROFILE_OPTS)
 
 $$(HEXBOX_FINAL_LINKER_SCRIPT): $$(BIN_DIR)/$$(TARGET)--hexbox--inter.elf Makefile | $$(HEXBOX_DIR)
 			python $HEXBOX_FINAL_LD_TOOL -o=$$(BIN_DIR)/$$(TARGET)--hexbox--inter.elf \
@@ -227,7 +256,8 @@ $$(BIN_DIR)/$$(TARGET)--hexbox--final.elf:$$(HEXBOX_FINAL_POLICY_FILE) $$(HEXBOX
 
 $$(HEXBOX_DIR)/$$(TARGET).dot: $$(HEXBOX_ANALYSIS_FILE) FORCE
 	python $HEXBOX_GRAPH_TOOL -j=$$(HEXBOX_ANALYSIS_FILE) -s=$$(HEXBOX_SIZE_FILE) \
-	-d=$$@
+	--debug-dir=$$(HEXBOX_DIR)/debug
+	cp $$(HEXBOX_DIR)/debug/all_nodes.dot $$@
 
 $$(HEXBOX_DIR)/$$(TARGET).svg: $$(HEXBOX_DIR)/$$(TARGET).dot FORCE
 	dot -Tsvg $$^ -o $$@
@@ -258,6 +288,6 @@ clean:
 #######################################
 -include $$(shell mkdir .dep 2>/dev/null) $$(wildcard .dep/*)
 
-.PHONY: clean all
+.PHONY: clean all hexbox_policies
 
 # *** EOF ***
@@ -376,6 +376,14 @@ def dump_mem(filename="accesses.bin"):
     gdb.execute("dump binary memory %s 0x10000000 0x1000E000" % filename)
 
 
+def dump_switch_counts(filename="switches.bin"):
+    '''
+        Dumps the PCs of compartment entries and their counts, used for
+        profile guided partitioning (analyzer.py -m profile -p <file>)
+    '''
+    gdb.execute("dump binary memory %s 0x1000E000 0x1000F000" % filename)
+
+
 def connect():
     gdb.execute('target remote localhost:3333')
     gdb.execute('monitor reset halt')
@@ -568,6 +576,7 @@ def record_memory():
     filename = get_filename()
     name, ext = os.path.splitext(filename)
     dump_mem('mem_accesses_' + name + '.bin')
+    dump_switch_counts('comp_switches_' + name + '.bin')
 
 
 